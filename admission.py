@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+from ratelimit import TokenBucket
+
+#Admission control for the DHT listener, run on every datagram before it is decoded.
+#
+#1. size: a query is a few hundred bytes at most, anything bigger than MAX_QUERY_SIZE is dropped unread. replies
+#   get MAX_REPLY_SIZE, a get_peers reply with 50 json peers is well over the query limit
+#2. per source: every sending ip gets a TokenBucket (SOURCE_RATE datagrams/s, SOURCE_BURST at once), kept in an LRU
+#   of at most max_sources entries, so a flood from fresh addresses can't grow it without bound. a client that
+#   hammers us is dropped instead of taking the listener's time away from everyone else. queries and replies
+#   draw from the same bucket
+#3. shape: for a query the codec's looks_like_query (a few byte compares) rejects garbage before the full decode.
+#   a reply must carry the transaction id of a query we are waiting for (codec.transaction_ids, a byte search),
+#   so replies nobody asked for are never decoded
+#
+#and under load, answering comes first: when more than overload_rate datagrams a second come in, or the listener
+#reports a backlog (a full batch / queue in worker mode), senders stop being added to the routing table. answering
+#a query is a lookup in memory, an insert takes the table lock and can queue a ping of the bucket's oldest node.
+#
+#   verdict = admission.admit(data, ip, codec)      None = go on, else the reason it was dropped
+#   verdict = admission.admit_reply(data, ip, codec, pending)       the same for replies (pending: our open ids)
+#   learn = admission.allow_insert()                 False while overloaded
+
+MAX_QUERY_SIZE = 1024
+MAX_REPLY_SIZE = 4096  # what Node.send_rpc reads
+SOURCE_RATE = 25  # queries per second per ip
+SOURCE_BURST = 100
+MAX_SOURCES = 10000
+OVERLOAD_RATE = 2000  # datagrams per second over which routing table inserts are skipped
+TRUSTED = ("127.0.0.1", "::1")  # not rate limited per source (local tools, tests)
+
+
+class Admission:
+    def __init__(self, source_rate=SOURCE_RATE, source_burst=SOURCE_BURST, max_sources=MAX_SOURCES,
+                 overload_rate=OVERLOAD_RATE, max_size=MAX_QUERY_SIZE, max_reply_size=MAX_REPLY_SIZE, trusted=TRUSTED,
+                 clock=time.monotonic):
+        self.source_rate = source_rate
+        self.source_burst = source_burst
+        self.max_sources = max_sources
+        self.max_size = max_size
+        self.max_reply_size = max_reply_size
+        self.trusted = set(trusted)
+        self.clock = clock
+        self.sources = OrderedDict()  # ip -> TokenBucket, least recently heard from first
+        self.lock = threading.Lock()  # worker mode admits from several threads
+        self.load = TokenBucket(overload_rate, overload_rate, clock)  # runs dry when we are over overload_rate
+        self.overloaded = False
+        self.backlogged = False  # set by the listener while it can't keep up
+
+    #None if the query may be decoded and answered, otherwise why it is dropped
+    def admit(self, data, ip, codec):
+        verdict = self.check(data, ip, self.max_size)
+        if verdict is None and not codec.looks_like_query(data):
+            return "malformed"
+        return verdict
+
+    #None if the reply may be decoded, otherwise why it is dropped. pending = transaction ids we wait on
+    def admit_reply(self, data, ip, codec, pending):
+        verdict = self.check(data, ip, self.max_reply_size)
+        if verdict is None and not any(t in pending for t in codec.transaction_ids(data)):
+            return "unexpected"
+        return verdict
+
+    #size and per source limits, the same for every datagram
+    def check(self, data, ip, max_size):
+        self.overloaded = not self.load.try_take()
+        if len(data) > max_size:
+            return "oversized"
+        if ip not in self.trusted and not self.source_allows(ip):
+            return "rate_limited"
+        return None
+
+    def source_allows(self, ip):
+        with self.lock:
+            bucket = self.sources.get(ip)
+            if bucket is None:
+                bucket = self.sources[ip] = TokenBucket(self.source_rate, self.source_burst, self.clock)
+                if len(self.sources) > self.max_sources:
+                    self.sources.popitem(last=False)
+            else:
+                self.sources.move_to_end(ip)
+            return bucket.try_take()
+
+    #may the sender of the query being answered go into the routing table
+    def allow_insert(self):
+        return not (self.overloaded or self.backlogged)
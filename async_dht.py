@@ -0,0 +1,248 @@
+import asyncio
+import time
+
+from core import Node
+from krpc import well_formed_reply
+from dht_snapshot import SNAPSHOT_INTERVAL
+
+
+#asyncio version of the DHT node
+#everything goes over the one bound Node.sock: outgoing queries and incoming queries share it,
+#and replies are matched back to the waiting coroutine through the transaction id ("t")
+class DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def connection_made(self, transport):
+        self.node.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.node.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        #ICMP port unreachable etc. -> the pending query just times out
+        pass
+
+
+class AsyncNode(Node):
+    def __init__(self, ip, port, bootstrap_nodes=None, codec="json", rpc_timeout=2, snapshot_path=None,
+                 snapshot_interval=SNAPSHOT_INTERVAL, metrics=None, admission=None):
+        super().__init__(ip, port, bootstrap_nodes, codec, snapshot_path=snapshot_path, metrics=metrics,
+                         admission=admission)
+        self.rpc_timeout = rpc_timeout
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_task = None
+        self.transport = None
+        self.pending = {}  # transaction_id -> future waiting for the reply
+        self.ping_tasks = set()  # liveness checks started by full buckets
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: DHTProtocol(self), sock=self.sock)
+        if self.snapshot_path:
+            self.snapshot_task = asyncio.ensure_future(self.save_periodically())
+
+    #periodic snapshots, written by a worker thread (fsync) so the loop keeps serving
+    async def save_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await loop.run_in_executor(None, self.save_snapshot)
+            except OSError:
+                pass
+
+    #the last snapshot is written here, on shutdown
+    def close(self):
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+        if self.snapshot_path:
+            try:
+                self.save_snapshot()
+            except OSError:
+                pass
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+        self.pending.clear()
+        for task in self.ping_tasks:
+            task.cancel()
+        if self.transport:
+            self.transport.close()
+
+    def datagram_received(self, data, addr):
+        #queries carry a "type", replies don't. both go through admission control first (see admission.py)
+        is_query = self.codec.looks_like_query(data)
+        if is_query:
+            if not self.admit(data, addr):
+                return
+        elif not self.admit_reply(data, addr, self.pending):
+            return
+        try:
+            message = self.codec.decode(data)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            self.metrics.inc("dht_parse_errors_total", kind="datagram")
+            return
+
+        if "type" in message:
+            if not is_query:
+                self.metrics.inc("dht_dropped_total", reason="malformed")  # slipped past the shape check
+                return
+            try:
+                response = self.dispatch(message, addr, self.may_learn())
+            except (KeyError, TypeError, ValueError, AttributeError):
+                self.metrics.inc("dht_query_errors_total", rpc=str(message["type"]))
+                return
+            if response is not None:
+                self.transport.sendto(self.codec.encode(response), addr)
+            return
+
+        future = self.pending.pop(message.get("t"), None)
+        if future and not future.done():
+            future.set_result(message)
+        else:
+            self.metrics.inc("dht_unmatched_replies_total")  # late (timed out) or never asked for
+
+    #the threaded listener isn't needed, the event loop reads Node.sock
+    def start_dht_listener(self):
+        raise RuntimeError("AsyncNode is driven by the event loop, use 'await node.start()'")
+
+    #full buckets ask for their oldest node to be checked, runs as a task so the handler returns right away
+    def queue_ping(self, node_id, ip, port):
+        task = asyncio.ensure_future(self.check_liveness(node_id, ip, port))
+        self.ping_tasks.add(task)
+        task.add_done_callback(self.ping_tasks.discard)
+
+    async def check_liveness(self, node_id, ip, port):
+        self.routing_table.ping_result(node_id, await self.ping_node(ip, port))
+
+    async def ping_node(self, ip, port):
+        return await self.send_rpc(ip, port, {
+            "type": "ping",
+            "node_id": self.node_id,
+            "port": self.port
+        }) is not None
+
+    def new_transaction_id(self):
+        transaction_id = super().new_transaction_id()
+        while transaction_id in self.pending:
+            transaction_id = super().new_transaction_id()
+        return transaction_id
+
+    #Core RPC function, same contract as Node.send_rpc (reply dict or None) but awaitable
+    async def send_rpc(self, ip, port, message):
+        metrics = self.metrics
+        rpc = message.get("type")
+        metrics.inc("dht_rpc_sent_total", rpc=rpc)
+        started = time.perf_counter()
+        transaction_id = self.new_transaction_id()
+        message["t"] = transaction_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction_id] = future
+        try:
+            self.transport.sendto(self.codec.encode(message), (ip, port))
+            reply = await asyncio.wait_for(future, self.rpc_timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("dht_rpc_timeouts_total", rpc=rpc)
+            return None
+        except asyncio.CancelledError:
+            return None
+        except (OSError, OverflowError, TypeError, ValueError) as error:
+            metrics.inc("dht_rpc_errors_total", rpc=rpc, error=type(error).__name__)
+            return None
+        finally:
+            self.pending.pop(transaction_id, None)
+        metrics.observe("dht_rpc_latency_seconds", time.perf_counter() - started, rpc=rpc)
+        if not well_formed_reply(reply):
+            metrics.inc("dht_bad_replies_total", rpc=rpc)
+            return None
+        return reply
+
+
+    #OUTGOING RPC
+    async def ping(self, node_id, ip, port):
+        response = await self.send_rpc(ip, port, {
+            "type": "ping",
+            "node_id": self.node_id,
+            "port": self.port
+        })
+        if response and "node_id" in response:
+            self.routing_table.add_node(response["node_id"], ip, port, self.queue_ping)
+        return response
+
+    async def find_node(self, node_id, ip, port, target_id):
+        response = await self.send_rpc(ip, port, {
+            "type": "find_node",
+            "node_id": self.node_id,
+            "target_id": target_id,
+            "port": self.port
+        })
+        if response and "nodes" in response:
+            for n_id, n_ip, n_port in response["nodes"]:
+                self.routing_table.add_node(n_id, n_ip, n_port, self.queue_ping)
+        return response
+
+    async def get_peers(self, node_id, ip, port, info_hash):
+        response = await self.send_rpc(ip, port, {
+            "type": "get_peers",
+            "node_id": self.node_id,
+            "info_hash": info_hash,
+            "port": self.port
+        })
+        if response and "nodes" in response:
+            for n_id, n_ip, n_port in response["nodes"]:
+                self.routing_table.add_node(n_id, n_ip, n_port, self.queue_ping)
+        return response
+
+    async def announce_peer(self, node_id, ip, port, info_hash):
+        return await self.send_rpc(ip, port, {
+            "type": "announce_peer",
+            "node_id": self.node_id,
+            "info_hash": info_hash,
+            "port": self.port
+        })
+
+    #all seed nodes and snapshot contacts are pinged at once instead of one 2s timeout after another
+    async def bootstrap(self):
+        await asyncio.gather(*(self.ping(*target) for target in self.bootstrap_targets()))
+
+
+    #Iterative lookup, same Lookup state machine as Node.run_lookup but the queries are tasks
+    async def run_lookup(self, lookup, rpc):
+        in_flight = {}
+        try:
+            while True:
+                for path, candidate in lookup.next_queries():
+                    in_flight[asyncio.ensure_future(rpc(candidate))] = (path, candidate)
+                if lookup.done or not in_flight:
+                    break
+                finished, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    path, candidate = in_flight.pop(task)
+                    lookup.on_response(path, candidate, task.result())
+        finally:
+            for task in in_flight:
+                task.cancel()
+        return lookup
+
+    async def iterative_find_node(self, target_id, alpha=3, paths=1):
+        lookup = self.new_lookup(target_id, alpha, paths)
+        await self.run_lookup(lookup, lambda c: self.find_node(c.node_id, c.ip, c.port, target_id))
+        return lookup.closest_nodes()
+
+    async def iterative_get_peers(self, info_hash, alpha=3, want_peers=50, paths=1):
+        lookup = self.new_lookup(info_hash, alpha, paths, want_peers)
+        await self.run_lookup(lookup, lambda c: self.get_peers(c.node_id, c.ip, c.port, info_hash))
+        return lookup.found_peers
+
+    #one get_peers walk all the way to the closest nodes, then announce_peer to those that answered: the same
+    #lookup finds peers and the announce targets, no separate find_node walk. returns (peers, nodes that took it)
+    async def get_peers_and_announce(self, info_hash, alpha=3):
+        lookup = self.new_lookup(info_hash, alpha, 1)
+        await self.run_lookup(lookup, lambda c: self.get_peers(c.node_id, c.ip, c.port, info_hash))
+        replies = await asyncio.gather(*(
+            self.announce_peer(node_id, ip, port, info_hash) for node_id, ip, port in lookup.closest_nodes()
+        ))
+        return lookup.found_peers, sum(1 for reply in replies if reply is not None)
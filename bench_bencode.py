@@ -0,0 +1,55 @@
+#bencode round trip benchmark: bencode vs the previous += encoder, and bdecode of the result
+import io
+import os
+import time
+
+from read_torrent import bdecode, bencode, bencode_to, TorrentFile
+
+
+#the encoder TorrentFile used to have, kept here for comparison
+def previous_bencode(obj):
+    if isinstance(obj, int):
+        return b'i' + str(obj).encode() + b'e'
+    elif isinstance(obj, (bytes, memoryview)):
+        return str(len(obj)).encode() + b':' + bytes(obj)
+    elif isinstance(obj, list):
+        return b'l' + b''.join(previous_bencode(x) for x in obj) + b'e'
+    elif isinstance(obj, dict):
+        result = b'd'
+        for key in sorted(obj.keys()):
+            result += previous_bencode(key)
+            result += previous_bencode(obj[key])
+        result += b'e'
+        return result
+    raise TypeError("Unsupported type")
+
+
+def timed(label, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print("  %-26s %9.2f ms" % (label, elapsed * 1000))
+    return result
+
+
+torrent = TorrentFile("ubuntu-25.10-desktop-amd64.iso.torrent")
+samples = {
+    "ubuntu iso info dict": (torrent.info, 50),
+    "multi-file, 50k files": ({
+        b"name": b"dataset",
+        b"piece length": 1 << 20,
+        b"pieces": os.urandom(20 * 20000),
+        b"files": [{b"length": i * 4096, b"path": [b"shard%d" % (i % 100), b"part%06d.bin" % i]}
+                   for i in range(50000)],
+    }, 3),
+    "KRPC find_node reply": ({b"t": b"aa", b"y": b"r", b"r": {b"id": os.urandom(20), b"nodes": os.urandom(208)}}, 20000),
+}
+
+for label, (value, repeat) in samples.items():
+    print("\n" + label)
+    encoded = timed("bencode", lambda: bencode(value), repeat)
+    timed("previous encoder", lambda: previous_bencode(value), repeat)
+    timed("bencode_to (BytesIO)", lambda: bencode_to(value, io.BytesIO()), repeat)
+    timed("bdecode", lambda: bdecode(encoded), repeat)
+    print("  %d bytes" % len(encoded))
@@ -0,0 +1,32 @@
+#DHT benchmark on the in-memory simulation (dht_sim.py)
+#python bench_dht_sim.py --nodes 2000 --lookups 500 --loss 0.02 --churn 0.2
+import argparse
+import time
+
+from dht_sim import SimNetwork, format_stats
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--nodes", type=int, default=1000)
+parser.add_argument("--lookups", type=int, default=300)
+parser.add_argument("--latency", type=float, nargs=2, default=(0.01, 0.1), metavar=("MIN", "MAX"),
+                    help="one way latency range in seconds")
+parser.add_argument("--loss", type=float, default=0.0, help="datagram loss probability")
+parser.add_argument("--churn", type=float, default=0.0, help="fraction of nodes replaced before the lookups")
+parser.add_argument("--alpha", type=int, default=3)
+parser.add_argument("--paths", type=int, default=1)
+parser.add_argument("--seed", type=int, default=1)
+args = parser.parse_args()
+
+start = time.perf_counter()
+network = SimNetwork(latency=tuple(args.latency), loss=args.loss, seed=args.seed)
+network.build(args.nodes)
+built = time.perf_counter() - start
+print("built %d nodes in %.1fs (%d messages)" % (args.nodes, built, network.messages))
+if args.churn:
+    network.churn(args.churn)
+    print("churned %.0f%% of the nodes" % (100 * args.churn))
+
+start = time.perf_counter()
+stats = network.run_lookups(args.lookups, alpha=args.alpha, paths=args.paths)
+print("ran %d lookups in %.1fs\n" % (args.lookups, time.perf_counter() - start))
+print(format_stats(stats))
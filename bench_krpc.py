@@ -0,0 +1,25 @@
+#compares the json and bencode DHT wire formats: bytes per packet and encode/decode time
+import random
+import timeit
+
+from krpc import get_codec
+
+N = 20000
+
+nodes = [(random.getrandbits(160), "10.0.%d.%d" % (i, i), 6881 + i) for i in range(8)]
+samples = {
+    "find_node query": {"type": "find_node", "node_id": random.getrandbits(160),
+                        "target_id": random.getrandbits(160), "port": 6881, "t": 1234},
+    "find_node reply (k=8)": {"node_id": random.getrandbits(160), "nodes": nodes, "t": 1234},
+    "get_peers reply (50 peers)": {"node_id": random.getrandbits(160), "t": 1234,
+                                   "values": [("10.1.%d.%d" % (i, i), 6881 + i) for i in range(50)]},
+}
+
+for label, message in samples.items():
+    print("\n" + label)
+    for name in ("json", "bencode"):
+        codec = get_codec(name)
+        packet = codec.encode(message)
+        encode_us = timeit.timeit(lambda: codec.encode(message), number=N) / N * 1e6
+        decode_us = timeit.timeit(lambda: codec.decode(packet), number=N) / N * 1e6
+        print("  %-8s %5d bytes  encode %6.2fus  decode %6.2fus" % (name, len(packet), encode_us, decode_us))
@@ -0,0 +1,25 @@
+#torrent creation throughput with 1 hashing thread vs one per core, over a generated file
+import os
+import sys
+import tempfile
+import time
+
+from make_torrent import make_torrent
+
+SIZE_MB = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+path = os.path.join(tempfile.mkdtemp(), "image.bin")
+with open(path, "wb") as f:
+    for _ in range(SIZE_MB):
+        f.write(os.urandom(1024 * 1024))
+
+pieces = None
+for workers in sorted({1, os.cpu_count() or 1}):
+    start = time.perf_counter()
+    metainfo = make_torrent(path, workers=workers)
+    elapsed = time.perf_counter() - start
+    assert pieces is None or metainfo[b'info'][b'pieces'] == pieces
+    pieces = metainfo[b'info'][b'pieces']
+    print("%2d worker(s): %6.1f MB/s" % (workers, SIZE_MB / elapsed))
+
+os.remove(path)
@@ -0,0 +1,32 @@
+#recheck throughput with 1 worker vs one per core, over a generated file
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+from piece_verify import PieceHashes, PieceVerifier
+
+SIZE_MB = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+PIECE_LENGTH = 256 * 1024
+
+path = os.path.join(tempfile.mkdtemp(), "data.bin")
+digests = []
+with open(path, "wb") as f:
+    for _ in range(SIZE_MB * 1024 * 1024 // PIECE_LENGTH):
+        piece = os.urandom(PIECE_LENGTH)
+        digests.append(hashlib.sha1(piece).digest())
+        f.write(piece)
+hashes = PieceHashes(b"".join(digests))
+files = [(path, SIZE_MB * 1024 * 1024)]
+
+for workers in sorted({1, os.cpu_count() or 1}):
+    verifier = PieceVerifier(hashes, workers)
+    start = time.perf_counter()
+    results = verifier.recheck(files, PIECE_LENGTH)
+    elapsed = time.perf_counter() - start
+    verifier.close()
+    assert all(results)
+    print("%2d worker(s): %6.1f MB/s" % (workers, SIZE_MB / elapsed))
+
+os.remove(path)
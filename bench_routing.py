@@ -0,0 +1,40 @@
+#routing table insert throughput: new contacts, refreshes of known contacts, and get_closest_nodes
+import random
+import time
+
+from core import RoutingTable
+
+N = 200000
+
+
+def no_ping(node_id, ip, port):
+    pass
+
+
+def rate(label, count, seconds):
+    print("  %-28s %10.0f ops/s  (%.2f us/op)" % (label, count / seconds, seconds / count * 1e6))
+
+
+table = RoutingTable(random.getrandbits(160))
+ids = [random.getrandbits(160) for _ in range(N)]
+
+print("routing table, %d operations each" % N)
+start = time.perf_counter()
+for node_id in ids:
+    table.add_node(node_id, "10.0.0.1", 6881, no_ping)
+rate("add_node (random ids)", N, time.perf_counter() - start)
+
+known = [n.node_id for b in table.buckets for n in b.nodes]
+refreshes = [random.choice(known) for _ in range(N)]
+start = time.perf_counter()
+for node_id in refreshes:
+    table.add_node(node_id, "10.0.0.1", 6881, no_ping)
+rate("add_node (refresh known)", N, time.perf_counter() - start)
+
+targets = ids[:N // 10]
+start = time.perf_counter()
+for target in targets:
+    table.get_closest_nodes(target, table.k)
+rate("get_closest_nodes (k=8)", len(targets), time.perf_counter() - start)
+
+print("  contacts: %d in %d buckets" % (len(table), len(table.buckets)))
@@ -0,0 +1,132 @@
+from array import array
+
+#Piece bitfields packed 8 pieces per byte, high bit first: exactly the payload of the wire "bitfield" message (BEP 3),
+#so a peer's bitfield is stored as received and ours is sent as is.
+#whole-field operations (what does this peer have that I lack, how many do I have) go through python's big ints,
+#which do them a machine word at a time instead of one list element at a time.
+
+#set bit positions of every byte value, for walking only the pieces that are set
+BIT_POSITIONS = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+
+class Bitfield:
+    __slots__ = ("length", "bits")
+
+    def __init__(self, length, bits=None):
+        self.length = length
+        size = (length + 7) // 8
+        if bits is None:
+            self.bits = bytearray(size)
+        else:
+            if len(bits) != size:
+                raise ValueError("bitfield must be %d bytes for %d pieces" % (size, length))
+            self.bits = bytearray(bits)
+            if length % 8 and self.bits[-1] & (0xFF >> (length % 8)):
+                raise ValueError("spare bits at the end of a bitfield must be cleared")
+
+    @classmethod
+    def full(cls, length):
+        bitfield = cls(length)
+        bitfield.bits[:] = b'\xff' * len(bitfield.bits)
+        if length % 8:
+            bitfield.bits[-1] = (0xFF << (8 - length % 8)) & 0xFF
+        return bitfield
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError("piece index out of range")
+        return (self.bits[index >> 3] >> (7 - (index & 7))) & 1
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.length:
+            raise IndexError("piece index out of range")
+        if value:
+            self.bits[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self.bits[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.length == other.length and self.bits == other.bits
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def as_int(self):
+        return int.from_bytes(self.bits, "big")
+
+    @classmethod
+    def from_int(cls, length, value):
+        return cls(length, value.to_bytes((length + 7) // 8, "big"))
+
+    def count(self):
+        return self.as_int().bit_count()
+
+    def is_complete(self):
+        return self.count() == self.length
+
+    def any(self):
+        return any(self.bits)
+
+    def __and__(self, other):
+        return Bitfield.from_int(self.length, self.as_int() & other.as_int())
+
+    def __or__(self, other):
+        return Bitfield.from_int(self.length, self.as_int() | other.as_int())
+
+    #pieces set here but not in other, e.g. peer_bitfield - my_bitfield = what the peer can give me
+    def __sub__(self, other):
+        return Bitfield.from_int(self.length, self.as_int() & ~other.as_int())
+
+    #does self have anything other lacks (the "interested" check) without building a new bitfield
+    def has_missing_from(self, other):
+        return bool(self.as_int() & ~other.as_int())
+
+    def set_indices(self):
+        for byte_index, value in enumerate(self.bits):
+            if value:
+                base = byte_index << 3
+                for bit in BIT_POSITIONS[value]:
+                    yield base + bit
+
+
+#lowest piece index >= start whose bit is set in value (an as_int() of a bitfield of length pieces), -1 if none.
+#bit_length finds it a machine word at a time, however sparse the field is
+def first_set_index(value, length, start=0):
+    width = (length + 7) // 8 * 8
+    value &= (1 << (width - start)) - 1
+    if not value:
+        return -1
+    return width - value.bit_length()
+
+
+#how many connected peers have each piece, updated as bitfield / have messages come and peers leave
+class Availability:
+    def __init__(self, total_pieces):
+        self.total_pieces = total_pieces
+        self.counts = array("I", bytes(4 * total_pieces))
+
+    def __getitem__(self, index):
+        return self.counts[index]
+
+    def add_have(self, index):
+        self.counts[index] += 1
+
+    def remove_have(self, index):
+        self.counts[index] -= 1
+
+    def add_bitfield(self, bitfield):
+        counts = self.counts
+        for index in bitfield.set_indices():
+            counts[index] += 1
+
+    def remove_bitfield(self, bitfield):
+        counts = self.counts
+        for index in bitfield.set_indices():
+            counts[index] -= 1
@@ -0,0 +1,22 @@
+#Reusable fixed size bytearrays (piece buffers).
+#a download fills, hashes and writes one piece buffer after the other, taking them from here instead of
+#allocating (and zeroing) a fresh piece_length bytearray for every piece.
+
+
+class BufferPool:
+    def __init__(self, size, max_free=32):
+        self.size = size
+        self.max_free = max_free  # released buffers kept around, the rest are left to the GC
+        self.free = []
+        self.allocated = 0  # buffers ever created, for tests / stats
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    #the buffer may still hold the previous piece, whoever acquires it overwrites what it uses
+    def release(self, buffer):
+        if len(buffer) == self.size and len(self.free) < self.max_free:
+            self.free.append(buffer)
@@ -0,0 +1,89 @@
+import asyncio
+import random
+import time
+
+#Who we upload to (BEP 3 choking, tit-for-tat).
+#
+#every ROUND_INTERVAL the interested peers are ranked: while downloading by how fast they send to us, while
+#seeding by how fast we manage to send to them. the best upload_slots get unchoked, everyone else is choked.
+#one more slot is an optimistic unchoke, rotated every OPTIMISTIC_ROUNDS rounds to a random choked peer (newly
+#connected peers are 3x as likely, they have nothing to offer yet and need a first piece to trade).
+#
+#rates come from the RateMeters every PeerWire keeps and are copied into PeerConnection.download_rate /
+#upload_rate every tick.
+#
+#   choker = Choker(swarm)
+#   swarm.choker = choker
+#   choker.start()
+
+UPLOAD_SLOTS = 4
+ROUND_INTERVAL = 10
+OPTIMISTIC_ROUNDS = 3
+RATE_TICK = 1
+NEW_PEER_AGE = 60  # seconds a peer counts as new for the optimistic unchoke
+
+
+class Choker:
+    def __init__(self, swarm, upload_slots=UPLOAD_SLOTS, round_interval=ROUND_INTERVAL,
+                 optimistic_rounds=OPTIMISTIC_ROUNDS, clock=time.monotonic):
+        self.swarm = swarm
+        self.upload_slots = upload_slots
+        self.round_interval = round_interval
+        self.optimistic_rounds = optimistic_rounds
+        self.clock = clock
+        self.rounds = 0
+        self.optimistic = None  # PeerWire holding the optimistic slot
+        self.task = None
+
+    def start(self):
+        self.task = self.swarm.spawn(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        next_round = self.clock()
+        while True:
+            now = self.clock()
+            self.swarm.update_rates(now)
+            if now >= next_round:
+                self.choke_round(now)
+                next_round = now + self.round_interval
+            await asyncio.sleep(RATE_TICK)
+
+    def choke_round(self, now=None):
+        now = self.clock() if now is None else now
+        seeding = self.swarm.storage.my_bitfield.is_complete()
+        interested = [wire for wire in self.swarm.connections if wire.peer.peer_interested]
+        random.shuffle(interested)  # equal rates (everyone at 0 at first) don't always favour the same peers
+        if seeding:
+            interested.sort(key=lambda wire: wire.peer.upload_rate, reverse=True)
+        else:
+            interested.sort(key=lambda wire: wire.peer.download_rate, reverse=True)
+        unchoked = set(interested[:self.upload_slots])
+
+        rotate = self.rounds % self.optimistic_rounds == 0
+        if rotate or self.optimistic not in interested or self.optimistic in unchoked:
+            self.optimistic = self.pick_optimistic(interested[self.upload_slots:], now)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for wire in list(self.swarm.connections):
+            if wire in unchoked:
+                wire.unchoke()
+            else:
+                wire.choke()
+        self.rounds += 1
+
+    def pick_optimistic(self, candidates, now):
+        if not candidates:
+            return None
+        weights = [3 if now - wire.connected_at < NEW_PEER_AGE else 1 for wire in candidates]
+        return random.choices(candidates, weights)[0]
+
+    #a peer became interested: unchoke it right away if a slot is free instead of making it wait for the round
+    def on_interested(self, wire):
+        unchoked = sum(1 for other in self.swarm.connections if not other.peer.am_choking)
+        if unchoked < self.upload_slots + 1:
+            wire.unchoke()
@@ -0,0 +1,213 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+
+#Which peers of a swarm we are connected to.
+#
+#peers found through the DHT (Node.iterative_get_peers) / trackers / incoming connections are fed to add_peers.
+#the manager keeps one queue of addresses to try, deduplicated against everything it already knows, and dials
+#them while the swarm has fewer than max_connections (and the shared ConnectionBudget, if any, has room).
+#
+#dialing is staggered happy-eyeballs style: a new dial starts every `stagger` seconds while the previous ones are
+#still connecting, or right away when one fails, up to max_dialing at once. a burst of 200 DHT results turns into
+#a steady trickle of connects instead of 200 sockets (and file descriptors) opened in the same millisecond.
+#
+#an address that fails (refused, timed out, bad handshake, dropped quickly) is backed off exponentially:
+#BACKOFF_BASE * 2^failures, up to BACKOFF_MAX, with jitter. after MAX_FAILURES it is forgotten.
+#
+#restart(new_swarm) carries the live connections over to a new Swarm of the same torrent (after a recheck, new
+#storage, ...) instead of closing and dialing them again. closing the old swarm afterwards only stops its timers.
+
+MAX_CONNECTIONS = 50
+MAX_DIALING = 8
+STAGGER = 0.25
+CONNECT_TIMEOUT = 5
+BACKOFF_BASE = 15
+BACKOFF_MAX = 3600
+MAX_FAILURES = 6
+SHORT_CONNECTION = 30  # a connection that dies before this counts as a failure of the address
+IDLE_CHECK = 5  # seconds between looks at the pool when nothing wakes the dialer (incoming peers leaving)
+
+
+#global connection count shared by the managers of many swarms (file descriptors are per process)
+class ConnectionBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def available(self):
+        return self.limit - self.used
+
+    def take(self):
+        self.used += 1
+
+    def give(self):
+        self.used -= 1
+
+
+class Backoff:
+    __slots__ = ("failures", "retry_at")
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+
+
+class ConnectionManager:
+    def __init__(self, swarm, max_connections=MAX_CONNECTIONS, max_dialing=MAX_DIALING, stagger=STAGGER,
+                 connect_timeout=CONNECT_TIMEOUT, budget=None, own_addresses=(), clock=time.monotonic):
+        self.swarm = swarm
+        self.max_connections = max_connections
+        self.max_dialing = max_dialing
+        self.stagger = stagger
+        self.connect_timeout = connect_timeout
+        self.budget = budget
+        self.own_addresses = set(own_addresses)  # our own (ip, port), DHT results often include it
+        self.clock = clock
+        self.candidates = OrderedDict()  # (ip, port) -> None, waiting to be dialed (oldest first)
+        self.backoff = {}  # (ip, port) -> Backoff, addresses that failed
+        self.dialing = set()  # (ip, port) being connected to
+        self.connected = {}  # (ip, port) -> PeerWire we dialed
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.tasks = set()  # dial / connection tasks, owned here so they outlive a swarm restart
+        self.dials = 0  # connection attempts made, for stats / tests
+
+    def start(self):
+        if self.task is None:
+            self.task = self.spawn(self.run())
+
+    def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        self.task = None
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    #queues (ip, port) pairs to dial, already known / connected ones are skipped
+    def add_peers(self, peers):
+        for ip, port in peers:
+            address = (ip, port)
+            if address in self.candidates or address in self.dialing or address in self.connected:
+                continue
+            if address in self.own_addresses:
+                continue
+            backoff = self.backoff.get(address)
+            if backoff is not None and backoff.failures >= MAX_FAILURES:
+                continue
+            self.candidates[address] = None
+        self.wakeup.set()
+
+    def connection_count(self):
+        #a dial whose handshake just finished is already in swarm.connections, don't count it twice
+        live = {(wire.peer.ip, wire.peer.port) for wire in self.swarm.connections}
+        return len(live) + len(self.dialing - live)
+
+    def has_room(self):
+        if self.connection_count() >= self.max_connections:
+            return False
+        return self.budget is None or self.budget.available() > 0
+
+    #next candidate whose backoff has run out, None if there is none yet
+    def next_candidate(self, now):
+        for address in self.candidates:
+            backoff = self.backoff.get(address)
+            if backoff is None or backoff.retry_at <= now:
+                del self.candidates[address]
+                return address
+        return None
+
+    #seconds until the earliest backed off candidate may be tried
+    def next_retry(self, now):
+        waits = [self.backoff[a].retry_at - now for a in self.candidates if a in self.backoff]
+        return max(0, min(waits)) if waits else None
+
+    async def run(self):
+        while True:
+            now = self.clock()
+            address = self.next_candidate(now) if self.has_room() and len(self.dialing) < self.max_dialing else None
+            if address is None:
+                retry = self.next_retry(now)
+                await self.wait(IDLE_CHECK if retry is None else min(retry, IDLE_CHECK))
+                continue
+            self.dialing.add(address)
+            if self.budget is not None:
+                self.budget.take()
+            self.dials += 1
+            self.spawn(self.dial(address))
+            #stagger: next dial after `stagger` seconds, or as soon as any dial finishes
+            await self.wait(self.stagger)
+
+    async def wait(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def dial(self, address):
+        ip, port = address
+        started = self.clock()
+        wire = None
+        try:
+            wire = await self.swarm.connect(ip, port, self.connect_timeout)
+        except (OSError, ConnectionError, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            self.release_budget()  # stopped mid dial, the budget is shared with other torrents
+            raise
+        finally:
+            self.dialing.discard(address)
+        if wire is None:
+            self.failed(address)
+            self.release_budget()
+            return
+        if self.is_duplicate(wire):
+            wire.close("already connected to this peer")  # the address is dropped, not backed off
+            self.release_budget()
+            return
+        self.connected[address] = wire
+        self.backoff.pop(address, None)
+        self.wakeup.set()
+        try:
+            await wire.closed
+        finally:
+            self.connected.pop(address, None)
+            if self.clock() - started < SHORT_CONNECTION:
+                self.failed(address)
+            self.release_budget()
+
+    def release_budget(self):
+        if self.budget is not None:
+            self.budget.give()
+        self.wakeup.set()
+
+    #the same peer (peer_id) reached through another address / an incoming connection
+    def is_duplicate(self, wire):
+        for other in self.swarm.connections:
+            if other is not wire and other.peer.peer_id == wire.peer.peer_id:
+                return True
+        return False
+
+    def failed(self, address):
+        backoff = self.backoff.get(address)
+        if backoff is None:
+            backoff = self.backoff[address] = Backoff()
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** backoff.failures)
+        backoff.failures += 1
+        backoff.retry_at = self.clock() + delay * random.uniform(0.75, 1.25)
+        if backoff.failures < MAX_FAILURES:
+            self.candidates[address] = None
+
+    #moves every live connection to new_swarm (same torrent), the sockets stay open
+    def restart(self, new_swarm):
+        old = self.swarm
+        for wire in list(old.connections):
+            wire.rebind(new_swarm)
+        self.swarm = new_swarm
+        self.wakeup.set()
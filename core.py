@@ -1,8 +1,27 @@
 import time
 import random
-import json
+import os
+import hashlib
+import bisect
+import queue
+import multiprocessing
 import socket
 import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from krpc import get_codec, well_formed_reply
+from peer_store import PeerStore
+from lookup import Lookup
+from piece_verify import PieceVerifier
+from bitfield import Bitfield
+from dht_snapshot import load_snapshot, save_snapshot, SNAPSHOT_INTERVAL
+from metrics import Metrics
+from admission import Admission
+
+BLOCK_SIZE = 16 * 1024  #size of one request/piece message payload
+
 
 #this is going to be a part of every node object (a dictionary of the peer-list peer_id ---> peerconnection)
 class PeerConnection:
@@ -11,7 +30,7 @@ class PeerConnection:
         self.port = port
         self.socket = None
         self.peer_id = None
-        self.peer_bitfield = None
+        self.peer_bitfield = None  #Bitfield (bitfield.py) once the peer sent its bitfield / first have
         self.am_choking = True
         self.am_interested = False
         self.peer_choking = True
@@ -19,6 +38,8 @@ class PeerConnection:
 
         self.download_rate = 0
         self.upload_rate = 0
+        self.downloaded = 0  #payload bytes received / sent so far, kept by the peer wire engine
+        self.uploaded = 0
 
         self.pending_requests = {}  #key-value pairs stored as (piece, block)--->timestamp
         self.last_active = time.time()
@@ -29,74 +50,225 @@ class PeerConnection:
 #2)track partial download progress
 #3)verify downloaded pieces
 class Storage:
-    def __init__(self, total_pieces, piece_length, piece_hashes):
+    def __init__(self, total_pieces, piece_length, piece_hashes, disk=None):
         self.total_pieces = total_pieces
         self.piece_length = piece_length
-        self.piece_hashes = piece_hashes  #[SHA1(piece_0), SHA1(piece_1), ..., SHA1(piece_1023)]
-        self.my_bitfield = [0] * total_pieces
-        self.block_status = {}  # piece_index -> list of block states
+        self.disk = disk  #DiskStorage the blocks are written to (None = only track state)
+        self.piece_hashes = piece_hashes  #[SHA1(piece_0), SHA1(piece_1), ..., SHA1(piece_1023)], a list or PieceHashes
+        self.my_bitfield = Bitfield(total_pieces)  #bit packed, same layout as the wire bitfield message
+        self.block_status = {}  # piece_index -> bytearray of block states (one byte per block)
+        self.blocks_received = array("I", bytes(4 * total_pieces))  # piece_index -> blocks in state 2
         '''
         0 is not rquested, 1 is requested, 2 is recieved
         the information that to whom i have requested the block is stored in PeerConection object
         {
-                5: [2, 2, 1, 0, 0, 0],
-                12: [2, 2, 2, 2, 2, 2]
+                5: bytearray([2, 2, 1, 0, 0, 0]),
+                12: bytearray([2, 2, 2, 2, 2, 2])
         }
         '''
     def initialize_piece(self, piece_index, num_blocks):
-        self.block_status[piece_index] = [0] * num_blocks
+        self.block_status[piece_index] = bytearray(num_blocks)
+        self.blocks_received[piece_index] = 0
+
+    def mark_block_requested(self, piece_index, block_index):
+        if self.block_status[piece_index][block_index] == 0:
+            self.block_status[piece_index][block_index] = 1
 
     def mark_block_received(self, piece_index, block_index):
-        self.block_status[piece_index][block_index] = 2
+        blocks = self.block_status[piece_index]
+        if blocks[block_index] != 2:
+            blocks[block_index] = 2
+            self.blocks_received[piece_index] += 1
+
+    #stores a received block on disk and marks it, returns True once the piece has all its blocks
+    def receive_block(self, piece_index, block_index, data):
+        if self.disk is not None:
+            self.disk.write_block(piece_index, block_index * BLOCK_SIZE, data)
+        self.mark_block_received(piece_index, block_index)
+        return self.is_piece_complete(piece_index)
 
     def is_piece_complete(self, piece_index):
-        return all(b == 2 for b in self.block_status[piece_index])
+        return self.blocks_received[piece_index] == len(self.block_status[piece_index])
+
+    #pieces the peer has that we don't (a Bitfield), empty if it isn't interesting
+    def wanted_from(self, peer_bitfield):
+        return peer_bitfield - self.my_bitfield
+
+    def pieces_completed(self):
+        return self.my_bitfield.count()
+
+    #checks a finished piece against its hash and marks it as owned if it matches
+    def verify_piece(self, piece_index, data):
+        if hashlib.sha1(data).digest() != self.piece_hashes[piece_index]:
+            return False
+        self.my_bitfield[piece_index] = 1
+        return True
+
+    #rebuilds my_bitfield from what is already on disk (files = TorrentFile.file_layout(download_dir))
+    def recheck(self, files, workers=None):
+        verifier = PieceVerifier(self.piece_hashes, workers)
+        try:
+            results = verifier.recheck(files, self.piece_length)
+        finally:
+            verifier.close()
+        self.my_bitfield = Bitfield(self.total_pieces)
+        for piece_index, ok in enumerate(results):
+            if ok:
+                self.my_bitfield[piece_index] = 1
+        return self.my_bitfield.count()
+
+
+PING_RESULT_TIMEOUT = 30  #seconds before a liveness check that never answered can be asked again
+
+
+#one routing table entry. refreshed in place instead of rebuilding a tuple every time the node is seen.
+#still unpacks/indexes like the old (node_id, ip, port, last_seen) tuples
+class Contact:
+    __slots__ = ("node_id", "ip", "port", "last_seen")
+
+    def __init__(self, node_id, ip, port, last_seen=None):
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.time() if last_seen is None else last_seen
+
+    def __iter__(self):
+        return iter((self.node_id, self.ip, self.port, self.last_seen))
+
+    def __getitem__(self, index):
+        return (self.node_id, self.ip, self.port, self.last_seen)[index]
+
+    def __repr__(self):
+        return "Contact(%r, %r, %r, %r)" % (self.node_id, self.ip, self.port, self.last_seen)
 
 
 class KBucket:
-    def __init__(self, k):
+    #a bucket covers the id range [lo, hi), the routing table splits it in half when it fills up
+    #contacts live in insertion ordered dicts (node_id -> Contact), least recently seen first,
+    #so lookup, move-to-tail and evicting the head are all O(1)
+    def __init__(self, k, lo=0, hi=2 ** 160, max_replacements=None):
         self.k = k
-        self.nodes = []  # list of (node_id, ip, port, last_seen)
+        self.lo = lo
+        self.hi = hi
+        self.contacts = OrderedDict()
+        #contacts seen while the bucket was full, newest last. they take the place of nodes that fail a ping
+        self.replacements = OrderedDict()
+        self.max_replacements = max_replacements or k
+        self.pending_ping = None  # (node_id, time asked) of the oldest node while its liveness check is running
+
+    #list of Contacts, least recently seen first
+    @property
+    def nodes(self):
+        return list(self.contacts.values())
+
+    def in_range(self, node_id):
+        return self.lo <= node_id < self.hi
+
+    def is_full(self):
+        return len(self.contacts) >= self.k
 
     def find_node(self, node_id):
-        for node in self.nodes:
-            if node[0] == node_id:
-                return node
-        return None
+        return self.contacts.get(node_id)
 
     def remove_node(self, node_id):
-        self.nodes = [n for n in self.nodes if n[0] != node_id]
+        self.contacts.pop(node_id, None)
+        self.replacements.pop(node_id, None)
 
     def add_node(self, node_info, ping_function):
         """
         node_info = (node_id, ip, port)
-        ping_function(ip, port) should return True if alive
+        ping_function(node_id, ip, port) queues a liveness check of the oldest node and must not block,
+        the answer comes back later through ping_result()
         """
         node_id, ip, port = node_info
-        existing = self.find_node(node_id)
+        existing = self.contacts.get(node_id)
         # Case 1: Node already exists ---> move to end (most recently seen)
-        if existing:
-            self.nodes.remove(existing)
-            self.nodes.append((node_id, ip, port, time.time()))
+        if existing is not None:
+            existing.ip = ip
+            existing.port = port
+            existing.last_seen = time.time()
+            self.contacts.move_to_end(node_id)
             return
 
         # Case 2: Bucket not full
-        if len(self.nodes) < self.k:
-            self.nodes.append((node_id, ip, port, time.time()))
+        if len(self.contacts) < self.k:
+            self.contacts[node_id] = Contact(node_id, ip, port)
             return
 
-        # Case 3: Bucket full ---> ping oldest node
-        oldest = self.nodes[0]
-        oldest_id, oldest_ip, oldest_port, _ = oldest
-
-        if ping_function(oldest_ip, oldest_port):
-            # Old node alive ---> keep it, discard new node
+        # Case 3: Bucket full ---> park the new node in the replacement cache and ask for the oldest node to be pinged
+        self.replacements.pop(node_id, None)
+        self.replacements[node_id] = Contact(node_id, ip, port)
+        if len(self.replacements) > self.max_replacements:
+            self.replacements.popitem(last=False)
+
+        if self.pending_ping and time.time() - self.pending_ping[1] < PING_RESULT_TIMEOUT:
+            return  # a check is already running, its result will make room if the old node is dead
+        oldest = next(iter(self.contacts.values()))
+        self.pending_ping = (oldest.node_id, time.time())
+        ping_function(oldest.node_id, oldest.ip, oldest.port)
+
+    #result of the liveness check started by add_node
+    def ping_result(self, node_id, alive):
+        if self.pending_ping and self.pending_ping[0] == node_id:
+            self.pending_ping = None
+        existing = self.contacts.get(node_id)
+        if existing is None:
             return
+        if alive:
+            # Old node alive ---> keep it (now most recently seen), the new node stays in the cache
+            existing.last_seen = time.time()
+            self.contacts.move_to_end(node_id)
         else:
-            # Old node dead ---> replace it
-            self.nodes.pop(0)
-            self.nodes.append((node_id, ip, port, time.time()))
+            # Old node dead ---> the most recently seen replacement takes its place
+            del self.contacts[node_id]
+            if self.replacements:
+                replacement_id, replacement = self.replacements.popitem(last=True)
+                self.contacts[replacement_id] = replacement
+
+    #splits [lo, hi) into two halves, nodes keep their least-recently-seen order
+    def split(self):
+        mid = (self.lo + self.hi) // 2
+        left = KBucket(self.k, self.lo, mid, self.max_replacements)
+        right = KBucket(self.k, mid, self.hi, self.max_replacements)
+        for node_id, contact in self.contacts.items():
+            (left if node_id < mid else right).contacts[node_id] = contact
+        for node_id, contact in self.replacements.items():
+            (left if node_id < mid else right).replacements[node_id] = contact
+        if self.pending_ping:
+            (left if self.pending_ping[0] < mid else right).pending_ping = self.pending_ping
+        return left, right
+
+
+
+#background liveness checks for full buckets, so a handler calling add_node never waits on a 2s ping timeout
+class Pinger:
+    def __init__(self, ping_node, on_result, workers=4, max_queued=256):
+        self.ping_node = ping_node  # ping_node(ip, port) -> True if alive (blocking)
+        self.on_result = on_result  # on_result(node_id, alive)
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.threads = []
+
+    def schedule(self, node_id, ip, port):
+        if not self.threads:
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        try:
+            self.queue.put_nowait((node_id, ip, port))
+        except queue.Full:
+            #too much churn to keep up, keep the old contact
+            self.on_result(node_id, True)
 
+    def run(self):
+        while True:
+            node_id, ip, port = self.queue.get()
+            try:
+                alive = self.ping_node(ip, port)
+            except Exception:
+                alive = False
+            self.on_result(node_id, alive)
 
 
 class RoutingTable:
@@ -104,46 +276,183 @@ class RoutingTable:
         self.node_id = node_id
         self.k = k
         self.id_bits = id_bits
-        self.buckets = [KBucket(k) for _ in range(id_bits)] #creates 160 buckets, each bucket corresponds to nodes whose XOR distance has highest differing bit at that position.
+        #starts as one bucket covering the whole id space, buckets are split on demand (only the one holding our own id)
+        #buckets are kept sorted by range, bucket_starts[i] == buckets[i].lo so a node's bucket is a bisect away
+        self.buckets = [KBucket(k, 0, 2 ** id_bits)]
+        self.bucket_starts = [0]
+        self.lock = threading.RLock()  #ping results come back on the pinger threads
+
+    def __len__(self):
+        return sum(len(bucket.contacts) for bucket in self.buckets)
 
+    #index into self.buckets of the bucket whose range holds other_id
     def get_bucket_index(self, other_id):
-        distance = self.node_id ^ other_id
-        return distance.bit_length() - 1
+        return bisect.bisect_right(self.bucket_starts, other_id) - 1
+
+    def split_bucket(self, index):
+        left, right = self.buckets[index].split()
+        self.buckets[index:index + 1] = [left, right]
+        self.bucket_starts.insert(index + 1, right.lo)
 
     def add_node(self, node_id, ip, port, ping_function):
-        index = self.get_bucket_index(node_id)
-        if index >= 0:
-            self.buckets[index].add_node((node_id, ip, port), ping_function)
+        if node_id is None or node_id == self.node_id:
+            return
+        with self.lock:
+            index = self.get_bucket_index(node_id)
+            bucket = self.buckets[index]
+            # a full bucket that covers our own id gets split instead of evicting (the far away halves stay at k)
+            while bucket.is_full() and bucket.in_range(self.node_id) and bucket.hi - bucket.lo > 1 \
+                    and bucket.find_node(node_id) is None:
+                self.split_bucket(index)
+                index = self.get_bucket_index(node_id)
+                bucket = self.buckets[index]
+            bucket.add_node((node_id, ip, port), ping_function)
+
+    def ping_result(self, node_id, alive):
+        with self.lock:
+            self.buckets[self.get_bucket_index(node_id)].ping_result(node_id, alive)
+
+    def remove_node(self, node_id):
+        with self.lock:
+            self.buckets[self.get_bucket_index(node_id)].remove_node(node_id)
 
     def get_closest_nodes(self, target_id, k):
-        all_nodes = []
-        for bucket in self.buckets:
-            all_nodes.extend(bucket.nodes)
-        all_nodes.sort(key=lambda node: node[0] ^ target_id)
-        return all_nodes[:k]
+        #buckets are disjoint prefix ranges, so xor distances of two buckets never interleave:
+        #every node in a bucket is closer than every node in a bucket with a bigger "floor" distance
+        #(distance of the range start with the bits inside the bucket cleared).
+        #so only the buckets get ordered, and only the nodes of the buckets we actually need get sorted
+        def floor_distance(bucket):
+            span_bits = (bucket.hi - bucket.lo).bit_length() - 1
+            return ((bucket.lo ^ target_id) >> span_bits) << span_bits
+
+        closest = []
+        with self.lock:
+            for bucket in sorted(self.buckets, key=floor_distance):
+                if not bucket.contacts:
+                    continue
+                closest.extend(sorted(bucket.contacts.values(), key=lambda contact: contact.node_id ^ target_id))
+                if len(closest) >= k:
+                    break
+        return closest[:k]
+
+
+BOOTSTRAP_WORKERS = 32  # pings in flight at once while (re)bootstrapping
 
 
 class Node:
-    def __init__(self, ip, port, bootstrap_nodes=None):
+    def __init__(self, ip, port, bootstrap_nodes=None, codec="json", node_id=None, reuse_port=False,
+                 snapshot_path=None, metrics=None, admission=None):
         self.ip = ip
         self.port = port
-        self.node_id = random.getrandbits(160)
+        #a snapshot from the last run (dht_snapshot.py) gives back our id, contacts to revalidate and announced peers
+        self.snapshot_path = snapshot_path
+        snapshot = load_snapshot(snapshot_path) if snapshot_path else None
+        if node_id is None and snapshot is not None:
+            node_id = snapshot[0]
+        self.node_id = node_id if node_id is not None else random.getrandbits(160)
+        self.snapshot_contacts = snapshot[1] if snapshot else []  # pinged by bootstrap, only live ones are kept
+        self.snapshot_stop = threading.Event()
+        self.codec = get_codec(codec)  #wire format, "json" or "bencode" (see krpc.py)
         #DHT stuff
         self.routing_table = RoutingTable(self.node_id)
-        self.local_storage = {}  # info_hash -> [(ip, port)]
+        self.pinger = Pinger(self.ping_node, self.routing_table.ping_result)
+        self.local_storage = PeerStore()  # info_hash -> announced peers (expiring, bounded, see peer_store.py)
+        if snapshot:
+            self.local_storage.load(snapshot[2])
+        self.max_peers_per_response = 50
         self.bootstrap_nodes = bootstrap_nodes or []
-
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind((self.ip, self.port))
-
-
+        #RPC counters, send_rpc latency, errors (metrics.py). pass one Metrics to export it, else the node keeps its own
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add_collector(self.collect_metrics)
+        #per source limits / cheap rejection of incoming datagrams, see admission.py
+        self.admission = admission if admission is not None else Admission()
+        self.shard = None  # (index, inboxes) when this is one of several SO_REUSEPORT shards, see run_dht_shards
+
+        self.sock = self.open_socket(reuse_port)
+
+    #binds the node's UDP socket (the in-memory simulation in dht_sim.py overrides this and binds nothing)
+    def open_socket(self, reuse_port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            #several processes can bind the same port, the kernel spreads senders over them (see run_dht_shards)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.ip, self.port))
+        self.port = sock.getsockname()[1]  #port 0 means "let the OS pick one"
+        return sock
+
+
+    #pings the seed nodes and the contacts of the last snapshot, all at once instead of one 2s timeout after
+    #another. ping adds whoever answers to the routing table
     def bootstrap(self):
-        for ip, port in self.bootstrap_nodes:
-            response = self.ping(None, ip, port)
-            if response:
-                self.routing_table.add_node(
-                    response["node_id"], ip, port, self.ping_node
-                )
+        targets = self.bootstrap_targets()
+        if not targets:
+            return
+        with ThreadPoolExecutor(max_workers=min(BOOTSTRAP_WORKERS, len(targets))) as pool:
+            list(pool.map(lambda target: self.ping(*target), targets))
+
+    #[(node_id or None, ip, port)] to ping when bootstrapping, the snapshot contacts are only used once
+    def bootstrap_targets(self):
+        targets = [(None, ip, port) for ip, port in self.bootstrap_nodes]
+        targets += self.snapshot_contacts
+        self.snapshot_contacts = []
+        return targets
+
+    #gauges read when the metrics are exported
+    def collect_metrics(self):
+        yield "dht_routing_table_contacts", {}, len(self.routing_table)
+        yield "dht_routing_table_buckets", {}, len(self.routing_table.buckets)
+        yield "dht_peer_store_torrents", {}, len(self.local_storage)
+        yield "dht_peer_store_peers", {}, self.local_storage.peer_count
+
+    #routing table contacts as (node_id, ip, port), closest to our own id first
+    def contacts(self):
+        with self.routing_table.lock:
+            contacts = [
+                (c.node_id, c.ip, c.port) for bucket in self.routing_table.buckets for c in bucket.contacts.values()
+            ]
+        contacts.sort(key=lambda contact: contact[0] ^ self.node_id)
+        return contacts
+
+    def save_snapshot(self, path=None):
+        path = path or self.snapshot_path
+        if path:
+            save_snapshot(path, self.node_id, self.contacts(), self.local_storage.dump())
+
+    #saves the snapshot every interval seconds on a daemon thread, until close()
+    def start_snapshot_timer(self, interval=SNAPSHOT_INTERVAL):
+        def run():
+            while not self.snapshot_stop.wait(interval):
+                try:
+                    self.save_snapshot()
+                except OSError:
+                    pass  # disk trouble: try again next time, the old snapshot is still there
+        threading.Thread(target=run, daemon=True).start()
+
+    #stops the snapshot timer, writes a last snapshot and releases the socket
+    def close(self):
+        self.snapshot_stop.set()
+        try:
+            self.save_snapshot()
+        finally:
+            self.sock.close()
+
+    #ping_function handed to the routing table: a full bucket asks for its oldest node to be checked,
+    #the check runs on the pinger threads and the bucket is updated when the answer arrives
+    def queue_ping(self, node_id, ip, port):
+        self.pinger.schedule(node_id, ip, port)
+
+    #blocking liveness check (True if the node answered)
+    #talks to send_rpc directly so a full bucket can't recurse back into add_node
+    def ping_node(self, ip, port):
+        return self.send_rpc(ip, port, {
+            "type": "ping",
+            "node_id": self.node_id,
+            "port": self.port
+        }) is not None
+
+    #16 bit transaction id, echoed back in the response as "t" so replies can be matched to queries
+    def new_transaction_id(self):
+        return random.getrandbits(16)
 
     #Core RPC function....everyting is built on top of this helper function
     '''
@@ -156,19 +465,43 @@ class Node:
         except:
             return None
     '''
+    #returns the decoded reply, None on timeout / send error / garbage reply (each counted in self.metrics)
     def send_rpc(self, ip, port, message):
+        metrics = self.metrics
+        rpc = message.get("type")
+        metrics.inc("dht_rpc_sent_total", rpc=rpc)
+        started = time.perf_counter()
+        temp_sock = None
         try:
             temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             temp_sock.settimeout(2)
 
-            temp_sock.sendto(json.dumps(message).encode(), (ip, port))
+            message["t"] = self.new_transaction_id()
+            temp_sock.sendto(self.codec.encode(message), (ip, port))
             data, _ = temp_sock.recvfrom(4096)
+        except socket.timeout:
+            metrics.inc("dht_rpc_timeouts_total", rpc=rpc)
+            return None
+        except (OSError, OverflowError, TypeError, ValueError) as error:
+            #unreachable host, out of file descriptors, a contact with a bad ip / port
+            metrics.inc("dht_rpc_errors_total", rpc=rpc, error=type(error).__name__)
+            return None
+        finally:
+            if temp_sock is not None:
+                temp_sock.close()
+        metrics.observe("dht_rpc_latency_seconds", time.perf_counter() - started, rpc=rpc)
 
-            temp_sock.close()
-            return json.loads(data.decode())
-
-        except:
+        try:
+            response = self.codec.decode(data)
+        except ValueError:
+            response = None
+        if not isinstance(response, dict):
+            metrics.inc("dht_parse_errors_total", kind="response")
+            return None
+        if not well_formed_reply(response):
+            metrics.inc("dht_bad_replies_total", rpc=rpc)
             return None
+        return response
 
 
 
@@ -179,8 +512,8 @@ class Node:
             "node_id": self.node_id,
             "port": self.port
         })
-        if response:
-            self.routing_table.add_node(node_id, ip, port, self.ping)
+        if response and "node_id" in response:
+            self.routing_table.add_node(response["node_id"], ip, port, self.queue_ping)
         return response
 
     def find_node(self, node_id, ip, port, target_id):
@@ -192,7 +525,7 @@ class Node:
         })
         if response and "nodes" in response:
             for n_id, n_ip, n_port in response["nodes"]:
-                self.routing_table.add_node(n_id, n_ip, n_port, self.ping)
+                self.routing_table.add_node(n_id, n_ip, n_port, self.queue_ping)
         return response
 
     def get_peers(self, node_id, ip, port, info_hash):
@@ -206,7 +539,7 @@ class Node:
         #so just add them to my routing table
         if response and "nodes" in response:
             for n_id, n_ip, n_port in response["nodes"]:
-                self.routing_table.add_node(n_id, n_ip, n_port, self.ping)
+                self.routing_table.add_node(n_id, n_ip, n_port, self.queue_ping)
         return response
 
     def announce_peer(self, node_id, ip, port, info_hash):
@@ -220,43 +553,45 @@ class Node:
 
 
     #INCOMING RPCs (like server, gives response)
-    def handle_ping(self, sender_node_id, sender_ip, sender_port):
-        self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.ping)
+    #learn=False answers without adding the sender to the routing table (the listener is overloaded)
+    def handle_ping(self, sender_node_id, sender_ip, sender_port, learn=True):
+        if learn:
+            self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.queue_ping)
         return {"node_id": self.node_id}
 
-    def handle_find_node(self, sender_node_id, sender_ip, sender_port, target_id):
-        self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.ping)
+    def handle_find_node(self, sender_node_id, sender_ip, sender_port, target_id, learn=True):
+        if learn:
+            self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.queue_ping)
         closest = self.routing_table.get_closest_nodes(
             target_id, self.routing_table.k
         )
         return {
-            "nodes": [(n[0], n[1], n[2]) for n in closest]
+            "nodes": [(n.node_id, n.ip, n.port) for n in closest]
         }
 
-    def handle_get_peers(self, sender_node_id, sender_ip, sender_port, info_hash):
-        self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.ping)
-        if info_hash in self.local_storage:
-            return {"values": self.local_storage[info_hash]}
+    def handle_get_peers(self, sender_node_id, sender_ip, sender_port, info_hash, learn=True):
+        if learn:
+            self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.queue_ping)
+        peers = self.local_storage.get_peers(info_hash, self.max_peers_per_response)
+        if peers:
+            return {"values": peers}
         else:
             closest = self.routing_table.get_closest_nodes(
                 info_hash, self.routing_table.k
             )
-            return {"nodes": [(n[0], n[1], n[2]) for n in closest]}
+            return {"nodes": [(n.node_id, n.ip, n.port) for n in closest]}
 
 
-    def handle_announce_peer(self, sender_node_id, sender_ip, sender_port, info_hash, peer_port):
-        self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.ping)
+    def handle_announce_peer(self, sender_node_id, sender_ip, sender_port, info_hash, peer_port, learn=True):
+        if learn:
+            self.routing_table.add_node(sender_node_id, sender_ip, sender_port, self.queue_ping)
         closest = self.routing_table.get_closest_nodes(
             info_hash, self.routing_table.k
         )
         my_distance = self.node_id ^ info_hash
-        farthest = max((n[0] ^ info_hash) for n in closest) if closest else float('inf')
+        farthest = max((n.node_id ^ info_hash) for n in closest) if closest else float('inf')
         if my_distance <= farthest:
-            if info_hash not in self.local_storage:
-                self.local_storage[info_hash] = []
-            peer_entry = (sender_ip, peer_port)
-            if peer_entry not in self.local_storage[info_hash]:
-                self.local_storage[info_hash].append(peer_entry)
+            self.local_storage.add_peer(info_hash, sender_ip, peer_port)
         return {"status": "ok"}
 
 
@@ -295,7 +630,84 @@ class Node:
 '''
 
     def handle_incoming(self, data, addr):
-        message = json.loads(data.decode())
+        if not self.admit(data, addr):
+            return
+        self.answer(data, addr)
+
+    #decodes an admitted query and answers it. forwarded = handed over by another shard (see run_dht_shards)
+    def answer(self, data, addr, forwarded=False):
+        try:
+            message = self.codec.decode(data)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            self.metrics.inc("dht_parse_errors_total", kind="query")
+            return
+        if self.shard is not None and not forwarded and self.forward(message, data, addr):
+            return
+        try:
+            response = self.dispatch(message, addr, self.may_learn())
+        except (KeyError, TypeError, ValueError, AttributeError):
+            #a query without its arguments (target_id, info_hash, port) or with the wrong types in them
+            self.metrics.inc("dht_query_errors_total", rpc=str(message.get("type")))
+            return
+        if response is None:
+            return
+        self.sock.sendto(self.codec.encode(response), addr)
+
+    #get_peers / announce_peer belong to the shard that owns the info_hash (info_hash % shards), so every
+    #announce and every lookup of one torrent meet in the same PeerStore, whichever shard the kernel picked.
+    #True if the query was handed to its owner
+    def forward(self, message, data, addr):
+        index, inboxes = self.shard
+        info_hash = message.get("info_hash")
+        if message.get("type") not in ("get_peers", "announce_peer") or type(info_hash) is not int:
+            return False
+        owner = info_hash % len(inboxes)
+        if owner == index:
+            return False
+        inboxes[owner].put((data, addr))
+        self.metrics.inc("dht_shard_forwarded_total")
+        return True
+
+    #answers what the other shards forward to us, from our socket on the shared port
+    def serve_forwarded(self, inbox):
+        def drain():
+            while True:
+                data, addr = inbox.get()
+                try:
+                    self.answer(data, addr, forwarded=True)
+                except Exception as error:
+                    self.listener_error(error)
+
+        threading.Thread(target=drain, daemon=True, name="dht-shard-inbox").start()
+
+    #admission control before anything is decoded, False = dropped (counted by reason)
+    def admit(self, data, addr):
+        verdict = self.admission.admit(data, addr[0], self.codec)
+        if verdict is None:
+            return True
+        self.metrics.inc("dht_dropped_total", reason=verdict)
+        return False
+
+    #the same for a reply, which must carry the transaction id of a query in pending
+    def admit_reply(self, data, addr, pending):
+        verdict = self.admission.admit_reply(data, addr[0], self.codec, pending)
+        if verdict is None:
+            return True
+        self.metrics.inc("dht_dropped_total", reason=verdict)
+        return False
+
+    #False while overloaded: queries are still answered, their senders aren't inserted
+    def may_learn(self):
+        if self.admission.allow_insert():
+            return True
+        self.metrics.inc("dht_inserts_skipped_total")
+        return False
+
+    #runs the matching handle_* for a decoded query and returns the response dict (None if it isn't a query)
+    #shared by the threaded listener and the asyncio node in async_dht.py
+    def dispatch(self, message, addr, learn=True):
         #sender_ip, sender_port = addr
         sender_ip = addr[0]
         sender_port = message.get("port")
@@ -303,33 +715,38 @@ class Node:
 
         msg_type = message.get("type")
         if not msg_type:
-            return
+            return None
 
         if msg_type == "ping":
-            response = self.handle_ping(sender_node_id, sender_ip, sender_port)
+            response = self.handle_ping(sender_node_id, sender_ip, sender_port, learn)
 
         elif msg_type == "find_node":
             response = self.handle_find_node(
                 sender_node_id, sender_ip, sender_port,
-                message["target_id"]
+                message["target_id"], learn
             )
 
         elif msg_type == "get_peers":
             response = self.handle_get_peers(
                 sender_node_id, sender_ip, sender_port,
-                message["info_hash"]
+                message["info_hash"], learn
             )
 
         elif msg_type == "announce_peer":
             response = self.handle_announce_peer(
                 sender_node_id, sender_ip, sender_port,
                 message["info_hash"],
-                message["port"]
+                message["port"], learn
             )
         else:
-            return
+            self.metrics.inc("dht_queries_unknown_total")
+            return None
 
-        self.sock.sendto(json.dumps(response).encode(), addr)
+        self.metrics.inc("dht_queries_received_total", rpc=msg_type)
+        response["node_id"] = self.node_id
+        if "t" in message:
+            response["t"] = message["t"]
+        return response
 
     '''      
     def start_dht_listener(self):
@@ -342,66 +759,141 @@ class Node:
         thread.start()
     '''
     
-    def start_dht_listener(self):
-        def listen():
+    #workers=1 keeps the single listener thread.
+    #workers>1: one thread drains the socket in batches and a pool of workers runs handle_incoming,
+    #routing table and local_storage lock themselves so the workers can share them
+    #profiler: a metrics.SamplingProfiler that gets to watch the listener threads
+    #anything unexpected is counted as dht_listener_errors_total and the thread keeps serving
+    def start_dht_listener(self, workers=1, batch_size=64, profiler=None):
+        threads = []
+        if workers <= 1:
+            def listen():
+                while True:
+                    try:
+                        data, addr = self.sock.recvfrom(4096)
+                        self.handle_incoming(data, addr)
+                    except socket.timeout:
+                        continue
+                    except Exception as error:
+                        self.listener_error(error)
+
+            threads.append(threading.Thread(target=listen, daemon=True, name="dht-listener"))
+            self.start_listener_threads(threads, profiler)
+            return
+
+        #bounded, so when the workers fall behind the backlog stays in the kernel socket buffer
+        batches = queue.Queue(maxsize=workers * 4)
+
+        def receive():
             while True:
                 try:
-                    data, addr = self.sock.recvfrom(4096)
-                    self.handle_incoming(data, addr)
+                    batch = self.receive_batch(batch_size)
+                    #a full batch means more is waiting in the socket buffer, a full queue that the workers lag:
+                    #either way answer first and stop inserting senders until it clears
+                    self.admission.backlogged = len(batch) == batch_size or batches.full()
+                    batches.put(batch)
                 except socket.timeout:
                     continue
-                except Exception:
-                    continue
-
-        thread = threading.Thread(target=listen, daemon=True)
-        thread.start()
+                except Exception as error:
+                    self.listener_error(error)
 
-
-    #Iterative lookup, alpha decides the breadth
-    def iterative_find_node(self, target_id, alpha=3):
-        queried = set()
-        closest = self.routing_table.get_closest_nodes(target_id, self.routing_table.k)
-        while True:
-            new_nodes = []
-            to_query = [n for n in closest if n[0] not in queried][:alpha]
-            if not to_query:
-                break
-            for node_id, ip, port, *_ in to_query:
-                queried.add(node_id)
-                response = self.find_node(node_id, ip, port, target_id)
-                if response and "nodes" in response:
-                    new_nodes.extend(response["nodes"])
-
-            for n_id, n_ip, n_port in new_nodes:
-                self.routing_table.add_node(n_id, n_ip, n_port, self.ping)
-            updated = self.routing_table.get_closest_nodes(target_id, self.routing_table.k)
-            if updated == closest:
+        def work():
+            while True:
+                for data, addr in batches.get():
+                    try:
+                        self.handle_incoming(data, addr)
+                    except Exception as error:
+                        self.listener_error(error)
+
+        threads.append(threading.Thread(target=receive, daemon=True, name="dht-receiver"))
+        for index in range(workers):
+            threads.append(threading.Thread(target=work, daemon=True, name="dht-worker-%d" % index))
+        self.start_listener_threads(threads, profiler)
+
+    def start_listener_threads(self, threads, profiler):
+        for thread in threads:
+            thread.start()
+            if profiler is not None:
+                profiler.watch(thread)
+        if profiler is not None:
+            profiler.start()
+
+    def listener_error(self, error):
+        self.metrics.inc("dht_listener_errors_total", error=type(error).__name__)
+
+    #waits for one datagram, then takes whatever else is already queued on the socket (up to batch_size)
+    def receive_batch(self, batch_size):
+        batch = [self.sock.recvfrom(4096)]
+        while len(batch) < batch_size:
+            try:
+                batch.append(self.sock.recvfrom(4096, socket.MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
                 break
-            closest = updated
-        return closest
+        return batch
 
-    def iterative_get_peers(self, info_hash, alpha=3):
-        queried = set()
-        closest = self.routing_table.get_closest_nodes(info_hash, self.routing_table.k)
-        found_peers = []
-        while True:
-            to_query = [n for n in closest if n[0] not in queried][:alpha]
-            if not to_query:
-                break
 
-            for node_id, ip, port, *_ in to_query:
-                queried.add(node_id)
-                response = self.get_peers(node_id, ip, port, info_hash)
-                if not response:
-                    continue
-                if "values" in response:
-                    found_peers.extend(response["values"])
-                if "nodes" in response:
-                    for n_id, n_ip, n_port in response["nodes"]:
-                        self.routing_table.add_node(n_id, n_ip, n_port, self.ping)
-
-            updated = self.routing_table.get_closest_nodes(info_hash, self.routing_table.k)
-            if updated == closest:
-                break
-            closest = updated
-        return found_peers
\ No newline at end of file
+    #Iterative lookup, alpha decides the breadth (queries kept in flight at once, per path)
+    #the lookup keeps its own shortlist (lookup.py), the routing table is only read once for the seeds
+    def run_lookup(self, lookup, rpc):
+        pool = ThreadPoolExecutor(max_workers=lookup.alpha * len(lookup.paths))
+        in_flight = {}
+        try:
+            while True:
+                for path, candidate in lookup.next_queries():
+                    in_flight[pool.submit(rpc, candidate)] = (path, candidate)
+                if lookup.done or not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path, candidate = in_flight.pop(future)
+                    lookup.on_response(path, candidate, future.result())
+        finally:
+            #don't wait for the stragglers of a finished lookup, their replies are dropped
+            pool.shutdown(wait=False, cancel_futures=True)
+        return lookup
+
+    def new_lookup(self, target_id, alpha, paths, want_peers=None):
+        k = self.routing_table.k
+        seeds = self.routing_table.get_closest_nodes(target_id, k * paths)
+        return Lookup(target_id, seeds, k, alpha, want_peers, paths, own_id=self.node_id)
+
+    def iterative_find_node(self, target_id, alpha=3, paths=1):
+        lookup = self.new_lookup(target_id, alpha, paths)
+        self.run_lookup(lookup, lambda c: self.find_node(c.node_id, c.ip, c.port, target_id))
+        return lookup.closest_nodes()
+
+    #stops as soon as want_peers peers are known (None = walk until the closest nodes have all answered)
+    def iterative_get_peers(self, info_hash, alpha=3, want_peers=50, paths=1):
+        lookup = self.new_lookup(info_hash, alpha, paths, want_peers)
+        self.run_lookup(lookup, lambda c: self.get_peers(c.node_id, c.ip, c.port, info_hash))
+        return lookup.found_peers
+
+
+#runs one Node process per core on the same port with SO_REUSEPORT.
+#the kernel spreads senders over the processes by their address and port, and a client that opens a new socket
+#per query (Node.send_rpc does) lands on a different shard each time. every shard answers with the same node id
+#and keeps its own routing table, but get_peers / announce_peer are forwarded to the shard owning the info_hash
+#(Node.forward) through a multiprocessing.Queue per shard, so an announce is always found again
+def run_dht_shards(ip, port, processes=None, workers=1, bootstrap_nodes=None, node_id=None):
+    node_id = node_id if node_id is not None else random.getrandbits(160)
+    count = processes or os.cpu_count() or 1
+    inboxes = [multiprocessing.Queue() for _ in range(count)]
+    shards = []
+    for index in range(count):
+        shard = multiprocessing.Process(
+            target=serve_dht_shard, args=(ip, port, workers, bootstrap_nodes, node_id, index, inboxes), daemon=True
+        )
+        shard.start()
+        shards.append(shard)
+    return shards
+
+
+def serve_dht_shard(ip, port, workers, bootstrap_nodes, node_id, index=0, inboxes=None):
+    node = Node(ip, port, bootstrap_nodes, node_id=node_id, reuse_port=True)
+    if inboxes and len(inboxes) > 1:
+        node.shard = (index, inboxes)
+        node.serve_forwarded(inboxes[index])
+    node.start_dht_listener(workers)
+    node.bootstrap()
+    while True:
+        time.sleep(3600)
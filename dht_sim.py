@@ -0,0 +1,284 @@
+import heapq
+import itertools
+import random
+import sys
+
+from core import Node
+
+#In-memory DHT simulation: thousands of real Node objects (routing tables, KBuckets, Lookup state machine, query
+#handlers) in one process, talking through a simulated network instead of UDP sockets.
+#
+#time is virtual: every message is an event on a heap, delivered after a random one-way latency, dropped with
+#probability `loss`, or never answered when the receiver is dead. a 2000 node network runs in seconds and
+#the same seed always gives the same numbers, so two versions of the DHT code can be compared run against run.
+#
+#   network = SimNetwork(latency=(0.02, 0.2), loss=0.01, seed=1)
+#   network.build(1000)                         each node joins through a random live node + a lookup of its own id
+#   network.churn(0.1)                          10% of the nodes leave, as many new ones join
+#   stats = network.run_lookups(200, alpha=3)   random find_node lookups from random live nodes
+#   print(format_stats(stats))
+#
+#queries go straight to Node.dispatch as dicts (no encoding), replies are applied the way Node.find_node does it
+#(responder and returned nodes go into the querier's routing table) and fed to the Lookup.
+
+RPC_TIMEOUT = 2.0
+PORT = 6881
+JOIN_ATTEMPTS = 3
+
+
+class SimNode(Node):
+    def __init__(self, network, ip, node_id=None):
+        self.network = network
+        super().__init__(ip, PORT, node_id=node_id)
+
+    #no socket, the network delivers messages by calling dispatch
+    def open_socket(self, reuse_port):
+        return None
+
+    #full buckets check their oldest node through the simulated network
+    def queue_ping(self, node_id, ip, port):
+        def on_reply(reply):
+            self.routing_table.ping_result(node_id, reply is not None)
+        self.network.query(self, (ip, port), {"type": "ping", "node_id": self.node_id, "port": self.port}, on_reply)
+
+
+class LookupRun:
+    def __init__(self, node, lookup, started, on_done):
+        self.node = node
+        self.lookup = lookup
+        self.started = started
+        self.on_done = on_done
+        self.in_flight = 0
+        self.hops = {}  # node_id -> hops from the lookup's seeds (seeds are hop 1)
+        self.finished = False
+        self.best = None  # closest live node to the target, to check the result against
+
+
+class SimNetwork:
+    def __init__(self, latency=(0.01, 0.1), loss=0.0, seed=None, rpc_timeout=RPC_TIMEOUT):
+        self.latency = latency  # (min, max) seconds one way
+        self.loss = loss  # probability a single datagram is lost
+        self.rpc_timeout = rpc_timeout
+        self.random = random.Random(seed)
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+        self.nodes = {}  # (ip, port) -> SimNode
+        self.alive = []  # live SimNodes
+        self.alive_ids = set()
+        self.next_ip = itertools.count(1)
+        self.messages = 0
+        self.timeouts = 0
+
+    # ---------------------------------------------------
+    # event loop
+    # ---------------------------------------------------
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.seq), callback, args))
+
+    def run(self):
+        while self.events:
+            self.now, _, callback, args = heapq.heappop(self.events)
+            callback(*args)
+
+    def one_way(self):
+        return self.random.uniform(*self.latency)
+
+    def lost(self):
+        return self.loss and self.random.random() < self.loss
+
+    #sends a query, on_reply(reply dict or None on timeout) is called exactly once
+    def query(self, sender, address, message, on_reply):
+        self.messages += 1
+        state = {"answered": False}
+
+        def reply(response):
+            if not state["answered"]:
+                state["answered"] = True
+                on_reply(response)
+
+        def timeout():
+            if not state["answered"]:
+                self.timeouts += 1
+                reply(None)
+
+        def deliver():
+            receiver = self.nodes.get(address)
+            if receiver is None or receiver.node_id not in self.alive_ids:
+                return
+            response = receiver.dispatch(dict(message), (sender.ip, sender.port))
+            if response is not None and not self.lost():
+                self.schedule(self.one_way(), reply, response)
+
+        if not self.lost():
+            self.schedule(self.one_way(), deliver)
+        self.schedule(self.rpc_timeout, timeout)
+
+    # ---------------------------------------------------
+    # membership
+    # ---------------------------------------------------
+
+    def new_ip(self):
+        n = next(self.next_ip)
+        return "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255)
+
+    def add_node(self):
+        node = SimNode(self, self.new_ip(), node_id=self.random.getrandbits(160))
+        self.nodes[(node.ip, node.port)] = node
+        self.alive.append(node)
+        self.alive_ids.add(node.node_id)
+        return node
+
+    #a new node pings a random live node, then looks up its own id (fills its table, announces it to others).
+    #an unanswered ping is retried through another node, like a client going down its bootstrap list
+    def join(self, node, attempts=JOIN_ATTEMPTS):
+        others = [n for n in self.random.sample(self.alive, min(2, len(self.alive))) if n is not node]
+        if not others:
+            return
+        seed = others[0]
+
+        def on_pong(reply):
+            if reply is not None:
+                node.routing_table.add_node(reply["node_id"], seed.ip, seed.port, node.queue_ping)
+                self.start_lookup(node, node.node_id, alpha=3, paths=1)
+            elif attempts > 1:
+                self.join(node, attempts - 1)
+
+        self.query(node, (seed.ip, seed.port), {"type": "ping", "node_id": node.node_id, "port": node.port}, on_pong)
+
+    #n nodes, joining in batches so early nodes see later ones
+    def build(self, n, batch=50):
+        while len(self.alive) < n:
+            for _ in range(min(batch, n - len(self.alive))):
+                self.join(self.add_node())
+            self.run()
+
+    def kill(self, node):
+        self.alive_ids.discard(node.node_id)
+        self.alive.remove(node)
+
+    #fraction of the nodes leave without a word, as many fresh nodes join
+    def churn(self, fraction):
+        count = int(len(self.alive) * fraction)
+        for node in self.random.sample(self.alive, count):
+            self.kill(node)
+        for _ in range(count):
+            self.join(self.add_node())
+        self.run()
+
+    # ---------------------------------------------------
+    # lookups
+    # ---------------------------------------------------
+
+    def start_lookup(self, node, target, alpha=3, paths=1, on_done=None, best=None):
+        lookup = node.new_lookup(target, alpha, paths)
+        run = LookupRun(node, lookup, self.now, on_done)
+        run.best = best
+        for path in lookup.paths:
+            for node_id in path.candidates:
+                run.hops[node_id] = 1
+        self.pump(run)
+        return run
+
+    def pump(self, run):
+        lookup = run.lookup
+        node = run.node
+        for path, candidate in lookup.next_queries():
+            run.in_flight += 1
+            message = {"type": "find_node", "node_id": node.node_id, "target_id": lookup.target_id, "port": node.port}
+            self.query(node, (candidate.ip, candidate.port), message,
+                       lambda reply, path=path, candidate=candidate: self.on_reply(run, path, candidate, reply))
+        #done once the lookup says so, queries still out (to dead nodes) don't count against its latency
+        if not run.finished and (lookup.done or run.in_flight == 0):
+            run.finished = True
+            if run.on_done:
+                run.on_done(run)
+
+    def on_reply(self, run, path, candidate, reply):
+        run.in_flight -= 1
+        node = run.node
+        if reply is not None:
+            #what Node.find_node does with an answer
+            node.routing_table.add_node(reply.get("node_id"), candidate.ip, candidate.port, node.queue_ping)
+            hop = run.hops.get(candidate.node_id, 1) + 1
+            for n_id, n_ip, n_port in reply.get("nodes", ()):
+                node.routing_table.add_node(n_id, n_ip, n_port, node.queue_ping)
+                run.hops.setdefault(n_id, hop)
+        if run.finished:
+            return  # a straggler, the result is already taken
+        run.lookup.on_response(path, candidate, reply)
+        self.pump(run)
+
+    def closest_alive(self, target):
+        return min(self.alive_ids, key=lambda node_id: node_id ^ target)
+
+    #count lookups for random targets from random live nodes, all running at the same time
+    def run_lookups(self, count, alpha=3, paths=1):
+        results = []
+        messages_before, timeouts_before = self.messages, self.timeouts
+
+        def on_done(run):
+            closest = run.lookup.closest_nodes()
+            found = closest[0][0] if closest else None
+            results.append({
+                "latency": self.now - run.started,
+                "messages": run.lookup.messages,
+                "hops": run.hops.get(found, 0),
+                "found": found == run.best,
+            })
+
+        for _ in range(count):
+            node = self.random.choice(self.alive)
+            target = self.random.getrandbits(160)
+            self.start_lookup(node, target, alpha, paths, on_done, best=self.closest_alive(target))
+        self.run()
+        return {
+            "lookups": len(results),
+            "found": sum(r["found"] for r in results) / max(1, len(results)),
+            "hops": sorted(r["hops"] for r in results),
+            "latency": sorted(r["latency"] for r in results),
+            "messages": sorted(r["messages"] for r in results),
+            "timeouts": self.timeouts - timeouts_before,
+            "sent": self.messages - messages_before,
+            "table_bytes": self.routing_table_bytes(),
+            "table_contacts": sum(len(n.routing_table) for n in self.alive) / max(1, len(self.alive)),
+        }
+
+    #average bytes held by one routing table (buckets, contact dicts, contacts, their ids / ips)
+    def routing_table_bytes(self):
+        total = 0
+        for node in self.alive:
+            table = node.routing_table
+            total += sys.getsizeof(table.buckets) + sys.getsizeof(table.bucket_starts)
+            for bucket in table.buckets:
+                total += sys.getsizeof(bucket) + sys.getsizeof(bucket.__dict__)
+                for contacts in (bucket.contacts, bucket.replacements):
+                    total += sys.getsizeof(contacts)
+                    for contact in contacts.values():
+                        total += sys.getsizeof(contact) + sys.getsizeof(contact.node_id) + sys.getsizeof(contact.ip)
+        return total / max(1, len(self.alive))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def format_stats(stats):
+    lines = [
+        "lookups           %d (closest live node found: %.1f%%)" % (stats["lookups"], 100 * stats["found"]),
+        "hops              mean %.2f  p50 %d  p95 %d  max %d" % (
+            sum(stats["hops"]) / max(1, len(stats["hops"])), percentile(stats["hops"], 50),
+            percentile(stats["hops"], 95), stats["hops"][-1] if stats["hops"] else 0),
+        "latency (s)       p50 %.3f  p90 %.3f  p99 %.3f" % (
+            percentile(stats["latency"], 50), percentile(stats["latency"], 90), percentile(stats["latency"], 99)),
+        "messages/lookup   mean %.1f  p50 %d  p95 %d" % (
+            sum(stats["messages"]) / max(1, len(stats["messages"])), percentile(stats["messages"], 50),
+            percentile(stats["messages"], 95)),
+        "timeouts          %d of %d queries sent (incl. pings)" % (stats["timeouts"], stats["sent"]),
+        "routing table     %.0f contacts, %.1f KiB per node" % (stats["table_contacts"], stats["table_bytes"] / 1024),
+    ]
+    return "\n".join(lines)
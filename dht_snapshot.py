@@ -0,0 +1,73 @@
+import os
+import struct
+import time
+
+from krpc import id_to_bytes, id_from_bytes, encode_nodes, decode_nodes, COMPACT_PEER_LENGTH
+from read_torrent import bdecode, bencode_to
+
+#On-disk snapshot of a DHT node, so a restart (deploy) doesn't begin with an empty routing table.
+#
+#one bencoded dict, everything in the compact BEP 5 forms:
+#   version  SNAPSHOT_VERSION
+#   id       our 20 byte node id (a new id would make every contact's routing table entry for us useless)
+#   saved    unix time of the snapshot
+#   nodes    26 byte compact node infos of the routing table contacts, closest buckets first
+#   peers    {20 byte info_hash: 10 bytes per peer = 6 byte compact peer + 4 byte expiry (unix time)}
+#
+#written to a temp file and renamed over the old one, a crash mid-write leaves the previous snapshot intact.
+#the contacts are not trusted on load: the node pings them all at once (Node.bootstrap) and only the ones
+#that answer go back into the routing table.
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 300  # seconds between periodic saves
+MAX_AGE = 24 * 3600  # older snapshots only give back the node id, their contacts are mostly gone
+EXPIRY = struct.Struct(">I")
+PEER_ENTRY_LENGTH = COMPACT_PEER_LENGTH + EXPIRY.size
+
+
+def build_snapshot(node_id, contacts, peer_entries):
+    peers = {}
+    for info_hash, compact, expires in peer_entries:
+        peers.setdefault(id_to_bytes(info_hash), []).append(compact + EXPIRY.pack(int(expires)))
+    return {
+        "version": SNAPSHOT_VERSION,
+        "id": id_to_bytes(node_id),
+        "saved": int(time.time()),
+        "nodes": encode_nodes(contacts),
+        "peers": {info_hash: b''.join(entries) for info_hash, entries in peers.items()},
+    }
+
+
+def save_snapshot(path, node_id, contacts, peer_entries):
+    snapshot = build_snapshot(node_id, contacts, peer_entries)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        bencode_to(snapshot, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
+
+
+#(node_id, [(id, ip, port)], [(info_hash, compact peer, expiry)]), None if there is no usable snapshot
+def load_snapshot(path, max_age=MAX_AGE):
+    try:
+        with open(path, "rb") as fp:
+            snapshot = bdecode(fp.read())
+        if snapshot[b"version"] != SNAPSHOT_VERSION:
+            return None
+        node_id = id_from_bytes(snapshot[b"id"])
+        if time.time() - snapshot[b"saved"] > max_age:
+            return node_id, [], []
+        contacts = decode_nodes(snapshot[b"nodes"])
+        peer_entries = []
+        for info_hash, blob in snapshot[b"peers"].items():
+            info_hash = id_from_bytes(info_hash)
+            if len(blob) % PEER_ENTRY_LENGTH:
+                raise ValueError("bad peer list in snapshot")
+            for i in range(0, len(blob), PEER_ENTRY_LENGTH):
+                compact = bytes(blob[i:i + COMPACT_PEER_LENGTH])
+                expires = EXPIRY.unpack_from(blob, i + COMPACT_PEER_LENGTH)[0]
+                peer_entries.append((info_hash, compact, expires))
+        return node_id, contacts, peer_entries
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        return None  # missing / unreadable / corrupt: start cold
@@ -0,0 +1,197 @@
+import bisect
+import os
+import threading
+
+#Disk backend for Storage.
+#the torrent is one long byte range laid over its files (TorrentFile.file_layout order). a block at
+#(piece, offset) maps to one or more (file, file offset) spans through a bisect on the file start offsets.
+#
+#writes: received blocks are only kept (by reference, no copy) until flush_size bytes are pending, then
+#neighbouring blocks are written with one pwritev per file run -> a few big writes instead of one per 16 KiB block.
+#reads: preadv straight into the caller's buffer, or sendfile from the file to a socket for uploads.
+
+FLUSH_SIZE = 4 * 1024 * 1024
+IOV_MAX = 1024
+
+
+class DiskStorage:
+    def __init__(self, files, piece_length, flush_size=FLUSH_SIZE):
+        self.files = list(files)  # [(path, length)]
+        self.piece_length = piece_length
+        self.flush_size = flush_size
+        self.starts = []  # absolute offset where each file begins
+        offset = 0
+        for _, length in self.files:
+            self.starts.append(offset)
+            offset += length
+        self.total_length = offset
+        self.fds = {}  # file index -> fd, opened on first use
+        self.pending = {}  # absolute offset -> block waiting to be written
+        self.pending_bytes = 0
+        self.lock = threading.RLock()
+        self.allocate()
+
+    #creates every file at its full (sparse) size, empty files included
+    def allocate(self):
+        for file_index in range(len(self.files)):
+            self.fd(file_index)
+
+    def fd(self, file_index):
+        fd = self.fds.get(file_index)
+        if fd is None:
+            path, length = self.files[file_index]
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size < length:
+                os.ftruncate(fd, length)  # sparse, no bytes written yet
+            self.fds[file_index] = fd
+        return fd
+
+    #[(file_index, offset in file, length)] covering [offset, offset + length)
+    def spans(self, offset, length):
+        if offset < 0 or offset + length > self.total_length:
+            raise ValueError("range outside the torrent")
+        result = []
+        file_index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0:
+            file_start = self.starts[file_index]
+            file_length = self.files[file_index][1]
+            in_file = min(length, file_start + file_length - offset)
+            if in_file > 0:
+                result.append((file_index, offset - file_start, in_file))
+                offset += in_file
+                length -= in_file
+            file_index += 1
+        return result
+
+    def piece_offset(self, piece_index, block_offset=0):
+        return piece_index * self.piece_length + block_offset
+
+    #data is kept by reference until the next flush, don't reuse its buffer before that
+    def write_block(self, piece_index, block_offset, data):
+        offset = self.piece_offset(piece_index, block_offset)
+        length = memoryview(data).nbytes
+        if offset + length > self.total_length:
+            raise ValueError("block outside the torrent")
+        with self.lock:
+            previous = self.pending.get(offset)
+            if previous is not None:
+                self.pending_bytes -= memoryview(previous).nbytes
+            self.pending[offset] = data
+            self.pending_bytes += length
+            if self.pending_bytes >= self.flush_size:
+                self.flush()
+
+    #writes right away instead of queueing, data can be reused as soon as this returns (pooled piece buffers)
+    def write_now(self, piece_index, block_offset, data):
+        offset = self.piece_offset(piece_index, block_offset)
+        view = memoryview(data).cast("B")
+        if offset + len(view) > self.total_length:
+            raise ValueError("block outside the torrent")
+        with self.lock:
+            self.write_run(offset, [view])
+
+    #writes everything pending, adjacent blocks are merged into one pwritev
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            run_start = None
+            run = []
+            run_end = None
+            for offset in sorted(self.pending):
+                view = memoryview(self.pending[offset]).cast("B")
+                if run and offset == run_end:
+                    run.append(view)
+                    run_end += len(view)
+                    continue
+                if run:
+                    self.write_run(run_start, run)
+                run_start, run, run_end = offset, [view], offset + len(view)
+            if run:
+                self.write_run(run_start, run)
+            self.pending.clear()
+            self.pending_bytes = 0
+
+    #buffers are contiguous from offset on, they are split where the files change
+    def write_run(self, offset, buffers):
+        length = sum(len(b) for b in buffers)
+        queue = list(buffers)
+        for file_index, file_offset, span_length in self.spans(offset, length):
+            iov = []
+            taken = 0
+            while taken < span_length:
+                buffer = queue.pop(0)
+                need = span_length - taken
+                if len(buffer) > need:
+                    queue.insert(0, buffer[need:])
+                    buffer = buffer[:need]
+                iov.append(buffer)
+                taken += len(buffer)
+            self.pwritev(self.fd(file_index), iov, file_offset)
+
+    def pwritev(self, fd, iov, offset):
+        while iov:
+            chunk = iov[:IOV_MAX]
+            written = os.pwritev(fd, chunk, offset)
+            offset += written
+            #short write: drop what went out and go again with the rest
+            while chunk and written >= len(chunk[0]):
+                written -= len(chunk[0])
+                chunk.pop(0)
+                iov.pop(0)
+            if written:
+                iov[0] = iov[0][written:]
+
+    #reads [offset, offset + length) into buffer (bytearray / writable memoryview), returns a view of it
+    def read_into(self, offset, buffer):
+        view = memoryview(buffer).cast("B")
+        self.flush()
+        filled = 0
+        for file_index, file_offset, span_length in self.spans(offset, len(view)):
+            target = view[filled:filled + span_length]
+            done = 0
+            while done < span_length:
+                n = os.preadv(self.fd(file_index), [target[done:]], file_offset + done)
+                if n == 0:
+                    break  # past the end of a short file, stays zero
+                done += n
+            filled += span_length
+        return view
+
+    def read_block(self, piece_index, block_offset, length, buffer=None):
+        if buffer is None:
+            buffer = bytearray(length)
+        return self.read_into(self.piece_offset(piece_index, block_offset), memoryview(buffer)[:length])
+
+    def read_piece(self, piece_index, buffer=None):
+        start = self.piece_offset(piece_index)
+        length = min(self.piece_length, self.total_length - start)
+        return self.read_block(piece_index, 0, length, buffer)
+
+    #uploads a block to a socket with sendfile, the data never comes up into python.
+    #a non-blocking socket takes what fits in its send buffer: the number of bytes sent is returned
+    def send_block(self, sock, piece_index, block_offset, length):
+        self.flush()
+        sent = 0
+        for file_index, file_offset, span_length in self.spans(self.piece_offset(piece_index, block_offset), length):
+            done = 0
+            while done < span_length:
+                try:
+                    n = os.sendfile(sock.fileno(), self.fd(file_index), file_offset + done, span_length - done)
+                except BlockingIOError:
+                    return sent + done
+                if n == 0:
+                    raise OSError("short file while sending block")
+                done += n
+            sent += done
+        return sent
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
@@ -0,0 +1,253 @@
+import json
+import re
+import socket
+
+from read_torrent import bdecode, bencode
+
+#Wire formats for DHT messages.
+#Node code always works with the same python dicts:
+#   query    -> {"type", "node_id", "port", "t", and "target_id" / "info_hash"}
+#   response -> {"node_id", "t", and "nodes" [(id, ip, port)] / "values" [(ip, port)] / "status"}
+#a codec only decides how those dicts look on the wire, so both formats can be compared on the same Node code.
+
+ID_LENGTH = 20
+COMPACT_NODE_LENGTH = 26  # 20 byte id + 4 byte ipv4 + 2 byte port
+COMPACT_PEER_LENGTH = 6   # 4 byte ipv4 + 2 byte port
+MAX_DEPTH = 4  # packet -> "a" / "r" -> "values" list -> peers, anything deeper is garbage
+
+
+# ---------------------------------------------------
+# Compact encodings (BEP 5)
+# ---------------------------------------------------
+
+def id_to_bytes(node_id):
+    return node_id.to_bytes(ID_LENGTH, "big")
+
+
+def id_from_bytes(raw):
+    if len(raw) != ID_LENGTH:
+        raise ValueError("node id must be 20 bytes")
+    return int.from_bytes(raw, "big")
+
+
+def encode_peer(ip, port):
+    return socket.inet_aton(ip) + port.to_bytes(2, "big")
+
+
+def decode_peer(raw):
+    return socket.inet_ntoa(raw[:4]), int.from_bytes(raw[4:6], "big")
+
+
+def encode_nodes(nodes):
+    return b''.join(id_to_bytes(n_id) + encode_peer(ip, port) for n_id, ip, port in nodes)
+
+
+def decode_nodes(raw):
+    if len(raw) % COMPACT_NODE_LENGTH:
+        raise ValueError("compact node info must be a multiple of 26 bytes")
+    nodes = []
+    for i in range(0, len(raw), COMPACT_NODE_LENGTH):
+        ip, port = decode_peer(raw[i + ID_LENGTH:i + COMPACT_NODE_LENGTH])
+        nodes.append((int.from_bytes(raw[i:i + ID_LENGTH], "big"), ip, port))
+    return nodes
+
+
+#transaction ids: ours are 16 bit ints sent as 2 bytes. other clients pick any length, their "t" stays the raw
+#bytes and is echoed back unchanged, so a 4 byte or 1 byte id still matches on their side
+TRANSACTION_ID_LENGTH = 2
+
+
+def encode_transaction_id(transaction_id):
+    if isinstance(transaction_id, bytes):
+        return transaction_id
+    return transaction_id.to_bytes(TRANSACTION_ID_LENGTH, "big")
+
+
+def decode_transaction_id(raw):
+    if len(raw) == TRANSACTION_ID_LENGTH:
+        return int.from_bytes(raw, "big")
+    return raw
+
+
+#walks the bencode tokens without building anything (strings are jumped over by their length), False as soon as
+#containers nest deeper than max_depth or a token is broken. a handful of steps for a real KRPC packet
+def within_depth(data, max_depth):
+    depth = 0
+    index = 0
+    end = len(data)
+    try:
+        while index < end:
+            token = data[index]
+            if token == 0x64 or token == 0x6c:  # 'd' / 'l'
+                depth += 1
+                if depth > max_depth:
+                    return False
+                index += 1
+            elif token == 0x65:  # 'e'
+                depth -= 1
+                index += 1
+            elif token == 0x69:  # 'i'
+                index = data.index(b"e", index) + 1
+            else:
+                colon = data.index(b":", index)
+                index = colon + 1 + int(data[index:colon])
+    except ValueError:
+        return False
+    return True
+
+
+#does a decoded reply hold what Node code expects: an int node_id, nodes as (id, ip, port), values as (ip, port).
+#a decoder only checks the wire format, a remote node can still send {"nodes": 5} in json
+def well_formed_reply(response):
+    if "node_id" in response and not valid_id(response["node_id"]):
+        return False
+    nodes = response.get("nodes", ())
+    values = response.get("values", ())
+    if not isinstance(nodes, (list, tuple)) or not isinstance(values, (list, tuple)):
+        return False
+    for node in nodes:
+        if not (isinstance(node, (list, tuple)) and len(node) == 3 and valid_id(node[0])
+                and isinstance(node[1], str) and valid_port(node[2])):
+            return False
+    for peer in values:
+        if not (isinstance(peer, (list, tuple)) and len(peer) == 2 and isinstance(peer[0], str)
+                and valid_port(peer[1])):
+            return False
+    return True
+
+
+def valid_id(node_id):
+    return type(node_id) is int and 0 <= node_id < 1 << 160
+
+
+def valid_port(port):
+    return type(port) is int and 0 < port < 65536
+
+
+# ---------------------------------------------------
+# Codecs
+# ---------------------------------------------------
+
+#the original format: json text, ids as decimal ints, nodes as [id, ip, port] arrays
+class JSONCodec:
+    name = "json"
+
+    def encode(self, message):
+        return json.dumps(message).encode()
+
+    def decode(self, data):
+        try:
+            return json.loads(data.decode())
+        except RecursionError as exc:
+            raise ValueError("json nested too deep") from exc
+
+    #cheap shape check before decoding (admission.py): a json object with a "type" key and nothing nested in it,
+    #our queries are flat
+    def looks_like_query(self, data):
+        return (data[:1] == b"{" and data[-1:] == b"}" and b'"type"' in data
+                and data.count(b"{") == 1 and b"[" not in data)
+
+    TRANSACTION_ID = re.compile(rb'"t":\s*(\d{1,5})\b')
+
+    #ints that may be the reply's "t", found without decoding (admission.py)
+    def transaction_ids(self, data):
+        return [int(match) for match in self.TRANSACTION_ID.findall(data)]
+
+
+#KRPC style bencoded dicts with raw 20 byte ids, 26 byte compact nodes and 6 byte peers
+class BencodeCodec:
+    name = "bencode"
+
+    #python key -> KRPC argument name, all of these hold 160 bit ids
+    ID_ARGS = {"node_id": b"id", "target_id": b"target", "info_hash": b"info_hash"}
+
+    def encode(self, message):
+        if "type" in message:
+            args = {}
+            for key, wire_key in self.ID_ARGS.items():
+                if message.get(key) is not None:
+                    args[wire_key] = id_to_bytes(message[key])
+            if "port" in message:
+                args[b"port"] = message["port"]
+            packet = {b"y": b"q", b"q": message["type"].encode(), b"a": args}
+        else:
+            body = {}
+            if "node_id" in message:
+                body[b"id"] = id_to_bytes(message["node_id"])
+            if "nodes" in message:
+                body[b"nodes"] = encode_nodes(message["nodes"])
+            if "values" in message:
+                body[b"values"] = [encode_peer(ip, port) for ip, port in message["values"]]
+            packet = {b"y": b"r", b"r": body}
+
+        if "t" in message:
+            packet[b"t"] = encode_transaction_id(message["t"])
+        return bencode(packet)
+
+    #cheap shape check before decoding (admission.py): a bencoded dict with y = q, nested no deeper than MAX_DEPTH
+    def looks_like_query(self, data):
+        return data[:1] == b"d" and data[-1:] == b"e" and b"1:y1:q" in data and within_depth(data, MAX_DEPTH)
+
+    #ints that may be the reply's "t" (ours are 2 bytes), found without decoding (admission.py). the key can
+    #also turn up inside binary ids, every place it does is a candidate
+    def transaction_ids(self, data):
+        ids = []
+        key = b"1:t2:"
+        index = data.find(key)
+        while index >= 0:
+            raw = data[index + len(key):index + len(key) + TRANSACTION_ID_LENGTH]
+            if len(raw) == TRANSACTION_ID_LENGTH:
+                ids.append(int.from_bytes(raw, "big"))
+            index = data.find(key, index + 1)
+        return ids
+
+    def decode(self, data):
+        try:
+            return self._decode(bdecode(data, max_depth=MAX_DEPTH))
+        except (IndexError, KeyError, TypeError, AttributeError, UnicodeDecodeError, OSError) as exc:
+            raise ValueError("malformed KRPC packet") from exc
+
+    def _decode(self, packet):
+        if not isinstance(packet, dict):
+            raise ValueError("KRPC packet must be a dict")
+
+        kind = packet.get(b"y")
+        if kind == b"q":
+            args = packet.get(b"a", {})
+            message = {"type": packet[b"q"].decode()}
+            for key, wire_key in self.ID_ARGS.items():
+                if wire_key in args:
+                    message[key] = id_from_bytes(args[wire_key])
+            if b"port" in args:
+                message["port"] = args[b"port"]
+        elif kind == b"r":
+            body = packet.get(b"r", {})
+            message = {}
+            if b"id" in body:
+                message["node_id"] = id_from_bytes(body[b"id"])
+            if b"nodes" in body:
+                message["nodes"] = decode_nodes(body[b"nodes"])
+            if b"values" in body:
+                message["values"] = [decode_peer(v) for v in body[b"values"]]
+            if not message:
+                message["status"] = "ok"
+        elif kind == b"e":
+            message = {"error": packet.get(b"e")}
+        else:
+            raise ValueError("unknown KRPC message kind")
+
+        if b"t" in packet:
+            message["t"] = decode_transaction_id(packet[b"t"])
+        return message
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    BencodeCodec.name: BencodeCodec,
+}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError("unknown DHT wire format: %r" % (name,))
+    return CODECS[name]()
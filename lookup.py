@@ -0,0 +1,121 @@
+import bisect
+
+from krpc import well_formed_reply
+
+#Iterative Kademlia lookup, kept separate from the routing table.
+#
+#the lookup owns a shortlist of candidates sorted by xor distance to the target. it only decides *who* to ask next,
+#sending the queries is left to the node (threads in core.Node, tasks in async_dht.AsyncNode):
+#
+#   lookup = Lookup(target_id, seeds, k, alpha)
+#   while not lookup.done:
+#       for path, node in lookup.next_queries():   -> keep up to alpha queries in flight per path
+#           send, and later call lookup.on_response(path, node, response)   (response None = timeout)
+#
+#the lookup is done when the k closest candidates that didn't fail have all answered, when there is nobody left
+#to ask, or (get_peers) as soon as want_peers peers were found.
+#
+#paths > 1 runs S/Kademlia style disjoint paths: the seeds are dealt out over the paths, every path has its own
+#shortlist and a node is only ever asked by one path, so a few malicious nodes can't steer every path.
+
+NEW, IN_FLIGHT, RESPONDED, FAILED = range(4)
+
+
+class Candidate:
+    __slots__ = ("node_id", "ip", "port", "state")
+
+    def __init__(self, node_id, ip, port):
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.state = NEW
+
+
+class LookupPath:
+    def __init__(self):
+        self.order = []       # [(distance, node_id)] ascending
+        self.candidates = {}  # node_id -> Candidate
+        self.in_flight = 0
+
+
+class Lookup:
+    def __init__(self, target_id, seeds, k=8, alpha=3, want_peers=None, paths=1, own_id=None):
+        self.target_id = target_id
+        self.k = k
+        self.alpha = alpha
+        self.want_peers = want_peers
+        self.paths = [LookupPath() for _ in range(max(1, paths))]
+        self.claimed = set() if own_id is None else {own_id}  # node ids owned by some path (never by two)
+        self.found_peers = []
+        self.seen_peers = set()
+        self.messages = 0
+        for i, (node_id, ip, port, *_) in enumerate(seeds):
+            self.add_candidate(self.paths[i % len(self.paths)], node_id, ip, port)
+
+    def add_candidate(self, path, node_id, ip, port):
+        if node_id is None or node_id in self.claimed:
+            return
+        self.claimed.add(node_id)
+        path.candidates[node_id] = Candidate(node_id, ip, port)
+        bisect.insort(path.order, (node_id ^ self.target_id, node_id))
+
+    #the k closest candidates of a path that haven't failed
+    def closest_alive(self, path):
+        closest = []
+        for _, node_id in path.order:
+            candidate = path.candidates[node_id]
+            if candidate.state != FAILED:
+                closest.append(candidate)
+                if len(closest) == self.k:
+                    break
+        return closest
+
+    def path_done(self, path):
+        closest = self.closest_alive(path)
+        return all(c.state == RESPONDED for c in closest)
+
+    @property
+    def done(self):
+        if self.want_peers is not None and len(self.found_peers) >= self.want_peers:
+            return True
+        return all(self.path_done(path) for path in self.paths)
+
+    #[(path, Candidate)] to query now. marks them in flight
+    def next_queries(self):
+        if self.done:
+            return []
+        queries = []
+        for path in self.paths:
+            if path.in_flight >= self.alpha:
+                continue
+            for candidate in self.closest_alive(path):
+                if candidate.state == NEW:
+                    candidate.state = IN_FLIGHT
+                    path.in_flight += 1
+                    self.messages += 1
+                    queries.append((path, candidate))
+                    if path.in_flight >= self.alpha:
+                        break
+        return queries
+
+    def on_response(self, path, candidate, response):
+        path.in_flight -= 1
+        if not response or not well_formed_reply(response):
+            candidate.state = FAILED  # no answer, or one we can't use
+            return
+        candidate.state = RESPONDED
+        for n_id, n_ip, n_port in response.get("nodes", ()):
+            self.add_candidate(path, n_id, n_ip, n_port)
+        for peer in response.get("values", ()):
+            peer = tuple(peer)
+            if peer not in self.seen_peers:
+                self.seen_peers.add(peer)
+                self.found_peers.append(peer)
+
+    #the k closest nodes that answered, over all paths, as (node_id, ip, port)
+    def closest_nodes(self):
+        responded = [
+            c for path in self.paths for c in path.candidates.values() if c.state == RESPONDED
+        ]
+        responded.sort(key=lambda c: c.node_id ^ self.target_id)
+        return [(c.node_id, c.ip, c.port) for c in responded[:self.k]]
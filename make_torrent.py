@@ -0,0 +1,188 @@
+import argparse
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from piece_verify import ConcatenatedFiles
+from read_torrent import bencode, bencode_to
+
+#Creates .torrent files (BEP 3 metainfo) from a file or a directory.
+#
+#the files are streamed front to back as one byte stream (ConcatenatedFiles, the same reader the recheck uses),
+#read_size bytes at a time (a whole number of pieces), and every chunk is hashed piece by piece on a thread pool.
+#hashlib drops the GIL on big buffers, so reading and hashing run on every core at once. chunks are collected in
+#the order they were read, so digests stay in piece order across file boundaries however the threads finish.
+#at most 2 chunks per worker are in memory, the metainfo itself only holds 20 bytes per piece.
+#
+#   metainfo = make_torrent("release/", announce="http://tracker/announce")
+#   info_hash = write_torrent(metainfo, "release.torrent")
+#
+#   python make_torrent.py release/ -o release.torrent -t http://tracker/announce
+
+MIN_PIECE_LENGTH = 16 * 1024
+MAX_PIECE_LENGTH = 16 * 1024 * 1024
+TARGET_PIECES = 1500  # piece length is doubled until the torrent has no more than this many pieces
+READ_SIZE = 4 * 1024 * 1024
+CREATED_BY = b"bitTorrent make_torrent"
+
+
+#smallest power of two piece length giving at most TARGET_PIECES pieces, within [16 KiB, 16 MiB]
+def choose_piece_length(total_length):
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_length > piece_length * TARGET_PIECES:
+        piece_length *= 2
+    return piece_length
+
+
+def collect_files(path):
+    """
+    the files to share under path, in the order their data runs through the pieces
+    returns [(file path, length, [path parts relative to path]), ...], sorted for a stable info_hash.
+    a single file has one entry with no parts
+    """
+    if os.path.isfile(path):
+        return [(path, os.path.getsize(path), [])]
+    if not os.path.isdir(path):
+        raise FileNotFoundError(path)
+    files = []
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            if not os.path.isfile(full):
+                continue  # sockets, broken links, ...
+            parts = os.path.relpath(full, path).split(os.sep)
+            files.append((full, os.path.getsize(full), parts))
+    files.sort(key=lambda entry: entry[2])  # walk order puts a directory's own files before its subdirectories
+    return files
+
+
+def hash_pieces(files, piece_length, workers=None, read_size=READ_SIZE):
+    """
+    files = [(path, length), ...] in torrent order
+    returns the pieces blob (20 byte SHA1 per piece, concatenated)
+    raises OSError if a file is missing or shorter than its length (changed while hashing)
+    """
+    total_length = sum(length for _, length in files)
+    chunk_size = max(1, read_size // piece_length) * piece_length
+    workers = workers or os.cpu_count() or 1
+    in_flight = threading.Semaphore(workers * 2)
+    free_buffers = []
+    lock = threading.Lock()
+
+    def hash_chunk(buffer, size):
+        try:
+            view = memoryview(buffer)[:size]
+            return b"".join(hashlib.sha1(view[start:start + piece_length]).digest()
+                            for start in range(0, size, piece_length))
+        finally:
+            with lock:
+                free_buffers.append(buffer)
+            in_flight.release()
+
+    pieces = bytearray()
+    futures = deque()
+    stream = ConcatenatedFiles(files)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for offset in range(0, total_length, chunk_size):
+            size = min(chunk_size, total_length - offset)
+            in_flight.acquire()
+            with lock:
+                buffer = free_buffers.pop() if free_buffers else bytearray(chunk_size)
+            if not stream.readinto(memoryview(buffer)[:size]):
+                in_flight.release()
+                raise OSError("file missing or truncated while hashing (around byte %d)" % offset)
+            futures.append(pool.submit(hash_chunk, buffer, size))
+            #collect finished chunks as we go, strictly in read order
+            while futures and futures[0].done():
+                pieces += futures.popleft().result()
+        while futures:
+            pieces += futures.popleft().result()
+    finally:
+        stream.close()
+        pool.shutdown(wait=True)
+    return bytes(pieces)
+
+
+def make_torrent(path, announce=None, trackers=(), piece_length=None, private=False, comment=None,
+                 workers=None, read_size=READ_SIZE, created_by=CREATED_BY):
+    """
+    metainfo dict for the file or directory at path.
+    trackers = extra announce URLs, each its own tier (announce-list, BEP 12)
+    piece_length=None picks one from the total size (choose_piece_length)
+    """
+    files = collect_files(path)
+    total_length = sum(length for _, length, _ in files)
+    if total_length == 0:
+        raise ValueError("nothing to share: %s is empty" % path)
+    if piece_length is None:
+        piece_length = choose_piece_length(total_length)
+    elif piece_length < MIN_PIECE_LENGTH or piece_length & (piece_length - 1):
+        raise ValueError("piece length must be a power of two of at least %d" % MIN_PIECE_LENGTH)
+
+    pieces = hash_pieces([(full, length) for full, length, _ in files], piece_length, workers, read_size)
+
+    name = os.path.basename(os.path.normpath(os.path.abspath(path)))
+    info = {b'name': name.encode(), b'piece length': piece_length, b'pieces': pieces}
+    if os.path.isfile(path):
+        info[b'length'] = total_length
+    else:
+        info[b'files'] = [
+            {b'length': length, b'path': [part.encode() for part in parts]} for _, length, parts in files
+        ]
+    if private:
+        info[b'private'] = 1
+
+    metainfo = {b'info': info, b'creation date': int(time.time())}
+    if created_by:
+        metainfo[b'created by'] = created_by
+    if comment:
+        metainfo[b'comment'] = comment.encode()
+    urls = ([announce] if announce else []) + [url for url in trackers if url != announce]
+    if urls:
+        metainfo[b'announce'] = urls[0].encode()
+    if len(urls) > 1:
+        metainfo[b'announce-list'] = [[url.encode()] for url in urls]
+    return metainfo
+
+
+def info_hash(metainfo):
+    return hashlib.sha1(bencode(metainfo[b'info'])).hexdigest()
+
+
+#streams the metainfo into out_path (atomically: temp file + rename), returns the hex info_hash
+def write_torrent(metainfo, out_path):
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        bencode_to(metainfo, f)
+    os.replace(tmp_path, out_path)
+    return info_hash(metainfo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="create a .torrent file from a file or directory")
+    parser.add_argument("path")
+    parser.add_argument("-o", "--output", help="torrent file to write (default: <name>.torrent)")
+    parser.add_argument("-t", "--tracker", action="append", default=[], help="announce URL, may be repeated")
+    parser.add_argument("-l", "--piece-length", type=int, help="bytes, power of two (default: from the size)")
+    parser.add_argument("-c", "--comment")
+    parser.add_argument("-p", "--private", action="store_true")
+    parser.add_argument("-w", "--workers", type=int, help="hashing threads (default: one per core)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    metainfo = make_torrent(args.path, trackers=args.tracker, piece_length=args.piece_length,
+                            private=args.private, comment=args.comment, workers=args.workers)
+    output = args.output or os.path.basename(os.path.normpath(os.path.abspath(args.path))) + ".torrent"
+    digest = write_torrent(metainfo, output)
+    info = metainfo[b'info']
+    print("wrote %s: %d pieces of %d bytes, hashed in %.1fs" % (
+        output, len(info[b'pieces']) // 20, info[b'piece length'], time.perf_counter() - start))
+    print("info hash:", digest)
+
+
+if __name__ == "__main__":
+    main()
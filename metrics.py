@@ -0,0 +1,295 @@
+import bisect
+import os
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Counters, latency histograms and gauges for the DHT and the peer wire engine.
+#
+#Metrics is a registry the hot paths write into with one dict update under a lock (inc / observe), no strings are
+#formatted and nothing is sent anywhere until someone reads it. gauges (routing table size, peer store size, per
+#peer rates) are not kept up to date at all: collectors registered with add_collector are called at export time.
+#
+#   metrics = Metrics()
+#   node = Node(ip, port, metrics=metrics)         per RPC type counters, send_rpc latency, timeouts, parse errors
+#   swarm = Swarm(..., metrics=metrics)            bytes per peer, pieces verified / failed
+#   PeerClient(..., metrics=metrics).connect()     handshakes, failures by reason
+#   print(metrics.format_text())                   readable snapshot
+#   serve_metrics(metrics, "127.0.0.1", 9100)      GET /metrics in Prometheus text format
+#
+#SamplingProfiler is the optional part: it looks at the stacks of chosen threads (the DHT listener) every few ms
+#and counts where they are, so a slow handler shows up without running the whole process under cProfile.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)  # seconds, upper bounds
+PROFILE_INTERVAL = 0.005
+
+#descriptions of the metrics the DHT and the peer wire engine write, shown as # HELP lines
+HELP = {
+    "dht_rpc_sent_total": "DHT queries sent, by type",
+    "dht_rpc_timeouts_total": "DHT queries that got no reply in time",
+    "dht_rpc_errors_total": "DHT queries that could not be sent (bad address, socket error)",
+    "dht_rpc_latency_seconds": "round trip of answered DHT queries",
+    "dht_parse_errors_total": "datagrams that did not decode to a message",
+    "dht_bad_replies_total": "DHT replies that decoded but held malformed node_id / nodes / values",
+    "dht_queries_received_total": "DHT queries answered, by type",
+    "dht_queries_unknown_total": "DHT queries of a type we don't handle",
+    "dht_query_errors_total": "DHT queries dropped for missing or malformed arguments",
+    "dht_unmatched_replies_total": "DHT replies that got past admission but matched no waiting query",
+    "dht_shard_forwarded_total": "get_peers / announce_peer queries handed to the shard owning the info_hash",
+    "dht_listener_errors_total": "unexpected errors in the DHT listener threads",
+    "dht_dropped_total": "datagrams dropped by admission control before decoding, by reason",
+    "dht_inserts_skipped_total": "queries answered without adding the sender to the routing table (overload)",
+    "dht_routing_table_contacts": "contacts in the routing table",
+    "dht_routing_table_buckets": "buckets in the routing table",
+    "dht_peer_store_torrents": "torrents with announced peers",
+    "dht_peer_store_peers": "announced peers stored",
+    "session_announce_failures_total": "torrent announces that failed with an error, by error type",
+    "peer_downloaded_bytes_total": "block payload received from peers",
+    "peer_uploaded_bytes_total": "block payload sent to peers",
+    "peer_pieces_verified_total": "pieces that passed the hash check and were written",
+    "peer_pieces_failed_total": "pieces that failed the hash check",
+    "peer_connections": "peers connected (handshake done)",
+    "peer_handshakes_total": "PeerClient handshakes that succeeded",
+    "peer_handshake_failures_total": "PeerClient handshakes that failed, by reason",
+    "peer_incoming_refused_total": "incoming connections refused for lack of a connection slot, by reason",
+    "peer_download_rate_bytes": "download rate from a peer, bytes per second",
+    "peer_upload_rate_bytes": "upload rate to a peer, bytes per second",
+}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    #upper bound of the bucket the q-th fraction of observations falls in (inf if past the last bound)
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> number, labels = ((key, value), ...)
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.collectors = []  # functions yielding (name, labels dict, value) gauges, called at export
+        self.help = dict(HELP)  # name -> one line description for the Prometheus export
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    #counter value (0 if never incremented), for tests and quick checks
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(labels.items())), 0)
+
+    #sum of a counter over all its label values
+    def total(self, name):
+        with self.lock:
+            return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def histogram(self, name, **labels):
+        with self.lock:
+            return self.histograms.get((name, tuple(labels.items())))
+
+    def gauges(self):
+        values = []
+        for collector in list(self.collectors):
+            for name, labels, value in collector():
+                values.append((name, tuple(labels.items()), value))
+        return values
+
+    #[(name, labels, value)] of counters and gauges, [((name, labels), histogram copy)], both sorted
+    def snapshot(self):
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: sort_key(item[0]))
+            histograms = sorted(((key, (histogram.bounds, list(histogram.counts), histogram.sum, histogram.count))
+                                 for key, histogram in self.histograms.items()), key=lambda item: sort_key(item[0]))
+        values = [(name, labels, value) for (name, labels), value in counters]
+        values += sorted(self.gauges(), key=lambda entry: sort_key(entry[:2]))
+        return values, histograms
+
+    def format_text(self):
+        values, histograms = self.snapshot()
+        lines = ["%s%s %s" % (name, format_labels(labels), format_value(value)) for name, labels, value in values]
+        for (name, labels), (bounds, counts, total, count) in histograms:
+            histogram = Histogram(bounds)
+            histogram.counts, histogram.sum, histogram.count = counts, total, count
+            lines.append("%s%s count %d  mean %.4f  p50 <= %g  p90 <= %g  p99 <= %g" % (
+                name, format_labels(labels), count, total / count if count else 0.0,
+                histogram.quantile(0.5), histogram.quantile(0.9), histogram.quantile(0.99)))
+        return "\n".join(lines)
+
+    #Prometheus text exposition format (version 0.0.4)
+    def format_prometheus(self):
+        values, histograms = self.snapshot()
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name in typed:
+                return
+            typed.add(name)
+            if name in self.help:
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        for name, labels, value in values:
+            header(name, "counter" if name.endswith("_total") else "gauge")
+            lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+        for (name, labels), (bounds, counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(bounds + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", le),)), cumulative))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(total)))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+#orders entries by name then labels, label values may mix types (None, ints, strings)
+def sort_key(key):
+    name, labels = key
+    return name, repr(labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+#serves GET /metrics (Prometheus) and GET /metrics.txt (format_text) on a daemon thread, returns the server
+#(server.server_address has the port when port=0, server.shutdown() stops it)
+def serve_metrics(metrics, host="127.0.0.1", port=9100):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.format_prometheus().encode()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.txt":
+                body = (metrics.format_text() + "\n").encode()
+                content_type = "text/plain"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # no line on stderr per scrape
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL, max_depth=32):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.threads = {}  # thread ident -> name
+        self.stacks = Counter()  # (outermost frame, ..., innermost frame) -> samples, frame = "file:function:line"
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def watch(self, thread, name=None):
+        self.threads[thread.ident] = name or thread.name
+
+    def start(self):
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, name in list(self.threads.items()):
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append("%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            stack.append(name)
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    #functions most often on top of the stack (where the time goes), as (frame, share of samples)
+    def top(self, count=20):
+        leaves = Counter()
+        for stack, samples in self.stacks.items():
+            leaves[stack[-1]] += samples
+        return [(frame, samples / self.samples) for frame, samples in leaves.most_common(count)]
+
+    #one "outer;...;inner count" line per stack, the input flamegraph.pl / speedscope take
+    def collapsed(self):
+        return "\n".join("%s %d" % (";".join(stack), samples) for stack, samples in self.stacks.most_common())
+
+    def format_top(self, count=20):
+        lines = ["%d samples every %.1f ms" % (self.samples, self.interval * 1000)]
+        lines += ["%5.1f%%  %s" % (100 * share, frame) for frame, share in self.top(count)]
+        return "\n".join(lines)
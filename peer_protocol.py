@@ -1,38 +1,779 @@
+import asyncio
 import socket
 import os
+import struct
+import time
+from collections import deque
+
+from bitfield import Bitfield
+from buffer_pool import BufferPool
+from core import PeerConnection, BLOCK_SIZE
+from piece_verify import PieceVerifier
+from ratelimit import TokenBucket, RateMeter, take_all
+from request_manager import RequestManager, RttEstimator
+
+#Peer wire protocol (BEP 3).
+#
+#a Swarm is the per-torrent state every connection shares (storage, picker, who else is connected). each TCP
+#connection is one PeerWire, an asyncio BufferedProtocol: the event loop reads straight into the connection's
+#receive buffer and frames are cut out of it in place, so hundreds of peers cost one thread, not hundreds.
+#
+#downloading is pipelined: every unchoked peer is kept at queue_depth outstanding block requests, so a link's
+#bandwidth-delay product is filled instead of waiting a round trip per 16 KiB block.
+#
+#blocks are not copied around: as soon as a piece message's header is in, the rest of its payload is read
+#(recv_into) straight into that piece's buffer, taken from a BufferPool. the finished buffer is hashed and written
+#to disk as is, then goes back to the pool. only payload bytes that arrived together with their header are copied
+#once out of the receive buffer.
+#
+#   swarm = Swarm(info_hash, storage, picker)      storage needs a disk (DiskStorage): pieces are written to it, uploads read from it
+#   await swarm.connect(ip, port)                  / await swarm.listen(host, port)
+#   await swarm.wait_complete()
+#
+#bandwidth: every connection meters what it sends and receives (RateMeter, read by the choker), and the optional
+#token buckets cap it per peer (peer_*_limit) and for the whole swarm (upload_bucket / download_bucket, which a
+#session can share between swarms). downloads are throttled by pausing the socket, uploads by waiting before a block.
+#unthrottled uploads are sent with sendfile, without reading the block into python.
+#payload bytes are also counted in PeerConnection.downloaded / uploaded and in the swarm's Metrics (metrics.py) if
+#it was given one. the meters' rates are copied to PeerConnection.download_rate / upload_rate every RATE_TICK.
+
+PSTR = b'BitTorrent protocol'
+HANDSHAKE_LENGTH = 49 + len(PSTR)  # 68
+
+CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD, REQUEST, PIECE, CANCEL = range(9)
+KEEPALIVE = b'\x00\x00\x00\x00'
+
+QUEUE_DEPTH = 16  # block requests kept outstanding per peer
+MAX_REQUEST_LENGTH = 128 * 1024  # peers asking for more than this are dropped
+MAX_MESSAGE_LENGTH = 2 * 1024 * 1024  # biggest frame accepted (a bitfield for 16M pieces)
+RECV_BUFFER_SIZE = 256 * 1024
+MIN_READ = 16 * 1024  # compact the receive buffer when less than this is free at its end
+KEEPALIVE_INTERVAL = 120
+RATE_TICK = 1  # seconds between folding the byte counters into PeerConnection (the choker does it if there is one)
+CONNECT_TIMEOUT = 5
+
+LENGTH = struct.Struct(">I")
+HEADER = struct.Struct(">IB")
+HAVE_MESSAGE = struct.Struct(">IBI")
+REQUEST_MESSAGE = struct.Struct(">IBIII")  # also cancel
+PIECE_HEADER = struct.Struct(">IBII")
+PIECE_HEADER_LENGTH = PIECE_HEADER.size  # 13
+INDEX = struct.Struct(">I")
+INDEX_BEGIN = struct.Struct(">II")
+INDEX_BEGIN_LENGTH = struct.Struct(">III")
+
+
+def generate_peer_id():
+    return b'-PC0001-' + os.urandom(12)
+
+
+def build_handshake(info_hash, peer_id):
+    return bytes([len(PSTR)]) + PSTR + b'\x00' * 8 + info_hash + peer_id
+
+
+#(reserved, info_hash, peer_id), ValueError if it isn't a BitTorrent handshake
+def parse_handshake(data):
+    if len(data) < HANDSHAKE_LENGTH or data[0] != len(PSTR) or bytes(data[1:20]) != PSTR:
+        raise ValueError("not a BitTorrent handshake")
+    return bytes(data[20:28]), bytes(data[28:48]), bytes(data[48:68])
+
+
+def encode_message(message_id, payload=b''):
+    return HEADER.pack(len(payload) + 1, message_id) + payload
+
+
+def encode_have(piece):
+    return HAVE_MESSAGE.pack(5, HAVE, piece)
+
+
+def encode_request(piece, begin, length, message_id=REQUEST):
+    return REQUEST_MESSAGE.pack(13, message_id, piece, begin, length)
+
+
+#the 13 bytes in front of a piece message's block, the block itself is written after it without joining
+def encode_piece_header(piece, begin, length):
+    return PIECE_HEADER.pack(9 + length, PIECE, piece, begin)
+
+
+class Swarm:
+    def __init__(self, info_hash, storage, picker, peer_id=None, queue_depth=QUEUE_DEPTH,
+                 upload_limit=None, download_limit=None, peer_upload_limit=None, peer_download_limit=None,
+                 metrics=None, executor=None, verifier=None):
+        self.info_hash = info_hash  # 20 bytes
+        self.peer_id = peer_id or generate_peer_id()
+        self.storage = storage
+        self.picker = picker
+        self.queue_depth = queue_depth
+        self.connections = set()  # PeerWire, handshake done
+        self.choker = None  # Choker (choker.py) deciding who gets unchoked, None = every interested peer
+        #bytes per second, None = unlimited
+        self.upload_bucket = TokenBucket(upload_limit) if upload_limit else None
+        self.download_bucket = TokenBucket(download_limit) if download_limit else None
+        self.peer_upload_limit = peer_upload_limit
+        self.peer_download_limit = peer_download_limit
+        self.tasks = set()
+        self.executor = executor  # thread pool for hashing / disk reads, None = the loop's default (shared by sessions)
+        #PieceVerifier (piece_verify.py) checking finished pieces, the same check Storage.recheck uses.
+        #verify() runs inside the executor job that also writes the piece
+        self.owns_verifier = verifier is None
+        self.verifier = verifier or PieceVerifier(storage.piece_hashes, workers=1)
+        self.pool = BufferPool(storage.piece_length)
+        self.piece_buffers = {}  # piece -> bytearray from the pool the piece's blocks are received into
+        self.filling = set()  # (piece, block) a connection is receiving into its piece buffer right now
+        self.requests = RequestManager(self)  # timeouts of outstanding requests, endgame
+        self.rate_task = None
+        self.metrics = metrics  # Metrics (metrics.py) or None
+        if metrics is not None:
+            metrics.add_collector(self.collect_metrics)
+        self.completed = asyncio.Event()
+        if storage.my_bitfield.is_complete():
+            self.completed.set()
+
+    async def connect(self, ip, port, timeout=CONNECT_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        peer = PeerConnection(ip, port)
+        transport, wire = await asyncio.wait_for(
+            loop.create_connection(lambda: PeerWire(self, peer), ip, port), timeout
+        )
+        try:
+            await asyncio.wait_for(wire.handshake_done, timeout)
+        except BaseException:
+            transport.close()
+            raise
+        return wire
+
+    #accepts incoming connections for this torrent, returns the asyncio Server
+    async def listen(self, host, port):
+        loop = asyncio.get_running_loop()
+        swarms = {self.info_hash: self}
+        return await loop.create_server(lambda: PeerWire(None, None, lookup_swarm=swarms.get), host, port)
+
+    async def wait_complete(self):
+        await self.completed.wait()
+
+    def close(self):
+        for wire in list(self.connections):
+            wire.close()
+        for task in self.tasks:
+            task.cancel()
+        if self.metrics is not None:
+            self.metrics.remove_collector(self.collect_metrics)
+        if self.owns_verifier:
+            self.verifier.close()
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    #keeps PeerConnection's rates fresh when no choker does it
+    def start_rates(self):
+        if self.rate_task is None:
+            self.rate_task = self.spawn(self.track_rates())
+
+    async def track_rates(self):
+        while True:
+            await asyncio.sleep(RATE_TICK)
+            if self.choker is None:
+                self.update_rates()
+
+    #folds every connection's RateMeters into its PeerConnection's rates, every RATE_TICK (by the choker if there is one)
+    def update_rates(self, now=None):
+        for wire in self.connections:
+            peer = wire.peer
+            peer.download_rate = wire.download_meter.tick(now)
+            peer.upload_rate = wire.upload_meter.tick(now)
+
+    #gauges read when the metrics are exported
+    def collect_metrics(self):
+        torrent = self.info_hash.hex()
+        yield "peer_connections", {"torrent": torrent}, len(self.connections)
+        for wire in self.connections:
+            labels = {"torrent": torrent, "peer": "%s:%d" % (wire.peer.ip, wire.peer.port)}
+            yield "peer_download_rate_bytes", labels, wire.peer.download_rate
+            yield "peer_upload_rate_bytes", labels, wire.peer.upload_rate
+
+    #payload bytes moved for this torrent, counted once per block / piece message
+    def count_bytes(self, name, amount):
+        if self.metrics is not None:
+            self.metrics.inc(name, amount, torrent=self.info_hash.hex())
+
+    #a requested block went away (choke, disconnect): free it again unless another peer still has it in flight
+    def release(self, piece, block, source):
+        for wire in self.connections:
+            if wire is not source and (piece, block) in wire.peer.pending_requests:
+                return
+        self.picker.on_request_failed(piece, block)
+
+    #where a block's payload goes: a writable view of its slot in the piece buffer, None if the block isn't
+    #wanted (endgame duplicate, another connection is already receiving it, piece reset after a failed hash check)
+    def block_destination(self, piece, block, length):
+        storage = self.storage
+        status = storage.block_status.get(piece)
+        if storage.my_bitfield[piece] or status is None or status[block] == 2 or (piece, block) in self.filling:
+            return None
+        buffer = self.piece_buffers.get(piece)
+        if buffer is None:
+            buffer = self.piece_buffers[piece] = self.pool.acquire()
+        self.filling.add((piece, block))
+        begin = block * BLOCK_SIZE
+        return memoryview(buffer)[begin:begin + length]
+
+    #a whole block that was still in the connection's receive buffer
+    def on_block(self, source, piece, block, data):
+        destination = self.block_destination(piece, block, len(data))
+        if destination is not None:
+            destination[:] = data
+            self.block_done(source, piece, block)
+
+    #the block's payload is in the piece buffer
+    def block_done(self, source, piece, block):
+        self.filling.discard((piece, block))
+        storage = self.storage
+        storage.mark_block_received(piece, block)
+        if storage.is_piece_complete(piece):
+            self.spawn(self.verify_piece(piece))
+        #endgame: whoever else was asked for this block can stop sending it
+        for wire in self.connections:
+            if wire is not source and (piece, block) in wire.peer.pending_requests:
+                wire.cancel(piece, block)
+
+    #hash check + disk write, in a worker thread. the bit in my_bitfield is only set once the data is on disk
+    def store_piece(self, piece, data):
+        if not self.verifier.verify(piece, data):
+            return False
+        self.storage.disk.write_now(piece, 0, data)
+        return True
+
+    #hashes and stores a piece once all its blocks are in, off the event loop
+    async def verify_piece(self, piece):
+        loop = asyncio.get_running_loop()
+        storage = self.storage
+        buffer = self.piece_buffers.pop(piece)
+        view = memoryview(buffer)[:self.picker.piece_size(piece)]
+        try:
+            ok = await loop.run_in_executor(self.executor, self.store_piece, piece, view)
+        finally:
+            view.release()
+            self.pool.release(buffer)
+        if self.metrics is not None:
+            name = "peer_pieces_verified_total" if ok else "peer_pieces_failed_total"
+            self.metrics.inc(name, torrent=self.info_hash.hex())
+        if ok:
+            storage.my_bitfield[piece] = 1
+            self.picker.on_piece_complete(piece)
+            have = encode_have(piece)
+            for wire in self.connections:
+                wire.send(have)
+                wire.update_interest()
+            if storage.my_bitfield.is_complete():
+                self.completed.set()
+        else:
+            self.picker.on_piece_failed(piece)
+            for wire in self.connections:
+                wire.fill_requests()
+
+
+class PeerWire(asyncio.BufferedProtocol):
+    def __init__(self, swarm, peer, lookup_swarm=None, accept=None):
+        self.swarm = swarm  # None for incoming connections until the handshake names the torrent
+        self.peer = peer
+        self.lookup_swarm = lookup_swarm  # info_hash -> Swarm or None, for incoming connections
+        self.accept = accept  # (wire, swarm) -> False refuses an incoming connection (connection limits)
+        self.release = None  # set by accept: called once when the accepted connection goes away
+        self.outgoing = swarm is not None
+        self.transport = None
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unparsed byte
+        self.end = 0  # end of the received data
+        self.need = 0  # size of the frame we are waiting for the rest of
+        self.block = None  # (piece, block) whose payload is being read straight into its piece buffer
+        self.block_swarm = None  # the swarm that piece buffer belongs to
+        self.block_view = None  # the rest of that block's slot in the piece buffer
+        self.block_filled = 0
+        self.handshaken = False
+        self.handshake_done = asyncio.get_event_loop().create_future()
+        self.closed = asyncio.get_event_loop().create_future()  # resolved when the socket is gone
+        self.uploads = deque()  # (piece, begin, length) the peer asked for, served in order
+        self.uploading = False
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.keepalive_handle = None
+        self.error = None
+        self.connected_at = time.monotonic()
+        self.download_meter = RateMeter()  # payload bytes received
+        self.upload_meter = RateMeter()  # payload bytes sent
+        self.upload_bucket = None  # per peer limits, set once we know the swarm
+        self.download_bucket = None
+        self.reading_paused = False
+        self.rtt = RttEstimator()  # request -> block round trip, drives the request timeouts
+
+    # ---------------------------------------------------
+    # connection events
+    # ---------------------------------------------------
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.peer is None:
+            ip, port = transport.get_extra_info("peername")[:2]
+            self.peer = PeerConnection(ip, port)
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.outgoing:
+            transport.write(build_handshake(self.swarm.info_hash, self.swarm.peer_id))
+        self.schedule_keepalive()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.keepalive_handle is not None:
+            self.keepalive_handle.cancel()
+        if not self.handshake_done.done():
+            if self.outgoing:
+                self.handshake_done.set_exception(ConnectionError(self.error or "connection closed during handshake"))
+            else:
+                self.handshake_done.cancel()  # nobody waits on it for incoming connections
+        self.writable.set()
+        if not self.closed.done():
+            self.closed.set_result(self.error)
+        if self.block is not None:
+            self.block_swarm.filling.discard(self.block)  # half received, the request is dropped below
+            self.block = self.block_view = None
+        self.leave_swarm()
+        if self.release is not None:
+            release, self.release = self.release, None
+            release()
+
+    def leave_swarm(self):
+        swarm = self.swarm
+        if swarm is None or self not in swarm.connections:
+            return
+        swarm.connections.discard(self)
+        swarm.picker.on_peer_gone(self.peer.peer_bitfield)
+        self.drop_requests()
+        self.uploads.clear()
+
+    #moves a live connection to another Swarm of the same torrent (restarted with new storage / picker)
+    def rebind(self, swarm):
+        self.leave_swarm()
+        self.swarm = swarm
+        if self.transport is None:
+            return
+        swarm.connections.add(self)
+        swarm.requests.start()
+        swarm.start_rates()
+        self.peer.am_interested = False
+        if self.peer.peer_bitfield is not None:
+            swarm.picker.on_bitfield(self.peer.peer_bitfield)
+        #a second bitfield message isn't allowed, what we have is announced again with haves
+        self.send(b''.join(encode_have(piece) for piece in swarm.storage.my_bitfield.set_indices()))
+        self.update_interest()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def close(self, error=None):
+        if error and self.error is None:
+            self.error = error
+        if self.transport is not None:
+            self.transport.close()
+
+    def send(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def schedule_keepalive(self):
+        loop = asyncio.get_event_loop()
+        self.keepalive_handle = loop.call_later(KEEPALIVE_INTERVAL, self.keepalive)
+
+    def keepalive(self):
+        self.send(KEEPALIVE)
+        self.schedule_keepalive()
+
+    # ---------------------------------------------------
+    # framing
+    # ---------------------------------------------------
+
+    def get_buffer(self, sizehint):
+        if self.block is not None:
+            return self.block_view[self.block_filled:]
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < max(MIN_READ, self.need - (self.end - self.start)):
+            #move the unparsed tail to the front (and grow if one frame is bigger than the buffer)
+            pending = self.end - self.start
+            if self.need > len(self.buffer):
+                buffer = bytearray(self.need)
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer, self.view = buffer, memoryview(buffer)
+            else:
+                self.view[:pending] = self.view[self.start:self.end]  # memoryview copies overlapping ranges safely
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.peer.last_active = time.time()
+        if self.swarm is not None:
+            self.throttle_download(nbytes)
+        if self.block is not None:
+            self.block_filled += nbytes
+            if self.block_filled == len(self.block_view):
+                self.finish_block()
+            return
+        self.end += nbytes
+        while self.transport is not None:
+            available = self.end - self.start
+            if not self.handshaken:
+                if available < HANDSHAKE_LENGTH:
+                    self.need = HANDSHAKE_LENGTH
+                    return
+                handshake = self.view[self.start:self.start + HANDSHAKE_LENGTH]
+                self.start += HANDSHAKE_LENGTH
+                self.on_handshake(handshake)
+                continue
+            if available < 4:
+                self.need = 4
+                return
+            length = LENGTH.unpack_from(self.buffer, self.start)[0]
+            if length > MAX_MESSAGE_LENGTH:
+                self.close("message of %d bytes" % length)
+                return
+            if available < 4 + length:
+                if available >= PIECE_HEADER_LENGTH and self.buffer[self.start + 4] == PIECE:
+                    self.start_block(length)
+                    if self.block is not None:
+                        return
+                self.need = 4 + length
+                return
+            message = self.view[self.start + 4:self.start + 4 + length]
+            self.start += 4 + length
+            if length:
+                self.on_message(message)
+        self.need = 0
+
+    #a piece message whose header is in but not all of its payload: the payload is received into the piece buffer
+    def start_block(self, length):
+        piece, begin = INDEX_BEGIN.unpack_from(self.buffer, self.start + 5)
+        block, offset = divmod(begin, BLOCK_SIZE)
+        size = length - 9
+        swarm = self.swarm
+        if offset or piece >= swarm.storage.total_pieces or size != swarm.picker.block_size(piece, block):
+            return  # left to the normal path, which drops the connection
+        destination = swarm.block_destination(piece, block, size)
+        if destination is None:
+            return  # unwanted, read and thrown away through the receive buffer
+        arrived = self.end - self.start - PIECE_HEADER_LENGTH
+        destination[:arrived] = self.view[self.start + PIECE_HEADER_LENGTH:self.end]
+        self.start = self.end = 0
+        self.block = (piece, block)
+        self.block_swarm = swarm
+        self.block_view = destination
+        self.block_filled = arrived
+
+    def throttle_download(self, nbytes):
+        delay = take_all((self.download_bucket, self.swarm.download_bucket), nbytes)
+        if delay and not self.reading_paused and self.transport is not None:
+            self.reading_paused = True
+            self.transport.pause_reading()
+            asyncio.get_event_loop().call_later(delay, self.resume_download)
+
+    def resume_download(self):
+        self.reading_paused = False
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def finish_block(self):
+        piece, block = self.block
+        self.count_download(self.block_filled)
+        self.block = self.block_view = None
+        if self.block_swarm is not self.swarm:
+            self.block_swarm.filling.discard((piece, block))  # arrived for the swarm we were moved away from
+            return
+        sent_at = self.peer.pending_requests.pop((piece, block), None)
+        if sent_at is not None:
+            self.swarm.requests.on_answer(self, sent_at)
+        self.swarm.block_done(self, piece, block)
+        self.fill_requests()
+
+    #payload bytes go to the connection's meter, PeerConnection's counter and the swarm's metrics
+    def count_download(self, nbytes):
+        self.download_meter.add(nbytes)
+        self.peer.downloaded += nbytes
+        self.swarm.count_bytes("peer_downloaded_bytes_total", nbytes)
+
+    def count_upload(self, nbytes):
+        self.upload_meter.add(nbytes)
+        self.peer.uploaded += nbytes
+        self.swarm.count_bytes("peer_uploaded_bytes_total", nbytes)
+
+    # ---------------------------------------------------
+    # incoming messages
+    # ---------------------------------------------------
+
+    def on_handshake(self, data):
+        try:
+            _, info_hash, peer_id = parse_handshake(data)
+        except ValueError as e:
+            self.close(str(e))
+            return
+        if self.swarm is None:
+            self.swarm = self.lookup_swarm(info_hash) if self.lookup_swarm else None
+            if self.swarm is None:
+                self.close("unknown info_hash")
+                return
+            if self.accept is not None and not self.accept(self, self.swarm):
+                self.close("too many connections")
+                return
+            self.transport.write(build_handshake(self.swarm.info_hash, self.swarm.peer_id))
+        elif info_hash != self.swarm.info_hash:
+            self.close("info_hash mismatch")
+            return
+        if peer_id == self.swarm.peer_id:
+            self.close("connected to ourselves")
+            return
+        self.handshaken = True
+        self.peer.peer_id = peer_id
+        if self.swarm.peer_upload_limit:
+            self.upload_bucket = TokenBucket(self.swarm.peer_upload_limit)
+        if self.swarm.peer_download_limit:
+            self.download_bucket = TokenBucket(self.swarm.peer_download_limit)
+        self.swarm.connections.add(self)
+        self.swarm.requests.start()
+        self.swarm.start_rates()
+        if self.swarm.storage.my_bitfield.any():
+            self.send(encode_message(BITFIELD, self.swarm.storage.my_bitfield.to_bytes()))
+        if not self.handshake_done.done():
+            self.handshake_done.set_result(self)
+
+    def on_message(self, message):
+        message_id = message[0]
+        peer = self.peer
+        try:
+            if message_id == PIECE:
+                piece, begin = INDEX_BEGIN.unpack_from(message, 1)
+                self.on_piece(piece, begin, message[9:])
+            elif message_id == HAVE:
+                self.on_have(INDEX.unpack_from(message, 1)[0])
+            elif message_id == REQUEST:
+                self.on_request(*INDEX_BEGIN_LENGTH.unpack_from(message, 1))
+            elif message_id == CANCEL:
+                request = INDEX_BEGIN_LENGTH.unpack_from(message, 1)
+                if request in self.uploads:
+                    self.uploads.remove(request)
+            elif message_id == CHOKE:
+                peer.peer_choking = True
+                #BEP 3: a choke drops every request we had outstanding
+                self.drop_requests()
+            elif message_id == UNCHOKE:
+                peer.peer_choking = False
+                self.fill_requests()
+            elif message_id == INTERESTED:
+                peer.peer_interested = True
+                if self.swarm.choker is None:
+                    self.unchoke()
+                else:
+                    self.swarm.choker.on_interested(self)
+            elif message_id == NOT_INTERESTED:
+                peer.peer_interested = False
+            elif message_id == BITFIELD:
+                self.on_bitfield(message[1:])
+            #unknown ids (extensions we didn't advertise) are ignored
+        except (struct.error, ValueError, IndexError) as e:
+            self.close("bad message %d: %s" % (message_id, e))
+
+    def on_bitfield(self, payload):
+        bitfield = Bitfield(self.swarm.storage.total_pieces, payload)
+        picker = self.swarm.picker
+        picker.on_peer_gone(self.peer.peer_bitfield)
+        self.peer.peer_bitfield = bitfield
+        picker.on_bitfield(bitfield)
+        self.update_interest()
+
+    def on_have(self, piece):
+        peer = self.peer
+        if peer.peer_bitfield is None:
+            peer.peer_bitfield = Bitfield(self.swarm.storage.total_pieces)
+        if peer.peer_bitfield[piece]:
+            return
+        peer.peer_bitfield[piece] = 1
+        self.swarm.picker.on_have(piece)
+        if not peer.am_interested and not self.swarm.storage.my_bitfield[piece]:
+            self.update_interest()
+        else:
+            self.fill_requests()
+
+    def on_piece(self, piece, begin, data):
+        block, offset = divmod(begin, BLOCK_SIZE)
+        picker = self.swarm.picker
+        if offset or piece >= self.swarm.storage.total_pieces or len(data) != picker.block_size(piece, block):
+            raise ValueError("block doesn't match a request")
+        sent_at = self.peer.pending_requests.pop((piece, block), None)  # None if cancelled, still useful
+        if sent_at is not None:
+            self.swarm.requests.on_answer(self, sent_at)
+        self.count_download(len(data))
+        self.swarm.on_block(self, piece, block, data)
+        self.fill_requests()
+
+    def on_request(self, piece, begin, length):
+        storage = self.swarm.storage
+        if length > MAX_REQUEST_LENGTH:
+            raise ValueError("request for %d bytes" % length)
+        if self.peer.am_choking or piece >= storage.total_pieces or not storage.my_bitfield[piece]:
+            return
+        if begin + length > self.swarm.picker.piece_size(piece):
+            raise ValueError("request past the end of the piece")
+        self.uploads.append((piece, begin, length))
+        if not self.uploading:
+            self.uploading = True
+            self.swarm.spawn(self.serve_uploads())
+
+    # ---------------------------------------------------
+    # outgoing
+    # ---------------------------------------------------
+
+    def update_interest(self):
+        peer = self.peer
+        interested = peer.peer_bitfield is not None and peer.peer_bitfield.has_missing_from(self.swarm.storage.my_bitfield)
+        if interested != peer.am_interested:
+            peer.am_interested = interested
+            self.send(encode_message(INTERESTED if interested else NOT_INTERESTED))
+        self.fill_requests()
+
+    def choke(self):
+        if not self.peer.am_choking:
+            self.peer.am_choking = True
+            self.uploads.clear()
+            self.send(encode_message(CHOKE))
+
+    def unchoke(self):
+        if self.peer.am_choking:
+            self.peer.am_choking = False
+            self.send(encode_message(UNCHOKE))
+
+    def cancel(self, piece, block):
+        if self.peer.pending_requests.pop((piece, block), None) is not None:
+            length = self.swarm.picker.block_size(piece, block)
+            self.send(encode_request(piece, block * BLOCK_SIZE, length, CANCEL))
+
+    #tops the pipeline up to queue_depth outstanding requests
+    def fill_requests(self):
+        peer = self.peer
+        if self.transport is None or peer.peer_choking or not peer.am_interested:
+            return
+        pending = peer.pending_requests
+        picker = self.swarm.picker
+        requests = []
+        now = time.monotonic()
+        while len(pending) < self.swarm.queue_depth:
+            pick = picker.pick_block(peer.peer_bitfield, exclude=pending)
+            if pick is None:
+                break
+            piece, block, length = pick
+            pending[(piece, block)] = now
+            self.swarm.requests.track(self, piece, block, now)
+            requests.append(encode_request(piece, block * BLOCK_SIZE, length))
+        if requests:
+            self.transport.write(b''.join(requests))
+
+    def drop_requests(self):
+        pending = list(self.peer.pending_requests)
+        self.peer.pending_requests.clear()
+        for piece, block in pending:
+            self.swarm.release(piece, block, self)
+
+    #unthrottled uploads: when nothing is queued in the transport the block goes from the page cache to the socket
+    #with sendfile (DiskStorage.send_block). what the socket buffer doesn't take is read and written right away, in
+    #this loop turn, so no other message can get in between. False = not sent, left to the normal read path
+    def send_file(self, piece, begin, length):
+        sock = self.transport.get_extra_info("socket")
+        if sock is None or self.transport.get_write_buffer_size():
+            return False
+        self.transport.write(encode_piece_header(piece, begin, length))
+        disk = self.swarm.storage.disk
+        sent = disk.send_block(sock, piece, begin, length) if not self.transport.get_write_buffer_size() else 0
+        if sent < length:
+            self.transport.write(disk.read_block(piece, begin + sent, length - sent))
+        self.count_upload(length)
+        return True
+
+    async def serve_uploads(self):
+        loop = asyncio.get_running_loop()
+        disk = self.swarm.storage.disk
+        try:
+            while self.uploads and self.transport is not None:
+                await self.writable.wait()
+                if not self.uploads or self.transport is None:
+                    break
+                piece, begin, length = self.uploads.popleft()
+                buckets = (self.upload_bucket, self.swarm.upload_bucket)
+                if buckets == (None, None) and self.send_file(piece, begin, length):
+                    continue
+                delay = take_all(buckets, length)
+                if delay:
+                    await asyncio.sleep(delay)
+                    if self.transport is None or self.peer.am_choking:
+                        break
+                data = await loop.run_in_executor(self.swarm.executor, disk.read_block, piece, begin, length)
+                if self.transport is None or self.peer.am_choking:
+                    break
+                self.transport.writelines((encode_piece_header(piece, begin, length), data))
+                self.count_upload(length)
+        finally:
+            self.uploading = False
+
+
+#blocking one-shot handshake, kept for scripts. the engine above is what the client uses.
+#connect() returns the socket after a good handshake, None otherwise: the reason is counted in
+#peer_handshake_failures_total if a Metrics was given
 class PeerClient:
-    def __init__(self, ip, port, info_hash):
+    def __init__(self, ip, port, info_hash, metrics=None):
         self.ip = ip
         self.port = port
         self.info_hash = bytes.fromhex(info_hash)
         self.peer_id = self.generate_peer_id()
+        self.metrics = metrics  # Metrics (metrics.py) or None
 
     def generate_peer_id(self):
-        return b'-PC0001-' + os.urandom(12)
+        return generate_peer_id()
 
     def build_handshake(self):
-        pstr = b'BitTorrent protocol'
-        return (
-            bytes([len(pstr)]) +
-            pstr +
-            b'\x00' * 8 +
-            self.info_hash +
-            self.peer_id
-        )
+        return build_handshake(self.info_hash, self.peer_id)
 
     def connect(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(5)
-        sock.connect((self.ip, self.port))
+        try:
+            sock.connect((self.ip, self.port))
+            sock.sendall(self.build_handshake())
 
-        handshake = self.build_handshake()
-        sock.sendall(handshake)
+            #recv can return less than asked for, read until the whole handshake is in
+            response = b''
+            while len(response) < HANDSHAKE_LENGTH:
+                chunk = sock.recv(HANDSHAKE_LENGTH - len(response))
+                if not chunk:
+                    break
+                response += chunk
+        except OSError as error:
+            return self.failed(sock, "timeout" if isinstance(error, socket.timeout) else "connect")
 
-        response = sock.recv(68)
+        try:
+            _, info_hash, _ = parse_handshake(response)
+        except ValueError:
+            return self.failed(sock, "closed" if len(response) < HANDSHAKE_LENGTH else "invalid")
+        if info_hash != self.info_hash:
+            return self.failed(sock, "wrong_torrent")
 
-        if len(response) < 68:
-            print("Invalid handshake response")
-            return None
-
-        print("Handshake successful with", self.ip, self.port)
+        if self.metrics is not None:
+            self.metrics.inc("peer_handshakes_total")
         return sock
+
+    def failed(self, sock, reason):
+        sock.close()
+        if self.metrics is not None:
+            self.metrics.inc("peer_handshake_failures_total", reason=reason)
+        return None
@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from krpc import encode_peer, decode_peer
+
+#Node.local_storage: peers announced to us, per info_hash.
+#  - each peer is kept as its 6 byte compact form (4 byte ipv4 + 2 byte port) in a dict -> O(1) dedup
+#  - every announce (re)sets the peer's expiry, expired peers are dropped lazily and by periodic sweeps
+#  - info_hashes are kept in LRU order, when the store holds more than max_peers the coldest info_hashes go first
+#  - get_peers hands out a random sample, popular torrents don't produce giant responses
+
+PEER_TTL = 30 * 60          # seconds an announce stays valid (BEP 5 suggests 30 minutes)
+MAX_PEERS = 100000          # whole store
+MAX_PEERS_PER_TORRENT = 2000
+SWEEP_INTERVAL = 1024       # announces between two full expiry sweeps
+
+
+class PeerStore:
+    def __init__(self, ttl=PEER_TTL, max_peers=MAX_PEERS, max_peers_per_torrent=MAX_PEERS_PER_TORRENT):
+        self.ttl = ttl
+        self.max_peers = max_peers
+        self.max_peers_per_torrent = max_peers_per_torrent
+        self.torrents = OrderedDict()  # info_hash -> OrderedDict(compact peer -> expiry time), coldest first
+        self.peer_count = 0
+        self.announces_since_sweep = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.torrents)
+
+    def __contains__(self, info_hash):
+        return bool(self.get_peers(info_hash, 1))
+
+    def add_peer(self, info_hash, ip, port):
+        try:
+            compact = encode_peer(ip, port)
+        except (OSError, OverflowError):
+            return  # not an ipv4 address / bad port, can't be handed out in compact form
+        now = time.time()
+        with self.lock:
+            peers = self.torrents.get(info_hash)
+            if peers is None:
+                peers = self.torrents[info_hash] = OrderedDict()
+            else:
+                self.torrents.move_to_end(info_hash)
+
+            if compact in peers:
+                peers.move_to_end(compact)
+            else:
+                self.peer_count += 1
+                if len(peers) >= self.max_peers_per_torrent:
+                    peers.popitem(last=False)  # oldest announce of this torrent
+                    self.peer_count -= 1
+            peers[compact] = now + self.ttl
+
+            self.announces_since_sweep += 1
+            if self.announces_since_sweep >= SWEEP_INTERVAL:
+                self.expire_locked(now)
+            while self.peer_count > self.max_peers and len(self.torrents) > 1:
+                _, cold = self.torrents.popitem(last=False)
+                self.peer_count -= len(cold)
+
+    #random sample of at most max_count live peers as (ip, port) tuples
+    def get_peers(self, info_hash, max_count=50):
+        now = time.time()
+        with self.lock:
+            peers = self.torrents.get(info_hash)
+            if not peers:
+                return []
+            self.torrents.move_to_end(info_hash)
+            self.drop_expired(info_hash, peers, now)
+            if len(peers) <= max_count:
+                sample = list(peers)
+            else:
+                sample = random.sample(list(peers), max_count)
+        return [decode_peer(compact) for compact in sample]
+
+    #[(info_hash, compact peer, expiry)] of every live peer, for snapshots (dht_snapshot.py)
+    def dump(self):
+        now = time.time()
+        with self.lock:
+            return [
+                (info_hash, compact, expires)
+                for info_hash, peers in self.torrents.items()
+                for compact, expires in peers.items() if expires > now
+            ]
+
+    #puts dumped peers back with their original expiry, the ones that ran out meanwhile are skipped
+    def load(self, entries):
+        now = time.time()
+        with self.lock:
+            for info_hash, compact, expires in entries:
+                if expires <= now:
+                    continue
+                peers = self.torrents.get(info_hash)
+                if peers is None:
+                    peers = self.torrents[info_hash] = OrderedDict()
+                if compact not in peers:
+                    if len(peers) >= self.max_peers_per_torrent:
+                        continue
+                    self.peer_count += 1
+                peers[compact] = expires
+            #expiry order is what drop_expired relies on
+            for info_hash, peers in self.torrents.items():
+                self.torrents[info_hash] = OrderedDict(sorted(peers.items(), key=lambda item: item[1]))
+
+    def expire(self):
+        with self.lock:
+            self.expire_locked(time.time())
+
+    def expire_locked(self, now):
+        self.announces_since_sweep = 0
+        for info_hash, peers in list(self.torrents.items()):
+            self.drop_expired(info_hash, peers, now)
+
+    #peers of one torrent are in announce order, so expired ones are always at the front
+    def drop_expired(self, info_hash, peers, now):
+        while peers:
+            compact, expires = next(iter(peers.items()))
+            if expires > now:
+                break
+            peers.popitem(last=False)
+            self.peer_count -= 1
+        if not peers:
+            del self.torrents[info_hash]
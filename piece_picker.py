@@ -0,0 +1,235 @@
+import heapq
+import random
+
+from bitfield import Availability, Bitfield, first_set_index
+from core import BLOCK_SIZE
+
+#Decides which block to request next from a peer.
+#
+#availability (how many peers have each piece) is kept up to date as bitfield / have messages arrive and peers
+#leave. pieces nobody has started yet sit in buckets by availability, levels[count] = set of pieces, so a have
+#message only moves one piece between two sets, nothing is ever re-sorted. a heap of non-empty levels gives the
+#rarest level in O(log n). every level also has a Bitfield mask, so "which of these does this peer have" is one
+#big int AND with the peer's bitfield instead of a walk over the level: a peer that only has common pieces costs a
+#few word-at-a-time ANDs per rarer level, not a look at every rarer piece.
+#
+#modes:
+#   RAREST_FIRST  finish started pieces first, then the rarest piece the peer has (the first one after a random
+#                 index among equally rare ones, so peers spread out)
+#   SEQUENTIAL    lowest piece index first (streaming)
+#   endgame       entered automatically once every missing block has been requested: blocks still in flight
+#                 are handed out again to other peers (the caller cancels the duplicates when one arrives)
+
+RAREST_FIRST = "rarest"
+SEQUENTIAL = "sequential"
+
+
+class PiecePicker:
+    def __init__(self, storage, total_length, mode=RAREST_FIRST):
+        self.storage = storage
+        self.total_length = total_length
+        self.mode = mode
+        self.availability = Availability(storage.total_pieces)
+        self.levels = {}  # availability -> set of untouched pieces we still need
+        self.level_masks = {}  # availability -> Bitfield of the same pieces
+        self.level_heap = []  # availability levels that may be non-empty (emptied ones are dropped when popped)
+        self.in_heap = set()  # levels currently in level_heap, so each is in there once
+        self.fresh = set()  # pieces not started, not owned
+        self.fresh_mask = Bitfield(storage.total_pieces)  # the same as a Bitfield, for SEQUENTIAL
+        self.partial = {}  # piece -> None for started pieces that still have unrequested blocks (insertion ordered)
+        self.in_flight = {}  # piece -> None for started pieces whose blocks are all requested but not all received
+        self.sequential_cursor = 0
+        for piece in range(storage.total_pieces):
+            if not storage.my_bitfield[piece]:
+                self.add_fresh(piece)
+                self.add_to_level(piece, 0)
+
+    # ---------------------------------------------------
+    # piece / block geometry
+    # ---------------------------------------------------
+
+    def piece_size(self, piece):
+        return min(self.storage.piece_length, self.total_length - piece * self.storage.piece_length)
+
+    def blocks_in_piece(self, piece):
+        return (self.piece_size(piece) + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    def block_size(self, piece, block):
+        return min(BLOCK_SIZE, self.piece_size(piece) - block * BLOCK_SIZE)
+
+    # ---------------------------------------------------
+    # availability index
+    # ---------------------------------------------------
+
+    def add_to_level(self, piece, count):
+        level = self.levels.get(count)
+        if level is None:
+            level = self.levels[count] = set()
+            self.level_masks[count] = Bitfield(self.storage.total_pieces)
+        level.add(piece)
+        self.level_masks[count][piece] = 1
+        if count not in self.in_heap:
+            self.in_heap.add(count)
+            heapq.heappush(self.level_heap, count)
+
+    def remove_from_level(self, piece, count):
+        self.levels[count].discard(piece)
+        self.level_masks[count][piece] = 0
+
+    def add_fresh(self, piece):
+        self.fresh.add(piece)
+        self.fresh_mask[piece] = 1
+
+    def remove_fresh(self, piece):
+        self.fresh.discard(piece)
+        self.fresh_mask[piece] = 0
+        self.remove_from_level(piece, self.availability[piece])
+
+    def move(self, piece, old, new):
+        if piece in self.fresh:
+            self.remove_from_level(piece, old)
+            self.add_to_level(piece, new)
+
+    def on_have(self, piece):
+        old = self.availability[piece]
+        self.availability.add_have(piece)
+        self.move(piece, old, old + 1)
+
+    def on_bitfield(self, bitfield):
+        for piece in bitfield.set_indices():
+            self.on_have(piece)
+
+    def on_peer_gone(self, bitfield):
+        if bitfield is None:
+            return
+        for piece in bitfield.set_indices():
+            old = self.availability[piece]
+            self.availability.remove_have(piece)
+            self.move(piece, old, old - 1)
+
+    # ---------------------------------------------------
+    # progress
+    # ---------------------------------------------------
+
+    def on_piece_complete(self, piece):
+        self.partial.pop(piece, None)
+        self.in_flight.pop(piece, None)
+        if piece in self.fresh:
+            self.remove_fresh(piece)
+
+    #hash check failed: the piece goes back to the pool, all its blocks are downloaded again
+    def on_piece_failed(self, piece):
+        self.partial.pop(piece, None)
+        self.in_flight.pop(piece, None)
+        self.storage.block_status.pop(piece, None)
+        self.add_fresh(piece)
+        self.add_to_level(piece, self.availability[piece])
+        self.sequential_cursor = min(self.sequential_cursor, piece)
+
+    #a request was cancelled / timed out / the peer choked us: the block can be requested again
+    def on_request_failed(self, piece, block):
+        blocks = self.storage.block_status.get(piece)
+        if blocks is None or blocks[block] != 1:
+            return
+        blocks[block] = 0
+        self.in_flight.pop(piece, None)
+        self.partial[piece] = None
+
+    @property
+    def endgame(self):
+        return not self.fresh and not self.partial and bool(self.in_flight)
+
+    # ---------------------------------------------------
+    # picking
+    # ---------------------------------------------------
+
+    def rarest_piece(self, peer_bitfield):
+        total = self.storage.total_pieces
+        if not total:
+            return None
+        has = peer_bitfield.as_int()
+        start = random.randrange(total)
+        popped = []
+        picked = None
+        while self.level_heap:
+            count = heapq.heappop(self.level_heap)
+            level = self.levels.get(count)
+            if not level:
+                self.in_heap.discard(count)
+                continue
+            popped.append(count)
+            if count == 0:
+                continue  # nobody has these
+            hits = self.level_masks[count].as_int() & has
+            if hits:
+                #the first one at or after a random index (wrapping around), so peers spread out
+                picked = first_set_index(hits, total, start)
+                if picked < 0:
+                    picked = first_set_index(hits, total)
+                break
+        for count in popped:
+            heapq.heappush(self.level_heap, count)
+        return picked
+
+    def sequential_piece(self, peer_bitfield):
+        total = self.storage.total_pieces
+        fresh = self.fresh_mask.as_int()
+        if self.sequential_cursor < total:
+            cursor = first_set_index(fresh, total, self.sequential_cursor)
+            self.sequential_cursor = total if cursor < 0 else cursor
+        if self.sequential_cursor >= total:
+            return None
+        piece = first_set_index(fresh & peer_bitfield.as_int(), total, self.sequential_cursor)
+        return None if piece < 0 else piece
+
+    def start_piece(self, piece):
+        self.remove_fresh(piece)
+        self.storage.initialize_piece(piece, self.blocks_in_piece(piece))
+        self.partial[piece] = None
+
+    def next_free_block(self, piece):
+        blocks = self.storage.block_status[piece]
+        block = blocks.find(0)
+        if block < 0:
+            #every block got requested elsewhere or arrived after its request was dropped
+            del self.partial[piece]
+            self.in_flight[piece] = None
+            return None
+        self.storage.mark_block_requested(piece, block)
+        if blocks.find(0) < 0:
+            del self.partial[piece]
+            self.in_flight[piece] = None
+        return piece, block, self.block_size(piece, block)
+
+    #(piece, block, length) to request from a peer with this bitfield, None if it has nothing we need.
+    #exclude = {(piece, block)} already requested from this peer (only matters in endgame)
+    def pick_block(self, peer_bitfield, exclude=()):
+        #started pieces first (lowest index first in SEQUENTIAL mode)
+        started = sorted(self.partial) if self.mode == SEQUENTIAL else self.partial
+        for piece in list(started):
+            if peer_bitfield[piece]:
+                pick = self.next_free_block(piece)
+                if pick is not None:
+                    return pick
+
+        if self.mode == SEQUENTIAL:
+            piece = self.sequential_piece(peer_bitfield)
+        else:
+            piece = self.rarest_piece(peer_bitfield)
+        if piece is not None:
+            self.start_piece(piece)
+            return self.next_free_block(piece)
+
+        if self.endgame:
+            return self.endgame_block(peer_bitfield, exclude)
+        return None
+
+    def endgame_block(self, peer_bitfield, exclude):
+        for piece in self.in_flight:
+            if not peer_bitfield[piece]:
+                continue
+            blocks = self.storage.block_status[piece]
+            for block, state in enumerate(blocks):
+                if state == 1 and (piece, block) not in exclude:
+                    return piece, block, self.block_size(piece, block)
+        return None
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#Piece verification for Storage.
+#hashlib drops the GIL while hashing anything bigger than 2 KiB, so a plain thread pool hashes on every core.
+
+HASH_LENGTH = 20
+
+
+#the torrent's pieces blob seen as a list of 20 byte SHA1 digests, without copying it
+class PieceHashes:
+    def __init__(self, pieces):
+        self.view = memoryview(pieces)
+        if self.view.nbytes % HASH_LENGTH:
+            raise ValueError("pieces blob is not a multiple of 20 bytes")
+        self.count = self.view.nbytes // HASH_LENGTH
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("piece index out of range")
+        start = index * HASH_LENGTH
+        return self.view[start:start + HASH_LENGTH]
+
+
+class PieceVerifier:
+    def __init__(self, piece_hashes, workers=None):
+        self.piece_hashes = piece_hashes
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def verify(self, piece_index, data):
+        return hashlib.sha1(data).digest() == self.piece_hashes[piece_index]
+
+    #hashes on the pool, returns a Future[bool]
+    def submit(self, piece_index, data):
+        return self.pool.submit(self.verify, piece_index, data)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def recheck(self, files, piece_length, read_size=None):
+        """
+        files = [(path, length), ...] in torrent order (see TorrentFile.file_layout)
+        streams the files front to back in piece sized reads and hashes the pieces on the pool,
+        pieces can span file boundaries. missing or short files fail the pieces they cover.
+        returns a list of bools, one per piece
+        """
+        total_length = sum(length for _, length in files)
+        total_pieces = (total_length + piece_length - 1) // piece_length
+        results = [False] * total_pieces
+        #at most 2 pieces per worker are read ahead, that bounds memory to a few piece buffers
+        in_flight = threading.Semaphore(self.workers * 2)
+        buffers = [bytearray(piece_length) for _ in range(self.workers * 2)]
+        free_buffers = list(buffers)
+        lock = threading.Lock()
+
+        def hash_piece(piece_index, buffer, size):
+            try:
+                results[piece_index] = self.verify(piece_index, memoryview(buffer)[:size])
+            finally:
+                with lock:
+                    free_buffers.append(buffer)
+                in_flight.release()
+
+        futures = []
+        stream = ConcatenatedFiles(files)
+        try:
+            for piece_index in range(total_pieces):
+                size = min(piece_length, total_length - piece_index * piece_length)
+                in_flight.acquire()
+                with lock:
+                    buffer = free_buffers.pop()
+                complete = stream.readinto(memoryview(buffer)[:size])
+                if not complete:
+                    with lock:
+                        free_buffers.append(buffer)
+                    in_flight.release()
+                    continue
+                futures.append(self.pool.submit(hash_piece, piece_index, buffer, size))
+        finally:
+            stream.close()
+        for future in futures:
+            future.result()
+        return results
+
+
+#reads a list of files as if they were one stream
+class ConcatenatedFiles:
+    def __init__(self, files):
+        self.files = list(files)
+        self.file_index = 0
+        self.current = None
+        self.remaining = 0  # bytes left in the current file, according to the torrent
+
+    def open_next(self):
+        path, length = self.files[self.file_index]
+        self.file_index += 1
+        self.remaining = length
+        try:
+            self.current = open(path, "rb", buffering=0)
+        except OSError:
+            self.current = None
+
+    #fills view completely, False if part of it wasn't on disk (the stream stays in step either way)
+    def readinto(self, view):
+        complete = True
+        filled = 0
+        while filled < len(view):
+            if self.remaining == 0:
+                self.close()
+                self.open_next()
+                continue
+            want = min(len(view) - filled, self.remaining)
+            got = 0
+            if self.current is not None:
+                while got < want:
+                    n = self.current.readinto(view[filled + got:filled + want])
+                    if not n:
+                        break
+                    got += n
+            if got < want:
+                complete = False
+                if self.current is not None:
+                    self.current.close()
+                    self.current = None  # short file, the rest of it is missing
+            filled += want
+            self.remaining -= want
+        return complete
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
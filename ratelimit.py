@@ -0,0 +1,85 @@
+import asyncio
+import math
+import time
+
+#Bandwidth accounting shared by the peer wire engine and the choker.
+#
+#TokenBucket  caps a byte rate (one per peer and direction, plus global ones a whole swarm / session shares).
+#             taking more than is there puts the bucket in debt, the caller waits the debt off. that shapes traffic
+#             without splitting blocks and never starves a big message.
+#RateMeter    rolling transfer rate, an exponentially weighted moving average over a byte counter
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate  # bytes (or messages) per second, None = unlimited
+        self.burst = burst if burst is not None else rate  # most that can be spent at once after idling
+        self.clock = clock
+        self.tokens = self.burst or 0
+        self.stamp = clock()
+
+    def refill(self, now=None):
+        now = self.clock() if now is None else now
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    #takes amount (going into debt if needed), returns the seconds to wait before going on (0 = right away)
+    def take(self, amount, now=None):
+        if not self.rate:
+            return 0
+        self.refill(now)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    #takes amount only if it's all there, for dropping instead of waiting
+    def try_take(self, amount=1, now=None):
+        if not self.rate:
+            return True
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    async def wait(self, amount):
+        delay = self.take(amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+#the longest of the waits the buckets ask for (None entries = no limit)
+def take_all(buckets, amount):
+    delay = 0
+    for bucket in buckets:
+        if bucket is not None:
+            delay = max(delay, bucket.take(amount))
+    return delay
+
+
+class RateMeter:
+    def __init__(self, time_constant=5.0, clock=time.monotonic):
+        self.time_constant = time_constant  # seconds, how fast old traffic is forgotten
+        self.clock = clock
+        self.rate = 0.0  # bytes per second
+        self.total = 0
+        self.pending = 0  # bytes since the last tick
+        self.stamp = clock()
+
+    def add(self, amount):
+        self.pending += amount
+        self.total += amount
+
+    #folds the bytes since the last tick into the average, returns the rate
+    def tick(self, now=None):
+        now = self.clock() if now is None else now
+        elapsed = now - self.stamp
+        if elapsed <= 0:
+            return self.rate
+        weight = math.exp(-elapsed / self.time_constant)
+        self.rate = weight * self.rate + (1 - weight) * (self.pending / elapsed)
+        self.pending = 0
+        self.stamp = now
+        return self.rate
@@ -1,93 +1,309 @@
 import hashlib
+import mmap
+import os
 
 
 # ---------------------------------------------------
-# Simple Bencode Decoder
+# Bencode Decoder
 # ---------------------------------------------------
+# works on bytes, bytearray, mmap or memoryview without slicing the input per token.
+# strings of view_threshold bytes or more come back as memoryviews into the input (no copy),
+# shorter ones (keys, names, ids) as bytes.
+# for the top level dict the raw byte span of every value is recorded in .spans, so the info_hash
+# can be hashed straight from the original bytes. keys listed in lazy_keys are skipped over instead
+# of decoded (decode them later with decode_span).
+# lists / dicts nested deeper than max_depth are a ValueError, not a RecursionError halfway down the stack.
 
-def bdecode(data):
-    def decode_next(index):
-        if data[index:index+1] == b'i':
-            end = data.index(b'e', index)
-            number = int(data[index+1:end])
-            return number, end + 1
+MAX_DEPTH = 64  # metainfo files nest a few levels, this leaves plenty of room
 
-        elif data[index:index+1] == b'l':
+class BDecoder:
+    def __init__(self, data, view_threshold=None, lazy_keys=(), max_depth=MAX_DEPTH):
+        self.data = data
+        self.max_depth = max_depth
+        self.view = memoryview(data)
+        self.length = len(self.view)
+        self.view_threshold = view_threshold
+        self.lazy_keys = lazy_keys
+        self.spans = {}  # top level key -> (start, end)
+        if isinstance(data, memoryview):
+            self.data = self.view  # no .find(), fall back to scanning
+            self.find = self.scan
+
+    def find(self, byte, start):
+        index = self.data.find(byte, start)
+        if index < 0:
+            raise ValueError("Invalid bencode format")
+        return index
+
+    def scan(self, byte, start):
+        target = byte[0]
+        for index in range(start, self.length):
+            if self.view[index] == target:
+                return index
+        raise ValueError("Invalid bencode format")
+
+    def decode(self):
+        if not self.length:
+            raise ValueError("Invalid bencode format")
+        if self.view[0] == 0x64:  # 'd'
+            value, _ = self.decode_dict(0, 1, top_level=True)
+        else:
+            value, _ = self.decode_next(0)
+        return value
+
+    def decode_span(self, key):
+        start, end = self.spans[key]
+        value, _ = self.decode_next(start, 1)
+        return value
+
+    #depth = containers the value at index sits in
+    def decode_next(self, index, depth=0):
+        view = self.view
+        if index >= self.length:
+            raise ValueError("Invalid bencode format")
+        token = view[index]
+
+        if 0x30 <= token <= 0x39:  # string: <length>:<bytes>
+            colon = self.find(b':', index)
+            start = colon + 1
+            end = start + int(bytes(view[index:colon]))
+            if end > self.length:
+                raise ValueError("Invalid bencode format")
+            if self.view_threshold is not None and end - start >= self.view_threshold:
+                return view[start:end], end
+            return bytes(view[start:end]), end
+
+        elif token == 0x69:  # 'i'
+            end = self.find(b'e', index)
+            return int(bytes(view[index + 1:end])), end + 1
+
+        elif token == 0x6c:  # 'l'
+            if depth >= self.max_depth:
+                raise ValueError("bencode nested too deep")
             index += 1
             lst = []
-            while data[index:index+1] != b'e':
-                item, index = decode_next(index)
+            while index < self.length and view[index] != 0x65:
+                item, index = self.decode_next(index, depth + 1)
                 lst.append(item)
+            if index >= self.length:
+                raise ValueError("Invalid bencode format")
             return lst, index + 1
 
-        elif data[index:index+1] == b'd':
-            index += 1
-            dct = {}
-            while data[index:index+1] != b'e':
-                key, index = decode_next(index)
-                value, index = decode_next(index)
-                dct[key] = value
-            return dct, index + 1
-
-        elif data[index:index+1].isdigit():
-            colon = data.index(b':', index)
-            length = int(data[index:colon])
-            start = colon + 1
-            end = start + length
-            return data[start:end], end
+        elif token == 0x64:  # 'd'
+            if depth >= self.max_depth:
+                raise ValueError("bencode nested too deep")
+            return self.decode_dict(index, depth + 1)
 
-        else:
+        raise ValueError("Invalid bencode format")
+
+    #depth = containers the dict's values sit in (the dict itself included)
+    def decode_dict(self, index, depth, top_level=False):
+        view = self.view
+        index += 1
+        dct = {}
+        while index < self.length and view[index] != 0x65:
+            key, index = self.decode_next(index, depth)
+            if not isinstance(key, bytes):
+                key = bytes(key)
+            start = index
+            if top_level and key in self.lazy_keys:
+                index = self.skip_next(index, depth)
+                dct[key] = None
+            else:
+                dct[key], index = self.decode_next(index, depth)
+            if top_level:
+                self.spans[key] = (start, index)
+        if index >= self.length:
             raise ValueError("Invalid bencode format")
+        return dct, index + 1
+
+    #end index of the value at index, without building it
+    def skip_next(self, index, depth=0):
+        view = self.view
+        if index >= self.length:
+            raise ValueError("Invalid bencode format")
+        token = view[index]
+        if 0x30 <= token <= 0x39:
+            colon = self.find(b':', index)
+            end = colon + 1 + int(bytes(view[index:colon]))
+            if end > self.length:
+                raise ValueError("Invalid bencode format")
+            return end
+        elif token == 0x69:
+            return self.find(b'e', index) + 1
+        elif token == 0x6c or token == 0x64:
+            if depth >= self.max_depth:
+                raise ValueError("bencode nested too deep")
+            index += 1
+            while index < self.length and view[index] != 0x65:
+                index = self.skip_next(index, depth + 1)
+            if index >= self.length:
+                raise ValueError("Invalid bencode format")
+            return index + 1
+        raise ValueError("Invalid bencode format")
 
-    decoded, _ = decode_next(0)
-    return decoded
+
+def bdecode(data, view_threshold=None, max_depth=MAX_DEPTH):
+    return BDecoder(data, view_threshold, max_depth=max_depth).decode()
 
 
 # ---------------------------------------------------
-# Torrent Reader
+# Bencode Encoder (info_hash + KRPC messages + metainfo)
 # ---------------------------------------------------
+# everything is appended to one growing bytearray, so encoding is linear in the output size.
+# with a file object the buffer is written out every flush_size bytes and large strings
+# (e.g. the pieces blob) go straight to the file, so big metainfo never sits in memory twice.
+
+FLUSH_SIZE = 1 << 16
+
+
+class BEncoder:
+    def __init__(self, fp=None, flush_size=FLUSH_SIZE):
+        self.fp = fp
+        self.flush_size = flush_size
+        self.out = bytearray()
+
+    def encode(self, obj):
+        out = self.out
+        write = out.extend
+        fp = self.fp
+        flush_size = self.flush_size
+
+        def encode_next(obj):
+            kind = type(obj)
+            if kind is bytes and len(obj) < flush_size:
+                write(b'%d:%s' % (len(obj), obj))
+            elif kind is int:
+                write(b'i%de' % obj)
+            elif kind is dict:
+                write(b'd')
+                # keys are sorted as raw bytes
+                if all(type(key) is bytes for key in obj):
+                    items = sorted(obj.items())
+                else:
+                    items = sorted((key.encode() if isinstance(key, str) else bytes(key), value)
+                                   for key, value in obj.items())
+                for key, value in items:
+                    write(b'%d:%s' % (len(key), key))
+                    encode_next(value)
+                write(b'e')
+                if fp is not None and len(out) >= flush_size:
+                    self.flush()
+            elif kind is list or kind is tuple:
+                write(b'l')
+                for item in obj:
+                    encode_next(item)
+                write(b'e')
+                if fp is not None and len(out) >= flush_size:
+                    self.flush()
+            elif isinstance(obj, (bytes, bytearray, memoryview)):
+                length = obj.nbytes if isinstance(obj, memoryview) else len(obj)
+                write(b'%d:' % length)
+                if fp is not None and length >= flush_size:
+                    self.flush()
+                    fp.write(obj)
+                else:
+                    write(obj)
+            elif isinstance(obj, str):
+                encode_next(obj.encode())
+            elif isinstance(obj, int):
+                write(b'i%de' % obj)
+            elif isinstance(obj, (list, tuple)):
+                encode_next(list(obj))
+            else:
+                raise TypeError("Unsupported type")
+
+        encode_next(obj)
+        if fp is not None and len(out) >= flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.out:
+            self.fp.write(self.out)
+            self.out.clear()
+
+
+def bencode(obj):
+    encoder = BEncoder()
+    encoder.encode(obj)
+    return bytes(encoder.out)
+
+
+#streams the encoding of obj into a binary file object
+def bencode_to(obj, fp, flush_size=FLUSH_SIZE):
+    encoder = BEncoder(fp, flush_size)
+    encoder.encode(obj)
+    encoder.flush()
+
+
+# strings at least this long (the pieces blob) stay views into the mapped file
+VIEW_THRESHOLD = 4096
+
 
 class TorrentFile:
     def __init__(self, filepath):
         with open(filepath, "rb") as f:
-            self.raw_data = f.read()
+            try:
+                self.raw_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file can't be mapped
+                self.raw_data = f.read()
 
-        self.meta = bdecode(self.raw_data)
+        # the info dict is only walked over here, it gets decoded the first time something in it is used
+        self.decoder = BDecoder(self.raw_data, VIEW_THRESHOLD, lazy_keys=(b'info',))
+        self.meta = self.decoder.decode()
+        if b'info' not in self.decoder.spans:
+            raise ValueError("torrent has no info dict")
 
         self.announce = self.meta.get(b'announce', b'').decode()
-        self.info = self.meta[b'info']
 
-        # Compute info_hash (SHA1 of bencoded info dict)
-        self.info_hash = hashlib.sha1(self._bencode(self.info)).hexdigest()
+        # info_hash is the SHA1 of the info dict exactly as it is in the file (not a re-encoding of it)
+        start, end = self.decoder.spans[b'info']
+        self.info_hash = hashlib.sha1(self.decoder.view[start:end]).hexdigest()
+        self._info = None
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = self.decoder.decode_span(b'info')
+            self.meta[b'info'] = self._info
+        return self._info
+
+    @property
+    def name(self):
+        return self.info.get(b'name', b'').decode()
+
+    @property
+    def piece_length(self):
+        return self.info.get(b'piece length')
 
-        self.name = self.info.get(b'name', b'').decode()
-        self.piece_length = self.info.get(b'piece length')
-        self.pieces = self.info.get(b'pieces')
+    @property
+    def pieces(self):
+        return self.info.get(b'pieces')
 
+    @property
+    def length(self):
+        return self.info.get(b'length')
+
+    @property
+    def files(self):
         if b'length' in self.info:
-            self.length = self.info[b'length']
-            self.files = None
-        else:
-            self.length = None
-            self.files = self.info.get(b'files')
-
-    # Minimal bencode encoder (needed to compute info_hash)
-    def _bencode(self, obj):
-        if isinstance(obj, int):
-            return b'i' + str(obj).encode() + b'e'
-        elif isinstance(obj, bytes):
-            return str(len(obj)).encode() + b':' + obj
-        elif isinstance(obj, list):
-            return b'l' + b''.join(self._bencode(x) for x in obj) + b'e'
-        elif isinstance(obj, dict):
-            result = b'd'
-            for key in sorted(obj.keys()):
-                result += self._bencode(key)
-                result += self._bencode(obj[key])
-            result += b'e'
-            return result
-        else:
-            raise TypeError("Unsupported type")
+            return None
+        return self.info.get(b'files')
+
+    @property
+    def total_length(self):
+        if self.length is not None:
+            return self.length
+        return sum(f[b'length'] for f in self.files)
+
+    # [(path, length), ...] of the torrent's files under base_dir, in the order the pieces run through them
+    def file_layout(self, base_dir="."):
+        if self.files is None:
+            return [(os.path.join(base_dir, self.name), self.length)]
+        return [
+            (os.path.join(base_dir, self.name, *(part.decode() for part in f[b'path'])), f[b'length'])
+            for f in self.files
+        ]
 
     def print_summary(self):
         print("\n--- Torrent Info ---")
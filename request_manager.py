@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+#Outstanding block requests of a swarm, ordered by deadline.
+#
+#every request sent (PeerWire.fill_requests) is pushed on a heap as (deadline, seq, wire, piece, block, sent_at).
+#answered / cancelled / choked requests are not removed from the heap: they are recognised and skipped when they
+#come up, because PeerConnection.pending_requests no longer holds the same sent_at. expiring is O(log n) per
+#request and never scans the requests that are still fine.
+#
+#deadlines come from each peer's measured request round trip (RFC 6298 style smoothed RTT + 4 * variance),
+#doubled after every timeout. an expired request is cancelled, its block freed for the other peers, and those
+#peers are topped up before the slow one.
+#
+#endgame: once the picker has nothing left but blocks in flight, every peer with a free pipeline slot gets
+#duplicate requests (PiecePicker.endgame_block), the first copy to arrive cancels the others (Swarm.block_done),
+#and deadlines are halved so a stalled peer loses its blocks sooner.
+
+INITIAL_TIMEOUT = 15  # seconds, before a peer delivered anything
+MIN_TIMEOUT = 2
+MAX_TIMEOUT = 60
+ENDGAME_FACTOR = 0.5
+TICK = 0.5
+COMPACT_RATIO = 4  # rebuild the heap when it holds this many times more entries than live requests
+
+
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_TIMEOUT
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.srtt + 4 * self.rttvar))
+
+    def on_timeout(self):
+        self.rto = min(MAX_TIMEOUT, self.rto * 2)
+
+
+class RequestManager:
+    def __init__(self, swarm, clock=time.monotonic):
+        self.swarm = swarm
+        self.clock = clock
+        self.heap = []
+        self.seq = itertools.count()
+        self.timeouts = 0
+        self.in_endgame = False
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = self.swarm.spawn(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(TICK)
+            self.tick()
+
+    def track(self, wire, piece, block, sent_at):
+        timeout = wire.rtt.rto
+        if self.in_endgame:
+            timeout = max(MIN_TIMEOUT, timeout * ENDGAME_FACTOR)
+        heapq.heappush(self.heap, (sent_at + timeout, next(self.seq), wire, piece, block, sent_at))
+
+    #a block arrived for a request sent at sent_at
+    def on_answer(self, wire, sent_at, now=None):
+        now = self.clock() if now is None else now
+        wire.rtt.sample(now - sent_at)
+
+    def tick(self, now=None):
+        now = self.clock() if now is None else now
+        self.expire(now)
+        endgame = self.swarm.picker.endgame
+        if endgame and not self.in_endgame:
+            #every peer gets duplicates of what is still in flight, not only those that happen to receive a block
+            for wire in list(self.swarm.connections):
+                wire.fill_requests()
+        self.in_endgame = endgame
+        live = sum(len(wire.peer.pending_requests) for wire in self.swarm.connections)
+        if len(self.heap) > COMPACT_RATIO * live + 1024:
+            self.compact()
+
+    #drops the entries of requests that were answered / cancelled, they pile up on fast links
+    def compact(self):
+        self.heap = [
+            entry for entry in self.heap if entry[2].peer.pending_requests.get((entry[3], entry[4])) == entry[5]
+        ]
+        heapq.heapify(self.heap)
+
+    def expire(self, now):
+        heap = self.heap
+        slow = set()
+        while heap and heap[0][0] <= now:
+            _, _, wire, piece, block, sent_at = heapq.heappop(heap)
+            if wire.peer.pending_requests.get((piece, block)) != sent_at:
+                continue  # answered, cancelled, dropped or re-requested since
+            wire.cancel(piece, block)
+            if wire not in slow:
+                wire.rtt.on_timeout()  # once per tick, a whole stalled pipeline counts as one timeout
+                slow.add(wire)
+            self.timeouts += 1
+            self.swarm.release(piece, block, wire)
+        if slow:
+            #the freed blocks go to the peers that are keeping up first
+            for wire in list(self.swarm.connections):
+                if wire not in slow:
+                    wire.fill_requests()
+            for wire in slow:
+                wire.fill_requests()
+
+    def __len__(self):
+        return len(self.heap)
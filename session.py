@@ -0,0 +1,247 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_dht import AsyncNode
+from choker import Choker
+from connection_manager import ConnectionBudget, ConnectionManager, MAX_CONNECTIONS
+from peer_protocol import PeerWire, Swarm, generate_peer_id
+from ratelimit import TokenBucket
+
+#Many torrents behind one set of sockets and threads.
+#
+#a Session owns what a seedbox must not multiply per torrent:
+#  - one AsyncNode (one UDP socket, one routing table) announcing every torrent
+#  - one TCP listener on the same port number. incoming handshakes are routed to the right Swarm by info_hash
+#    (PeerWire's lookup_swarm), so a peer found through our DHT announce reaches us on the port it was told
+#  - one peer id
+#  - one thread pool for hashing and disk reads, shared by every Swarm (Swarm.executor)
+#  - one ConnectionBudget (file descriptors) shared by every ConnectionManager and the listener: an incoming
+#    handshake takes a slot too (and counts against its torrent's max_connections), or the connection is refused
+#  - one upload and one download TokenBucket shared by every Swarm, so the limits hold for the whole session
+#
+#announces are batched: one task walks all active info hashes every announce_interval, at most
+#announce_concurrency lookups at a time, each one a single get_peers walk that also yields the announce targets
+#(AsyncNode.get_peers_and_announce). torrents added in between are picked up by a short extra round, together.
+#with thousands of torrents that is a steady trickle of DHT traffic instead of a burst per timer.
+#
+#   session = Session("0.0.0.0", 6881, bootstrap_nodes=[("router.example", 6881)], upload_limit=10 << 20)
+#   await session.start()
+#   swarm = session.add_torrent(info_hash, storage, picker)       peers come from the DHT and incoming connections
+#   await swarm.wait_complete()
+#   await session.close()
+
+ANNOUNCE_INTERVAL = 15 * 60  # half of PeerStore's PEER_TTL, announces never lapse
+ANNOUNCE_CONCURRENCY = 8  # lookups in flight at once during a round
+NEW_TORRENT_DELAY = 2  # seconds torrents added close together wait, so they share one round
+DISK_WORKERS = 8
+
+
+class SessionTorrent:
+    def __init__(self, swarm, manager, choker):
+        self.swarm = swarm
+        self.manager = manager
+        self.choker = choker
+        self.dht_id = int.from_bytes(swarm.info_hash, "big")
+        self.active = True  # announced and dialing, False = paused
+        self.last_announce = None  # time of the last announce that reached at least one node
+        self.peers_found = 0
+        self.announce_failures = 0  # announces that raised, retried with the next round
+
+
+class Session:
+    def __init__(self, host="0.0.0.0", port=0, bootstrap_nodes=None, codec="json", peer_id=None,
+                 max_connections=MAX_CONNECTIONS * 10, upload_limit=None, download_limit=None,
+                 disk_workers=DISK_WORKERS, announce_interval=ANNOUNCE_INTERVAL,
+                 announce_concurrency=ANNOUNCE_CONCURRENCY, snapshot_path=None, metrics=None, clock=time.monotonic):
+        self.host = host
+        self.peer_id = peer_id or generate_peer_id()
+        self.node = AsyncNode(host, port, bootstrap_nodes, codec, snapshot_path=snapshot_path, metrics=metrics)
+        self.port = self.node.port  # the TCP listener takes the same number
+        self.metrics = self.node.metrics
+        self.budget = ConnectionBudget(max_connections)
+        #bytes per second for the whole session, None = unlimited
+        self.upload_bucket = TokenBucket(upload_limit) if upload_limit else None
+        self.download_bucket = TokenBucket(download_limit) if download_limit else None
+        self.disk_pool = ThreadPoolExecutor(max_workers=disk_workers, thread_name_prefix="disk")
+        self.announce_interval = announce_interval
+        self.announce_concurrency = announce_concurrency
+        self.clock = clock
+        self.torrents = {}  # info_hash (20 bytes) -> SessionTorrent
+        self.unannounced = set()  # info hashes added since the last round
+        self.wakeup = asyncio.Event()
+        self.server = None
+        self.tasks = set()
+        self.announces = 0  # announce lookups run, for stats / tests
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await self.node.start()
+        self.server = await loop.create_server(
+            lambda: PeerWire(None, None, lookup_swarm=self.lookup_swarm, accept=self.accept_incoming),
+            self.host, self.port
+        )
+        self.spawn(self.run())
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    #incoming handshakes: the Swarm of an active torrent, None closes the connection
+    def lookup_swarm(self, info_hash):
+        torrent = self.torrents.get(info_hash)
+        if torrent is None or not torrent.active:
+            return None
+        return torrent.swarm
+
+    #an incoming handshake for an active torrent: takes a budget slot, given back when the connection is lost
+    def accept_incoming(self, wire, swarm):
+        torrent = self.torrents.get(swarm.info_hash)
+        if torrent is None:
+            return False
+        if self.budget.available() <= 0:
+            self.metrics.inc("peer_incoming_refused_total", reason="budget")
+            return False
+        if torrent.manager.connection_count() >= torrent.manager.max_connections:
+            self.metrics.inc("peer_incoming_refused_total", reason="torrent_full")
+            return False
+        self.budget.take()
+        wire.release = lambda: self.release_incoming(torrent)
+        return True
+
+    def release_incoming(self, torrent):
+        self.budget.give()
+        torrent.manager.wakeup.set()  # room to dial again
+
+    def add_torrent(self, info_hash, storage, picker, choke=True, max_connections=MAX_CONNECTIONS, **swarm_options):
+        """
+        starts sharing a torrent (storage + picker as for a Swarm), returns its Swarm.
+        max_connections caps this torrent's peers, dialed and incoming, within the session's budget.
+        swarm_options go to Swarm (queue_depth, peer_upload_limit, ...), the session wide limits are always shared
+        """
+        if info_hash in self.torrents:
+            raise ValueError("torrent already in the session")
+        swarm = Swarm(info_hash, storage, picker, peer_id=self.peer_id, metrics=self.metrics,
+                      executor=self.disk_pool, **swarm_options)
+        swarm.upload_bucket = self.upload_bucket
+        swarm.download_bucket = self.download_bucket
+        manager = ConnectionManager(swarm, max_connections=max_connections, budget=self.budget,
+                                    own_addresses=self.own_addresses())
+        manager.start()
+        choker = None
+        if choke:
+            choker = swarm.choker = Choker(swarm)
+            choker.start()
+        self.torrents[info_hash] = SessionTorrent(swarm, manager, choker)
+        self.unannounced.add(info_hash)
+        self.wakeup.set()
+        return swarm
+
+    def remove_torrent(self, info_hash):
+        torrent = self.torrents.pop(info_hash)
+        self.unannounced.discard(info_hash)
+        torrent.manager.stop()
+        torrent.swarm.close()
+
+    #a paused torrent is neither announced nor dialing, incoming connections for it are refused
+    def pause(self, info_hash):
+        torrent = self.torrents[info_hash]
+        torrent.active = False
+        torrent.manager.stop()
+        for wire in list(torrent.swarm.connections):
+            wire.close("paused")
+
+    def resume(self, info_hash):
+        torrent = self.torrents[info_hash]
+        torrent.active = True
+        torrent.manager.start()
+        self.unannounced.add(info_hash)
+        self.wakeup.set()
+
+    #addresses DHT results may list for ourselves
+    def own_addresses(self):
+        addresses = {(self.host, self.port)}
+        if self.host in ("0.0.0.0", ""):
+            addresses.add(("127.0.0.1", self.port))
+        return addresses
+
+    #peers from the DHT / trackers for one torrent
+    def add_peers(self, info_hash, peers):
+        torrent = self.torrents.get(info_hash)
+        if torrent is not None and torrent.active:
+            torrent.manager.add_peers(peers)
+
+    # ---------------------------------------------------
+    # DHT announces
+    # ---------------------------------------------------
+
+    async def run(self):
+        await self.node.bootstrap()
+        next_round = self.clock()
+        while True:
+            now = self.clock()
+            if now >= next_round:
+                self.unannounced.clear()
+                await self.announce_round(list(self.torrents))
+                next_round = self.clock() + self.announce_interval * random.uniform(0.9, 1.1)
+            elif self.unannounced:
+                #new torrents: give others added right after them a moment to join the same round
+                await asyncio.sleep(NEW_TORRENT_DELAY)
+                batch = list(self.unannounced)
+                self.unannounced.clear()
+                await self.announce_round(batch)
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0, next_round - self.clock()))
+            except asyncio.TimeoutError:
+                pass
+
+    #announces the given torrents (the active ones), announce_concurrency at a time, returns how many got through
+    async def announce_round(self, info_hashes):
+        torrents = [self.torrents[h] for h in info_hashes if h in self.torrents and self.torrents[h].active]
+        #neighbouring ids walk through the same part of the id space, consecutive lookups find the nodes they
+        #need already in the routing table
+        torrents.sort(key=lambda torrent: torrent.dht_id)
+        limit = asyncio.Semaphore(self.announce_concurrency)
+
+        async def announce(torrent):
+            async with limit:
+                return await self.announce(torrent)
+
+        results = await asyncio.gather(*(announce(torrent) for torrent in torrents))
+        return sum(results)
+
+    #one torrent's announce. a failure is counted and left for the next round, it never stops the loop that
+    #announces every other torrent
+    async def announce(self, torrent):
+        self.announces += 1
+        try:
+            peers, accepted = await self.node.get_peers_and_announce(torrent.dht_id)
+        except Exception as error:
+            torrent.announce_failures += 1
+            self.metrics.inc("session_announce_failures_total", error=type(error).__name__)
+            return False
+        if peers:
+            torrent.peers_found += len(peers)
+            self.add_peers(torrent.swarm.info_hash, peers)
+        if accepted:
+            torrent.last_announce = self.clock()
+        return bool(accepted)
+
+    # ---------------------------------------------------
+    # shutdown
+    # ---------------------------------------------------
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        for info_hash in list(self.torrents):
+            self.remove_torrent(info_hash)
+        if self.server is not None:
+            self.server.close()
+        self.node.close()
+        self.disk_pool.shutdown(wait=False)
@@ -0,0 +1,56 @@
+#testing code for the asyncio DHT node (async_dht.py)
+import asyncio
+import random
+import time
+
+from async_dht import AsyncNode
+
+NUM_NODES = 20
+
+
+async def main():
+    print("\n=== CREATING ASYNC NODES ===")
+    nodes = [AsyncNode("127.0.0.1", 0, codec="bencode", rpc_timeout=0.5) for _ in range(NUM_NODES)]
+    for node in nodes:
+        await node.start()
+
+    # every node bootstraps off node 0 plus three random others, dense enough that any node is reachable
+    for node in nodes[1:]:
+        others = random.sample(nodes, 3)
+        node.bootstrap_nodes = [("127.0.0.1", nodes[0].port)] + [("127.0.0.1", other.port) for other in others]
+        await node.bootstrap()
+
+    print("\n=== TEST 1: LOOKUP ===")
+    target = random.choice(nodes[:-1])
+    start = time.time()
+    result = await nodes[-1].iterative_find_node(target.node_id)
+    print("lookup took %.3fs" % (time.time() - start))
+    assert result, "lookup returned no nodes"
+    assert result[0][0] == target.node_id, "lookup missed the target"
+
+    print("\n=== TEST 2: ANNOUNCE + GET_PEERS ===")
+    info_hash = random.getrandbits(160)
+    announcer = random.choice(nodes)
+    closest = await announcer.iterative_find_node(info_hash)
+    await asyncio.gather(*(
+        announcer.announce_peer(node_id, ip, port, info_hash) for node_id, ip, port, *_ in closest
+    ))
+    found = await random.choice(nodes).iterative_get_peers(info_hash)
+    found = set(tuple(p) for p in found)
+    print("Peers found:", found)
+    assert ("127.0.0.1", announcer.port) in found
+
+    print("\n=== TEST 3: TIMEOUT ON DEAD NODE ===")
+    dead = nodes.pop()
+    dead.close()
+    start = time.time()
+    assert await nodes[0].ping(None, "127.0.0.1", dead.port) is None
+    assert not nodes[0].pending, "timed out transaction was not cleaned up"
+    print("dead node timed out after %.3fs" % (time.time() - start))
+
+    for node in nodes:
+        node.close()
+    print("\n=== TEST COMPLETE ===")
+
+
+asyncio.run(main())
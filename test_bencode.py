@@ -0,0 +1,85 @@
+#testing code for the bencode decoder/encoder in read_torrent.py
+import hashlib
+import io
+import os
+import random
+import tempfile
+
+from read_torrent import bdecode, bencode, bencode_to, BDecoder, TorrentFile
+
+
+def random_value(depth=0):
+    r = random.random()
+    if depth > 3 or r < 0.3:
+        return random.randint(-10 ** 12, 10 ** 12)
+    if r < 0.6:
+        return os.urandom(random.randint(0, 20))
+    if r < 0.8:
+        return [random_value(depth + 1) for _ in range(random.randint(0, 4))]
+    return {os.urandom(random.randint(0, 5)): random_value(depth + 1) for _ in range(random.randint(0, 4))}
+
+
+print("\n=== TEST 1: DECODE ROUND TRIP (bytes, bytearray, memoryview) ===")
+for _ in range(1000):
+    value = random_value()
+    encoded = bencode(value)
+    assert bdecode(encoded) == value
+    assert bdecode(bytearray(encoded)) == value
+    assert bdecode(memoryview(encoded)) == value
+print("ok")
+
+print("\n=== TEST 2: MALFORMED INPUT ===")
+for bad in (b"", b"i12", b"l", b"5:abc", b"d3:foo", b"x", b"li1e", b"l" * 5000 + b"e" * 5000):
+    try:
+        bdecode(bad)
+    except ValueError:
+        continue
+    raise AssertionError("accepted %r" % bad)
+print("ok")
+
+print("\n=== TEST 3: LARGE STRINGS ARE VIEWS, SPANS ARE RAW BYTES ===")
+blob = os.urandom(10000)
+data = b"d4:infod6:pieces10000:" + blob + b"4:name1:xe1:zi1ee"
+decoder = BDecoder(data, view_threshold=4096)
+meta = decoder.decode()
+assert isinstance(meta[b"info"][b"pieces"], memoryview) and meta[b"info"][b"pieces"] == blob
+assert isinstance(meta[b"info"][b"name"], bytes)
+start, end = decoder.spans[b"info"]
+assert data[start:end] == b"d6:pieces10000:" + blob + b"4:name1:xe"
+lazy = BDecoder(data, lazy_keys=(b"info",))
+assert lazy.decode() == {b"info": None, b"z": 1}
+assert lazy.decode_span(b"info")[b"pieces"] == blob
+print("ok")
+
+print("\n=== TEST 4: INFO_HASH OF A NON-CANONICAL TORRENT ===")
+#keys of the info dict out of sorted order, re-encoding would change the hash
+info = b"d4:name3:abc12:piece lengthi16384e6:lengthi5e6:pieces20:" + b"\x01" * 20 + b"e"
+with tempfile.NamedTemporaryFile(suffix=".torrent", delete=False) as f:
+    f.write(b"d8:announce3:url4:info" + info + b"e")
+torrent = TorrentFile(f.name)
+assert torrent.info_hash == hashlib.sha1(info).hexdigest()
+assert torrent.name == "abc" and torrent.length == 5 and torrent.piece_length == 16384
+os.unlink(f.name)
+print("ok")
+
+print("\n=== TEST 5: ENCODER ===")
+assert bencode({b"b": 1, "a": [b"x", "y", -3], b"c": memoryview(b"zz")}) == b"d1:al1:x1:yi-3ee1:bi1e1:c2:zze"
+assert bencode(b"") == b"0:" and bencode([]) == b"le" and bencode({}) == b"de" and bencode(0) == b"i0e"
+try:
+    bencode(1.5)
+    raise AssertionError("encoded a float")
+except TypeError:
+    pass
+torrent = TorrentFile("ubuntu-25.10-desktop-amd64.iso.torrent")
+start, end = torrent.decoder.spans[b"info"]
+assert bencode(torrent.info) == bytes(torrent.raw_data[start:end])
+print("ok")
+
+print("\n=== TEST 6: STREAMING TO A FILE ===")
+big = {b"files": [{b"length": i, b"path": [b"dir", b"file%d" % i]} for i in range(5000)],
+       b"pieces": os.urandom(200000)}
+stream = io.BytesIO()
+bencode_to(big, stream, flush_size=4096)
+assert stream.getvalue() == bencode(big)
+assert bdecode(stream.getvalue()) == big
+print("ok")
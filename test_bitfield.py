@@ -0,0 +1,73 @@
+#testing code for bit packed bitfields and availability counts (bitfield.py)
+import random
+import time
+
+from bitfield import Bitfield, Availability
+from core import Storage
+
+print("\n=== TEST 1: WIRE FORMAT ===")
+bitfield = Bitfield(10)
+bitfield[0] = 1
+bitfield[9] = 1
+assert bitfield.to_bytes() == b"\x80\x40"
+assert Bitfield(10, b"\x80\x40") == bitfield
+assert list(bitfield) == [1, 0, 0, 0, 0, 0, 0, 0, 0, 1]
+for bad in (b"\x80", b"\x80\x41"):  # wrong size, spare bit set
+    try:
+        Bitfield(10, bad)
+        raise AssertionError("accepted %r" % bad)
+    except ValueError:
+        pass
+assert Bitfield.full(10).to_bytes() == b"\xff\xc0" and Bitfield.full(10).is_complete()
+print("ok")
+
+print("\n=== TEST 2: SET OPERATIONS MATCH PER-PIECE LISTS ===")
+n = 1001
+mine_list = [random.random() < 0.5 for _ in range(n)]
+peer_list = [random.random() < 0.5 for _ in range(n)]
+mine, peer = Bitfield(n), Bitfield(n)
+for i in range(n):
+    mine[i] = mine_list[i]
+    peer[i] = peer_list[i]
+wanted = [i for i in range(n) if peer_list[i] and not mine_list[i]]
+assert list((peer - mine).set_indices()) == wanted
+assert peer.has_missing_from(mine) == bool(wanted)
+assert (peer & mine).count() == sum(a and b for a, b in zip(peer_list, mine_list))
+assert (peer | mine).count() == sum(a or b for a, b in zip(peer_list, mine_list))
+assert not mine.has_missing_from(mine | peer)
+print("ok")
+
+print("\n=== TEST 3: AVAILABILITY ===")
+availability = Availability(n)
+availability.add_bitfield(peer)
+availability.add_bitfield(mine)
+availability.add_have(0)
+assert [availability[i] for i in range(1, n)] == [int(peer_list[i]) + int(mine_list[i]) for i in range(1, n)]
+availability.remove_bitfield(peer)
+assert [availability[i] for i in range(1, n)] == [int(mine_list[i]) for i in range(1, n)]
+print("ok")
+
+print("\n=== TEST 4: STORAGE BLOCK STATE ===")
+storage = Storage(4, 64 * 1024, None)
+storage.initialize_piece(2, 4)
+storage.mark_block_requested(2, 0)
+for block in (0, 1, 1, 2):
+    storage.mark_block_received(2, block)
+assert not storage.is_piece_complete(2)
+storage.mark_block_received(2, 3)
+assert storage.is_piece_complete(2)
+assert storage.block_status[2] == bytearray([2, 2, 2, 2])
+peer = Bitfield(4, b"\xa0")
+assert list(storage.wanted_from(peer).set_indices()) == [0, 2]
+print("ok")
+
+print("\n=== TEST 5: SPEED, 300k PIECES ===")
+n = 300000
+mine = Bitfield.from_int(n, random.getrandbits(n))  # n is a multiple of 8, no spare bits
+peer = Bitfield.full(n)
+start = time.perf_counter()
+for _ in range(100):
+    peer.has_missing_from(mine)
+    mine.count()
+print("interested check + count: %.1f us" % ((time.perf_counter() - start) / 100 * 1e6))
+print("bitfield size: %d bytes (a list of ints would be %d bytes)" % (len(mine.bits), 8 * n))
@@ -0,0 +1,96 @@
+#testing code for the choker (choker.py)
+import random
+
+from bitfield import Bitfield
+from choker import Choker
+from core import PeerConnection
+from peer_protocol import Swarm
+from ratelimit import RateMeter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeWire:
+    def __init__(self, clock, connected_at):
+        self.peer = PeerConnection("10.0.0.%d" % random.randint(1, 254), 6881)
+        self.peer.peer_interested = True
+        self.connected_at = connected_at
+        self.download_meter = RateMeter(clock=clock)
+        self.upload_meter = RateMeter(clock=clock)
+
+    def choke(self):
+        self.peer.am_choking = True
+
+    def unchoke(self):
+        self.peer.am_choking = False
+
+
+class FakeSwarm:
+    def __init__(self, pieces_owned):
+        self.connections = set()
+        self.storage = type("Storage", (), {})()
+        self.storage.my_bitfield = Bitfield(10)
+        for piece in range(pieces_owned):
+            self.storage.my_bitfield[piece] = 1
+
+    update_rates = Swarm.update_rates
+
+
+def unchoked(swarm):
+    return {wire for wire in swarm.connections if not wire.peer.am_choking}
+
+
+print("\n=== TEST 1: TIT FOR TAT WHILE DOWNLOADING ===")
+clock = Clock()
+swarm = FakeSwarm(pieces_owned=5)
+wires = [FakeWire(clock, clock.now - 600) for _ in range(10)]
+swarm.connections.update(wires)
+choker = Choker(swarm, upload_slots=4, clock=clock)
+for step in range(1, 11):
+    for rank, wire in enumerate(wires):
+        wire.download_meter.add(rank * 10000)  # wire 9 sends us the most
+        wire.upload_meter.add((9 - rank) * 10000)
+    clock.now += 1
+    swarm.update_rates()
+choker.choke_round()
+regular = unchoked(swarm) - {choker.optimistic}
+assert regular == set(wires[6:]), [wires.index(w) for w in regular]
+assert choker.optimistic in wires[:6]
+assert wires[9].peer.download_rate > wires[8].peer.download_rate > 0
+print("ok")
+
+print("\n=== TEST 2: SEEDING RANKS BY UPLOAD RATE ===")
+for piece in range(10):
+    swarm.storage.my_bitfield[piece] = 1
+choker.choke_round()
+assert unchoked(swarm) - {choker.optimistic} == set(wires[:4])
+print("ok")
+
+print("\n=== TEST 3: NOT INTERESTED PEERS ARE CHOKED ===")
+for wire in wires[:4]:
+    wire.peer.peer_interested = False
+choker.choke_round()
+assert not unchoked(swarm) & set(wires[:4])
+assert len(unchoked(swarm)) == 5
+print("ok")
+
+print("\n=== TEST 4: OPTIMISTIC UNCHOKE ROTATES AND PREFERS NEW PEERS ===")
+clock = Clock()
+swarm = FakeSwarm(pieces_owned=0)
+old = [FakeWire(clock, clock.now - 600) for _ in range(50)]
+new = [FakeWire(clock, clock.now - 5) for _ in range(50)]
+swarm.connections.update(old + new)
+choker = Choker(swarm, upload_slots=0, optimistic_rounds=1, clock=clock)
+picked_new = 0
+for _ in range(2000):
+    choker.choke_round()
+    assert len(unchoked(swarm)) == 1
+    picked_new += choker.optimistic in new
+assert 0.65 < picked_new / 2000 < 0.85, picked_new  # 3:1 weighting -> 75%
+print("ok, new peers got %.0f%% of optimistic unchokes" % (100 * picked_new / 2000))
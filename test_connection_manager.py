@@ -0,0 +1,138 @@
+#testing code for the peer connection pool (connection_manager.py)
+import asyncio
+import hashlib
+import os
+import socket
+import tempfile
+
+from connection_manager import ConnectionManager, ConnectionBudget, BACKOFF_BASE, MAX_FAILURES
+from core import Storage
+from disk_storage import DiskStorage
+from piece_picker import PiecePicker
+from peer_protocol import Swarm
+
+PIECE_LENGTH = 64 * 1024
+DATA = os.urandom(12 * PIECE_LENGTH)
+NUM_PIECES = len(DATA) // PIECE_LENGTH
+HASHES = [hashlib.sha1(DATA[i:i + PIECE_LENGTH]).digest() for i in range(0, len(DATA), PIECE_LENGTH)]
+INFO_HASH = hashlib.sha1(b"connection manager").digest()
+tmp = tempfile.mkdtemp()
+names = iter(range(10 ** 6))
+
+
+def make_swarm(seed, path=None):
+    path = path or os.path.join(tmp, "swarm%d" % next(names))
+    disk = DiskStorage([(path, len(DATA))], PIECE_LENGTH)
+    storage = Storage(NUM_PIECES, PIECE_LENGTH, HASHES, disk)
+    if seed:
+        disk.write_now(0, 0, DATA)
+        for piece in range(NUM_PIECES):
+            storage.my_bitfield[piece] = 1
+    return Swarm(INFO_HASH, storage, PiecePicker(storage, len(DATA)))
+
+
+def dead_address():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()  # nothing listens there -> connection refused
+    return ("127.0.0.1", port)
+
+
+async def start_seeders(count):
+    seeders, servers, addresses = [], [], []
+    for _ in range(count):
+        seeder = make_swarm(True)
+        server = await seeder.listen("127.0.0.1", 0)
+        seeders.append(seeder)
+        servers.append(server)
+        addresses.append(("127.0.0.1", server.sockets[0].getsockname()[1]))
+    return seeders, servers, addresses
+
+
+async def main():
+    print("\n=== TEST 1: DEDUP, BOUNDED POOL, BACKOFF OF DEAD PEERS ===")
+    seeders, servers, addresses = await start_seeders(12)
+    dead = [dead_address() for _ in range(5)]
+    leecher = make_swarm(False)
+    manager = ConnectionManager(leecher, max_connections=4, stagger=0.02)
+    peers = dead + addresses
+    manager.add_peers(peers + peers)  # every address twice
+    manager.add_peers(peers)
+    assert len(manager.candidates) == 17
+    manager.start()
+    most = 0
+    #uploads are quick (sendfile), the download can be done before the staggered dials have filled the pool
+    while not leecher.completed.is_set() or len(manager.connected) < 4:
+        most = max(most, manager.connection_count())
+        await asyncio.sleep(0.001)
+    assert most <= 4, most
+    assert manager.dials <= 5 + 4, manager.dials  # the dead ones once, then the pool is full
+    for address in dead:
+        assert manager.backoff[address].failures == 1
+        assert address in manager.candidates  # queued again, for later
+    assert len(manager.connected) == 4
+    leecher.storage.disk.flush()
+    assert bytes(leecher.storage.disk.read_block(0, 0, len(DATA))) == DATA
+    manager.stop()
+    leecher.close()
+    print("ok, %d dials, at most %d connections" % (manager.dials, most))
+
+    print("\n=== TEST 2: EXPONENTIAL BACKOFF ===")
+    now = [0.0]
+    manager = ConnectionManager(make_swarm(False), clock=lambda: now[0])
+    address = ("10.1.2.3", 6881)
+    for failure in range(MAX_FAILURES):
+        manager.failed(address)
+        delay = manager.backoff[address].retry_at
+        assert 0.75 * BACKOFF_BASE * 2 ** failure <= delay <= 1.25 * BACKOFF_BASE * 2 ** failure
+        assert manager.next_candidate(now[0]) is None  # not before the backoff ran out
+        if failure < MAX_FAILURES - 1:
+            assert manager.next_candidate(delay) == address
+    assert address not in manager.candidates
+    manager.add_peers([address])
+    assert not manager.candidates  # given up on
+    print("ok")
+
+    print("\n=== TEST 3: SHARED CONNECTION BUDGET ===")
+    budget = ConnectionBudget(3)
+    leechers = [make_swarm(False), make_swarm(False)]
+    managers = [ConnectionManager(swarm, stagger=0.01, budget=budget) for swarm in leechers]
+    for m in managers:
+        m.add_peers(addresses)
+        m.start()
+    await asyncio.sleep(0.3)
+    assert sum(len(s.connections) for s in leechers) == 3 and budget.used == 3
+    for m, s in zip(managers, leechers):
+        m.stop()
+        s.close()
+    await asyncio.sleep(0.05)
+    assert budget.used == 0
+    print("ok")
+
+    print("\n=== TEST 4: RESTART KEEPS THE SOCKETS ===")
+    old = make_swarm(False, path=os.path.join(tmp, "restart"))
+    manager = ConnectionManager(old, max_connections=1, stagger=0.01)
+    manager.add_peers(addresses[:1])
+    manager.start()
+    while not old.connections:
+        await asyncio.sleep(0.01)
+    wire = next(iter(old.connections))
+    transport = wire.transport
+    new = make_swarm(False, path=os.path.join(tmp, "restart"))
+    manager.restart(new)
+    old.close()
+    await asyncio.wait_for(new.wait_complete(), 10)
+    assert wire.transport is transport and wire.swarm is new and manager.dials == 1
+    assert len(seeders[0].connections) == 1
+    manager.stop()
+    new.close()
+    print("ok")
+
+    for server in servers:
+        server.close()
+    for seeder in seeders:
+        seeder.close()
+    await asyncio.sleep(0)
+
+asyncio.run(main())
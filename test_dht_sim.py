@@ -0,0 +1,32 @@
+#testing code for the in-memory DHT simulation (dht_sim.py)
+from dht_sim import SimNetwork, format_stats, percentile
+
+print("\n=== TEST 1: LOOKUPS ON A CLEAN NETWORK ===")
+network = SimNetwork(seed=7)
+network.build(300)
+assert len(network.alive) == 300 and not network.events
+stats = network.run_lookups(100)
+print(format_stats(stats))
+assert stats["lookups"] == 100
+assert stats["found"] >= 0.9
+assert stats["timeouts"] == 0
+assert 1 <= percentile(stats["hops"], 50) <= 5
+assert all(latency <= 2 for latency in stats["latency"])  # no timeouts -> a few round trips
+assert stats["table_bytes"] > 0 and stats["table_contacts"] >= 8
+
+print("\n=== TEST 2: SAME SEED, SAME NUMBERS ===")
+again = SimNetwork(seed=7)
+again.build(300)
+assert again.run_lookups(100) == stats
+print("ok")
+
+print("\n=== TEST 3: LOSS AND CHURN ===")
+lossy = SimNetwork(seed=7, loss=0.1)
+lossy.build(300)
+lossy.churn(0.3)
+assert len(lossy.alive) == 300
+lossy_stats = lossy.run_lookups(100)
+print(format_stats(lossy_stats))
+assert lossy_stats["timeouts"] > 0
+assert percentile(lossy_stats["latency"], 90) > percentile(stats["latency"], 90)
+assert lossy_stats["found"] >= 0.3  # 10% loss each way + 30% dead contacts
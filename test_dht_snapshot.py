@@ -0,0 +1,113 @@
+#testing code for DHT snapshots and warm starts (dht_snapshot.py)
+import asyncio
+import os
+import random
+import socket
+import tempfile
+import time
+
+from async_dht import AsyncNode
+from core import Node
+from dht_snapshot import load_snapshot, save_snapshot
+
+tmp = tempfile.mkdtemp()
+
+print("\n=== TEST 1: ROUND TRIP ===")
+path = os.path.join(tmp, "node.snapshot")
+node = Node("127.0.0.1", 0, snapshot_path=path)
+for i in range(300):
+    node.routing_table.add_node(random.getrandbits(160), "10.0.%d.%d" % (i // 250, i % 250 + 1), 6881, lambda *a: None)
+info_hash = random.getrandbits(160)
+for i in range(20):
+    node.local_storage.add_peer(info_hash, "10.9.0.%d" % (i + 1), 7000 + i)
+node.close()
+assert not os.path.exists(path + ".tmp")
+node_id, contacts, peers = load_snapshot(path)
+assert node_id == node.node_id
+assert contacts == node.contacts() and len(contacts) == len(node.routing_table)
+#expiry is kept to the second
+assert sorted(peers) == sorted((h, c, int(e)) for h, c, e in node.local_storage.dump()) and len(peers) == 20
+print("ok, %d contacts in %d bytes" % (len(contacts), os.path.getsize(path)))
+
+print("\n=== TEST 2: RESTART KEEPS ID AND PEERS ===")
+restarted = Node("127.0.0.1", 0, snapshot_path=path)
+assert restarted.node_id == node.node_id
+assert len(restarted.snapshot_contacts) == len(contacts) and len(restarted.routing_table) == 0
+assert sorted(restarted.local_storage.get_peers(info_hash, 100)) == sorted(
+    ("10.9.0.%d" % (i + 1), 7000 + i) for i in range(20))
+restarted.sock.close()
+print("ok")
+
+print("\n=== TEST 3: BROKEN / OLD SNAPSHOTS ===")
+broken = os.path.join(tmp, "broken.snapshot")
+with open(broken, "wb") as fp:
+    fp.write(b"d7:versioni1e2:id3:abce")
+assert load_snapshot(broken) is None
+assert load_snapshot(os.path.join(tmp, "missing")) is None
+old = os.path.join(tmp, "old.snapshot")
+save_snapshot(old, 12345, contacts, peers)
+assert load_snapshot(old, max_age=-1) == (12345, [], [])
+fresh = Node("127.0.0.1", 0, snapshot_path=broken)
+assert fresh.node_id != node.node_id
+fresh.sock.close()
+print("ok")
+
+print("\n=== TEST 4: BOOTSTRAP PINGS CONCURRENTLY ===")
+dead = []
+for _ in range(4):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    dead.append(s)  # bound but never answering -> every ping runs into the 2s timeout
+cold = Node("127.0.0.1", 0, bootstrap_nodes=[s.getsockname() for s in dead])
+start = time.time()
+cold.bootstrap()
+elapsed = time.time() - start
+assert elapsed < 3.5, elapsed  # one timeout, not four in a row
+cold.sock.close()
+for s in dead:
+    s.close()
+print("ok, %.1fs" % elapsed)
+
+
+async def warm_start():
+    print("\n=== TEST 5: WARM START REVALIDATES CONTACTS ===")
+    nodes = [AsyncNode("127.0.0.1", 0, codec="bencode", rpc_timeout=0.5) for _ in range(30)]
+    for n in nodes:
+        await n.start()
+    #a kademlia join: ping node 0, then look up our own id so the nodes closest to us learn about us
+    for n in nodes[1:]:
+        n.bootstrap_nodes = [("127.0.0.1", nodes[0].port)]
+        await n.bootstrap()
+        await n.iterative_find_node(n.node_id)
+    path = os.path.join(tmp, "async.snapshot")
+    restarting = AsyncNode("127.0.0.1", 0, codec="bencode", rpc_timeout=0.5, snapshot_path=path)
+    await restarting.start()
+    restarting.bootstrap_nodes = [("127.0.0.1", nodes[0].port)]
+    await restarting.bootstrap()
+    for n in nodes:
+        await restarting.iterative_find_node(n.node_id)
+    known = {c[0] for c in restarting.contacts()}
+    restarting.close()
+    assert len(known) >= 10, len(known)
+
+    gone = nodes[:5]  # nodes that went away while we were down
+    for n in gone:
+        n.close()
+    warm = AsyncNode("127.0.0.1", 0, codec="bencode", rpc_timeout=0.5, snapshot_path=path)
+    assert warm.node_id == restarting.node_id and not warm.bootstrap_nodes
+    await warm.start()
+    start = time.time()
+    await warm.bootstrap()
+    elapsed = time.time() - start
+    back = {c[0] for c in warm.contacts()}
+    assert back == known - {n.node_id for n in gone}, (len(back), len(known))
+    assert elapsed < 1.5, elapsed
+    #lookups work straight away, without any bootstrap node
+    result = await warm.iterative_find_node(nodes[-1].node_id)
+    assert result and result[0][0] == nodes[-1].node_id, "warm lookup missed its target"
+    warm.close()
+    for n in nodes[5:]:
+        n.close()
+    print("ok, %d contacts back in %.2fs" % (len(back), elapsed))
+
+asyncio.run(warm_start())
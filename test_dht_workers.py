@@ -0,0 +1,54 @@
+#testing code for the worker pool / SO_REUSEPORT listener modes in core.py
+import random
+import threading
+import time
+
+from core import Node, run_dht_shards
+
+print("\n=== TEST 1: WORKER POOL ANSWERS CONCURRENT CLIENTS ===")
+server = Node("127.0.0.1", 0)
+server.start_dht_listener(workers=4)
+clients = [Node("127.0.0.1", 0) for _ in range(8)]
+answers = []
+
+
+def hammer(client):
+    for _ in range(50):
+        info_hash = server.node_id ^ random.getrandbits(32)  # server is the closest node, so it stores the peer
+        client.announce_peer(server.node_id, "127.0.0.1", server.port, info_hash)
+        response = client.get_peers(server.node_id, "127.0.0.1", server.port, info_hash)
+        answers.append(response is not None and "values" in response)
+
+
+start = time.time()
+threads = [threading.Thread(target=hammer, args=(c,)) for c in clients]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+print("%d round trips in %.2fs" % (len(answers) * 2, time.time() - start))
+assert len(answers) == 400 and all(answers)
+assert len(server.local_storage) == 400
+
+print("\n=== TEST 2: SO_REUSEPORT SHARDS SHARE ONE PORT ===")
+probe = Node("127.0.0.1", 0)
+port = probe.port
+probe.sock.close()
+node_id = random.getrandbits(160)
+shards = run_dht_shards("127.0.0.1", port, processes=4, node_id=node_id)
+time.sleep(1)
+client = Node("127.0.0.1", 0)
+response = client.ping(None, "127.0.0.1", port)
+assert response and response["node_id"] == node_id
+#every query comes from a fresh socket, so announce and get_peers mostly hit different shards: the info_hash
+#owner must answer both
+found = 0
+for i in range(20):
+    info_hash = node_id ^ random.getrandbits(32)
+    assert client.announce_peer(node_id, "127.0.0.1", port, info_hash) is not None
+    response = client.get_peers(node_id, "127.0.0.1", port, info_hash)
+    found += bool(response and [tuple(p) for p in response.get("values", ())] == [("127.0.0.1", client.port)])
+for shard in shards:
+    shard.terminate()
+assert found == 20, found
+print("shards answered as", node_id, "and found %d of 20 announces" % found)
@@ -0,0 +1,74 @@
+#testing code for the disk backend (disk_storage.py)
+import os
+import random
+import shutil
+import socket
+import tempfile
+
+from core import Storage, BLOCK_SIZE
+from disk_storage import DiskStorage
+
+PIECE_LENGTH = 4 * BLOCK_SIZE
+
+tmp = tempfile.mkdtemp()
+#multi-file layout with a file in a sub directory, an empty file and sizes that cut through pieces/blocks
+sizes = [70000, 0, 3, 200000]
+names = ["a.bin", "empty", os.path.join("sub", "b.bin"), os.path.join("sub", "c.bin")]
+files = [(os.path.join(tmp, name), size) for name, size in zip(names, sizes)]
+data = os.urandom(sum(sizes))
+total_pieces = (len(data) + PIECE_LENGTH - 1) // PIECE_LENGTH
+
+print("\n=== TEST 1: SPANS ACROSS FILES ===")
+disk = DiskStorage(files, PIECE_LENGTH, flush_size=1024 * 1024)
+assert disk.spans(69990, 20) == [(0, 69990, 10), (2, 0, 3), (3, 0, 7)]
+assert sum(length for _, _, length in disk.spans(0, len(data))) == len(data)
+print("ok")
+
+print("\n=== TEST 2: BLOCKS IN RANDOM ORDER, COALESCED WRITES ===")
+storage = Storage(total_pieces, PIECE_LENGTH, None, disk)
+blocks = []
+for piece in range(total_pieces):
+    piece_size = min(PIECE_LENGTH, len(data) - piece * PIECE_LENGTH)
+    num_blocks = (piece_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    storage.initialize_piece(piece, num_blocks)
+    for block in range(num_blocks):
+        blocks.append((piece, block))
+random.shuffle(blocks)
+writes = []
+real_pwritev = os.pwritev
+os.pwritev = lambda fd, iov, offset: writes.append(len(iov)) or real_pwritev(fd, iov, offset)
+for piece, block in blocks:
+    start = piece * PIECE_LENGTH + block * BLOCK_SIZE
+    storage.receive_block(piece, block, memoryview(data)[start:start + BLOCK_SIZE])
+disk.flush()
+os.pwritev = real_pwritev
+print("%d blocks written with %d pwritev calls" % (len(blocks), len(writes)))
+assert len(writes) == 3, "one write per non-empty file"
+assert all(storage.is_piece_complete(p) for p in range(total_pieces))
+for (path, size), offset in zip(files, disk.starts):
+    with open(path, "rb") as f:
+        assert f.read() == data[offset:offset + size]
+print("ok")
+
+print("\n=== TEST 3: READS FOR UPLOADS ===")
+buffer = bytearray(PIECE_LENGTH)
+assert disk.read_piece(1, buffer) == data[PIECE_LENGTH:2 * PIECE_LENGTH]
+last = total_pieces - 1
+assert disk.read_piece(last) == data[last * PIECE_LENGTH:]
+assert disk.read_block(1, 100, 50) == data[PIECE_LENGTH + 100:PIECE_LENGTH + 150]
+left, right = socket.socketpair()
+sent = disk.send_block(left, 1, 0, BLOCK_SIZE)  # block 0 of piece 1 crosses a.bin -> b.bin -> c.bin
+received = b""
+while len(received) < sent:
+    received += right.recv(65536)
+assert received == data[PIECE_LENGTH:PIECE_LENGTH + BLOCK_SIZE]
+left.close()
+right.close()
+print("ok")
+
+print("\n=== TEST 4: READ SEES PENDING WRITES ===")
+disk.write_block(0, 0, b"x" * 10)
+assert disk.read_block(0, 0, 10) == b"x" * 10
+disk.close()
+shutil.rmtree(tmp)
+print("ok")
@@ -0,0 +1,74 @@
+#testing code for the DHT wire formats (krpc.py)
+import random
+import socket
+
+from core import Node
+from krpc import get_codec, COMPACT_NODE_LENGTH
+
+nodes = [(random.getrandbits(160), "127.0.0.%d" % (i + 1), 6881 + i) for i in range(8)]
+messages = [
+    {"type": "ping", "node_id": random.getrandbits(160), "port": 6881, "t": 7},
+    {"type": "find_node", "node_id": random.getrandbits(160), "target_id": random.getrandbits(160), "port": 6881, "t": 8},
+    {"type": "get_peers", "node_id": random.getrandbits(160), "info_hash": random.getrandbits(160), "port": 6881, "t": 9},
+    {"type": "announce_peer", "node_id": random.getrandbits(160), "info_hash": random.getrandbits(160), "port": 51413, "t": 10},
+    {"node_id": random.getrandbits(160), "nodes": nodes, "t": 11},
+    {"node_id": random.getrandbits(160), "values": [("10.0.0.1", 51413), ("10.0.0.2", 6881)], "t": 12},
+]
+
+print("\n=== TEST 1: ROUND TRIP ===")
+for name in ("json", "bencode"):
+    codec = get_codec(name)
+    for message in messages:
+        decoded = codec.decode(codec.encode(message))
+        for key, value in message.items():
+            if isinstance(value, list):
+                assert [tuple(v) for v in decoded[key]] == value, (name, key)
+            else:
+                assert decoded[key] == value, (name, key)
+    print(name, "ok")
+
+print("\n=== TEST 2: PACKET SIZE ===")
+reply = messages[4]
+json_size = len(get_codec("json").encode(reply))
+bencode_size = len(get_codec("bencode").encode(reply))
+print("k=8 find_node reply: json %d bytes, bencode %d bytes" % (json_size, bencode_size))
+assert bencode_size < json_size
+assert len(get_codec("bencode").decode(get_codec("bencode").encode(reply))["nodes"]) * COMPACT_NODE_LENGTH == 8 * 26
+
+print("\n=== TEST 3: MALFORMED PACKETS ===")
+nested = b"d1:y1:q1:a" + b"l" * 1010 + b"e"  # 1021 bytes, recursion would run out long before the end
+for garbage in (b"", b"x", b"d1:y1:qe", b"i42e", b"d1:y1:r1:rd2:id3:abcee", nested,
+                b"d1:y1:q1:ad1:xllleee1:q4:pinge"):
+    try:
+        get_codec("bencode").decode(garbage)
+    except ValueError:
+        continue
+    raise AssertionError("accepted malformed packet %r" % garbage)
+try:
+    get_codec("json").decode(b'{"type": ' + b"[" * 5000 + b"]" * 5000 + b"}")
+    raise AssertionError("accepted deeply nested json")
+except ValueError:
+    pass
+print("malformed packets rejected")
+
+print("\n=== TEST 4: FOREIGN TRANSACTION IDS ARE ECHOED UNCHANGED ===")
+codec = get_codec("bencode")
+for t in (b"abcd", b"\x00\x00\x01", b"x", b"", b"\x00\x07"):
+    query = b"d1:ad2:id20:" + bytes(20) + b"e1:q4:ping1:t" + str(len(t)).encode() + b":" + t + b"1:y1:qe"
+    message = codec.decode(query)
+    reply = codec.decode(codec.encode({"node_id": 1, "t": message["t"]}))
+    answer = codec.encode({"node_id": 1, "t": message["t"]})
+    assert b"1:t" + str(len(t)).encode() + b":" + t in answer, (t, answer)
+    assert reply["t"] == message["t"]
+assert codec.decode(codec.encode({"node_id": 1, "t": 7}))["t"] == 7  # our own ids stay ints
+
+#and through a live node: the answer to a 4 byte "t" carries the same 4 bytes
+server = Node("127.0.0.1", 0, codec="bencode")
+server.start_dht_listener()
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.settimeout(2)
+sock.sendto(b"d1:ad2:id20:" + bytes(20) + b"4:porti1ee1:q4:ping1:t4:abcd1:y1:qe", ("127.0.0.1", server.port))
+data, _ = sock.recvfrom(4096)
+sock.close()
+assert codec.decode(data)["t"] == b"abcd", data
+print("ok")
@@ -0,0 +1,91 @@
+#testing code for the lookup state machine (lookup.py), runs over a fake network, no sockets
+import random
+
+from core import RoutingTable
+from lookup import Lookup, FAILED, RESPONDED
+
+NUM_NODES = 400
+K = 8
+
+ids = [random.getrandbits(160) for _ in range(NUM_NODES)]
+#every node gets a real routing table filled with everybody (full buckets just drop the newcomer)
+tables = {}
+for node_id in ids:
+    tables[node_id] = RoutingTable(node_id, K)
+    for other in ids:
+        tables[node_id].add_node(other, "10.0.0.1", 6881, lambda *node: None)
+peers_at = {}
+
+
+def respond(candidate, target):
+    if candidate.node_id in peers_at and target in peers_at[candidate.node_id]:
+        return {"values": peers_at[candidate.node_id][target]}
+    closest = tables[candidate.node_id].get_closest_nodes(target, K)
+    return {"nodes": [(n.node_id, n.ip, n.port) for n in closest]}
+
+
+def run(lookup, dead=()):
+    while not lookup.done:
+        queries = lookup.next_queries()
+        if not queries:
+            break
+        for path, candidate in queries:
+            response = None if candidate.node_id in dead else respond(candidate, lookup.target_id)
+            lookup.on_response(path, candidate, response)
+    return lookup
+
+
+def seeds_for(start):
+    return tables[start].get_closest_nodes(random.getrandbits(160), K)
+
+
+print("\n=== TEST 1: FIND_NODE CONVERGES ON THE TRUE K CLOSEST ===")
+hops = []
+for _ in range(50):
+    target = random.getrandbits(160)
+    lookup = run(Lookup(target, seeds_for(random.choice(ids)), K, 3))
+    expected = sorted(ids, key=lambda n: n ^ target)[:K]
+    assert [n[0] for n in lookup.closest_nodes()] == expected
+    hops.append(lookup.messages)
+print("messages per lookup: avg %.1f max %d" % (sum(hops) / len(hops), max(hops)))
+
+print("\n=== TEST 2: DEAD NODES ARE SKIPPED ===")
+target = random.getrandbits(160)
+expected = sorted(ids, key=lambda n: n ^ target)
+dead = set(expected[:3])
+lookup = run(Lookup(target, seeds_for(random.choice(ids)), K, 3), dead)
+result = [n[0] for n in lookup.closest_nodes()]
+assert not dead & set(result)
+assert result[:5] == expected[3:8]
+print("ok")
+
+print("\n=== TEST 3: GET_PEERS STOPS EARLY ===")
+info_hash = random.getrandbits(160)
+holders = sorted(ids, key=lambda n: n ^ info_hash)[:K]
+for i, holder in enumerate(holders):
+    peers_at[holder] = {info_hash: [("10.9.0.%d" % i, 6881), ("10.9.1.%d" % i, 6881)]}
+seeds = seeds_for(random.choice(ids))
+full = run(Lookup(info_hash, seeds, K, 3))
+early = run(Lookup(info_hash, seeds, K, 3, want_peers=2))
+assert len(full.found_peers) == 2 * K
+assert 2 <= len(early.found_peers) < len(full.found_peers)
+assert early.messages <= full.messages
+print("full lookup %d messages, early stop %d messages" % (full.messages, early.messages))
+
+print("\n=== TEST 4: DISJOINT PATHS NEVER SHARE A NODE ===")
+target = random.getrandbits(160)
+lookup = run(Lookup(target, [(n, "10.0.0.1", 6881) for n in random.sample(ids, 3 * K)], K, 3, paths=3))
+asked = [set(n for n, c in path.candidates.items() if c.state == RESPONDED) for path in lookup.paths]
+assert not (asked[0] & asked[1]) and not (asked[0] & asked[2]) and not (asked[1] & asked[2])
+assert lookup.closest_nodes()[0][0] == sorted(ids, key=lambda n: n ^ target)[0]
+print("ok")
+
+print("\n=== TEST 5: MALFORMED REPLIES COUNT AS FAILED ===")
+target = random.getrandbits(160)
+for bad in ({"node_id": 1, "nodes": 5}, {"node_id": 1, "nodes": [(1, "10.0.0.1")]},
+            {"node_id": 1, "values": [("10.0.0.1", "6881")]}, {"node_id": "1"}):
+    lookup = Lookup(target, [(1, "10.0.0.1", 6881)], K, 3)
+    (path, candidate), = lookup.next_queries()
+    lookup.on_response(path, candidate, bad)
+    assert candidate.state == FAILED and lookup.done and not lookup.closest_nodes(), bad
+print("ok")
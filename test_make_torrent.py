@@ -0,0 +1,101 @@
+#testing code for torrent creation (make_torrent.py)
+import hashlib
+import os
+import shutil
+import tempfile
+
+from make_torrent import (MAX_PIECE_LENGTH, MIN_PIECE_LENGTH, choose_piece_length, hash_pieces, make_torrent,
+                          write_torrent)
+from piece_verify import PieceHashes, PieceVerifier
+from read_torrent import TorrentFile
+
+PIECE_LENGTH = 16 * 1024
+
+tmp = tempfile.mkdtemp()
+release = os.path.join(tmp, "release")
+os.makedirs(os.path.join(release, "b_dir"))
+os.makedirs(os.path.join(release, "a_dir"))
+#sizes that don't line up with pieces, one empty file, a file smaller than a piece between two bigger ones
+layout = [("a_dir/x.bin", 50000), ("a_dir/y.bin", 7), ("b_dir/z.bin", 0), ("readme.txt", 120001)]
+data = bytearray()
+for name, size in layout:
+    chunk = os.urandom(size)
+    with open(os.path.join(release, *name.split("/")), "wb") as f:
+        f.write(chunk)
+    data += chunk
+expected = b"".join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+
+print("\n=== TEST 1: AUTOMATIC PIECE LENGTH ===")
+assert choose_piece_length(1) == MIN_PIECE_LENGTH
+assert choose_piece_length(5 * 1024 ** 3) == 4 * 1024 * 1024
+assert choose_piece_length(10 ** 15) == MAX_PIECE_LENGTH
+for size in (10 ** 6, 700 * 1024 ** 2, 40 * 1024 ** 3):
+    length = choose_piece_length(size)
+    assert length & (length - 1) == 0
+    assert (size + length - 1) // length <= 1500 or length == MAX_PIECE_LENGTH
+print("ok")
+
+print("\n=== TEST 2: PIECES STAY IN ORDER ACROSS FILES AND THREADS ===")
+files = [(os.path.join(release, *name.split("/")), size) for name, size in layout]
+for workers in (1, 4):
+    for read_size in (1, PIECE_LENGTH * 3, 1 << 22):  # one piece per chunk, several, the whole data at once
+        assert hash_pieces(files, PIECE_LENGTH, workers, read_size) == expected, (workers, read_size)
+print("ok")
+
+print("\n=== TEST 3: MULTI-FILE TORRENT ROUND TRIP ===")
+metainfo = make_torrent(release, announce="http://tracker/announce", trackers=["udp://backup:80"],
+                        piece_length=PIECE_LENGTH, comment="nightly", workers=3)
+out = os.path.join(tmp, "release.torrent")
+digest = write_torrent(metainfo, out)
+torrent = TorrentFile(out)
+assert torrent.info_hash == digest
+assert torrent.name == "release"
+assert torrent.announce == "http://tracker/announce"
+assert torrent.meta[b'announce-list'] == [[b"http://tracker/announce"], [b"udp://backup:80"]]
+assert bytes(torrent.pieces) == expected
+assert [b"/".join(f[b'path']).decode() for f in torrent.files] == [name for name, _ in layout]
+assert torrent.total_length == len(data)
+assert not os.path.exists(out + ".tmp")
+#what we created verifies against the data it was made from
+verifier = PieceVerifier(PieceHashes(torrent.pieces), workers=2)
+assert all(verifier.recheck(torrent.file_layout(tmp), torrent.piece_length))
+verifier.close()
+print("ok")
+
+print("\n=== TEST 4: SINGLE FILE, PRIVATE ===")
+single = os.path.join(release, "readme.txt")
+metainfo = make_torrent(single, private=True)
+info = metainfo[b'info']
+assert info[b'name'] == b"readme.txt" and info[b'length'] == 120001 and b'files' not in info
+assert info[b'private'] == 1 and b'announce' not in metainfo
+assert info[b'piece length'] == MIN_PIECE_LENGTH
+with open(single, "rb") as f:
+    content = f.read()
+assert info[b'pieces'] == b"".join(hashlib.sha1(content[i:i + MIN_PIECE_LENGTH]).digest()
+                                   for i in range(0, len(content), MIN_PIECE_LENGTH))
+print("ok")
+
+print("\n=== TEST 5: ERRORS ===")
+short = [(files[0][0], files[0][1] + 100)]  # the file is shorter than we claim, e.g. truncated while hashing
+try:
+    hash_pieces(short, PIECE_LENGTH, workers=2)
+    assert False, "short file not noticed"
+except OSError:
+    pass
+for bad in (1000, 3 * 16 * 1024):
+    try:
+        make_torrent(release, piece_length=bad)
+        assert False, "bad piece length accepted"
+    except ValueError:
+        pass
+empty = os.path.join(tmp, "empty")
+os.makedirs(empty)
+try:
+    make_torrent(empty)
+    assert False, "empty directory accepted"
+except ValueError:
+    pass
+print("ok")
+
+shutil.rmtree(tmp)
+print("\nall make_torrent tests passed")
@@ -0,0 +1,188 @@
+#testing code for the metrics layer (metrics.py) and the counters Node / Swarm write into it
+import asyncio
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+
+from core import Node, Storage
+from disk_storage import DiskStorage
+from metrics import Histogram, Metrics, SamplingProfiler, serve_metrics
+from peer_protocol import PeerClient, Swarm, build_handshake
+from piece_picker import PiecePicker
+
+print("\n=== TEST 1: COUNTERS, HISTOGRAMS, EXPORT ===")
+metrics = Metrics()
+metrics.inc("dht_rpc_sent_total", rpc="ping")
+metrics.inc("dht_rpc_sent_total", 2, rpc="ping")
+metrics.inc("dht_rpc_sent_total", rpc="find_node")
+metrics.inc("odd_total", rpc=None)  # label values of mixed types still sort
+for latency in (0.001, 0.02, 0.02, 0.3, 7):
+    metrics.observe("dht_rpc_latency_seconds", latency, rpc="ping")
+metrics.add_collector(lambda: [("queue_length", {}, 5)])
+assert metrics.value("dht_rpc_sent_total", rpc="ping") == 3
+assert metrics.total("dht_rpc_sent_total") == 4
+histogram = metrics.histogram("dht_rpc_latency_seconds", rpc="ping")
+assert histogram.count == 5 and histogram.quantile(0.5) == 0.025 and histogram.quantile(1) == float("inf")
+assert Histogram().quantile(0.5) == 0.0
+text = metrics.format_text()
+assert 'dht_rpc_sent_total{rpc="ping"} 3' in text and "queue_length 5" in text
+assert 'dht_rpc_latency_seconds{rpc="ping"} count 5' in text
+prometheus = metrics.format_prometheus()
+assert "# TYPE dht_rpc_sent_total counter" in prometheus
+assert "# HELP dht_rpc_sent_total" in prometheus
+assert "# TYPE queue_length gauge" in prometheus
+assert 'dht_rpc_latency_seconds_bucket{rpc="ping",le="0.025"} 3' in prometheus
+assert 'dht_rpc_latency_seconds_bucket{rpc="ping",le="+Inf"} 5' in prometheus
+assert 'dht_rpc_latency_seconds_count{rpc="ping"} 5' in prometheus
+print("ok")
+
+print("\n=== TEST 2: NODE RPC COUNTERS, TIMEOUTS, BAD PACKETS ===")
+server_metrics = Metrics()
+server = Node("127.0.0.1", 0, metrics=server_metrics)
+profiler = SamplingProfiler(interval=0.001)
+server.start_dht_listener(profiler=profiler)
+client = Node("127.0.0.1", 0)
+for _ in range(20):
+    assert client.ping(server.node_id, "127.0.0.1", server.port) is not None
+assert client.find_node(server.node_id, "127.0.0.1", server.port, 12345) is not None
+assert client.metrics.value("dht_rpc_sent_total", rpc="ping") == 20
+assert client.metrics.histogram("dht_rpc_latency_seconds", rpc="ping").count == 20
+assert server_metrics.value("dht_queries_received_total", rpc="ping") == 20
+assert server_metrics.value("dht_queries_received_total", rpc="find_node") == 1
+
+#garbage, a non-dict, broken json, a query without its target, an unknown query: counted, and the listener
+#keeps answering
+raw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+for packet in (b"\xff\x00 not a message", b"5", b'{"type" broken}',
+               b'{"type": "find_node", "node_id": 1, "port": 1, "t": 1}', b'{"type": "vote", "node_id": 1, "port": 1}'):
+    raw.sendto(packet, ("127.0.0.1", server.port))
+raw.close()
+time.sleep(0.2)
+assert server_metrics.value("dht_dropped_total", reason="malformed") == 2  # rejected before decoding
+assert server_metrics.value("dht_parse_errors_total", kind="query") == 1
+assert server_metrics.value("dht_query_errors_total", rpc="find_node") == 1
+assert server_metrics.value("dht_queries_unknown_total") == 1
+assert client.ping(server.node_id, "127.0.0.1", server.port) is not None
+
+#nobody listens on this port: the query times out instead of failing silently
+dead = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+dead.bind(("127.0.0.1", 0))
+dead_port = dead.getsockname()[1]
+assert client.ping(None, "127.0.0.1", dead_port) is None
+dead.close()
+assert client.metrics.value("dht_rpc_timeouts_total", rpc="ping") == 1
+assert client.ping(None, "127.0.0.1", 70000) is None  # a contact with a nonsense port
+assert client.metrics.value("dht_rpc_errors_total", rpc="ping", error="OverflowError") == 1
+
+text = server_metrics.format_text()
+assert "dht_routing_table_contacts 1" in text and "dht_peer_store_peers 0" in text
+print(text)
+print("ok")
+
+print("\n=== TEST 3: SAMPLING PROFILER ON THE LISTENER ===")
+for _ in range(200):
+    client.find_node(server.node_id, "127.0.0.1", server.port, 12345)
+profiler.stop()
+assert profiler.samples > 0
+assert any("listen" in ";".join(stack) for stack in profiler.stacks)
+assert all(line.rsplit(" ", 1)[1].isdigit() for line in profiler.collapsed().splitlines())
+print(profiler.format_top(5))
+print("ok")
+
+print("\n=== TEST 4: PROMETHEUS ENDPOINT ===")
+http = serve_metrics(server_metrics, "127.0.0.1", 0)
+url = "http://127.0.0.1:%d" % http.server_address[1]
+body = urllib.request.urlopen(url + "/metrics").read().decode()
+assert 'dht_queries_received_total{rpc="ping"} 21' in body
+assert "# TYPE dht_routing_table_contacts gauge" in body
+assert "dht_routing_table_contacts 1" in urllib.request.urlopen(url + "/metrics.txt").read().decode()
+try:
+    urllib.request.urlopen(url + "/nothing")
+    assert False, "unknown path served"
+except urllib.error.HTTPError as error:
+    assert error.code == 404
+http.shutdown()
+print("ok")
+
+print("\n=== TEST 5: PEER BYTE COUNTERS AND RATES ===")
+PIECE_LENGTH = 32 * 1024
+DATA = os.urandom(20 * PIECE_LENGTH)
+HASHES = [hashlib.sha1(DATA[i:i + PIECE_LENGTH]).digest() for i in range(0, len(DATA), PIECE_LENGTH)]
+INFO_HASH = hashlib.sha1(b"metrics torrent").digest()
+tmp = tempfile.mkdtemp()
+
+
+def make_swarm(name, seed, swarm_metrics):
+    disk = DiskStorage([(os.path.join(tmp, name), len(DATA))], PIECE_LENGTH)
+    storage = Storage(len(HASHES), PIECE_LENGTH, HASHES, disk)
+    if seed:
+        disk.write_block(0, 0, DATA)
+        disk.flush()
+        for piece in range(len(HASHES)):
+            storage.my_bitfield[piece] = 1
+    return Swarm(INFO_HASH, storage, PiecePicker(storage, len(DATA)), metrics=swarm_metrics)
+
+
+async def transfer():
+    peer_metrics = Metrics()
+    seeder = make_swarm("seed", True, peer_metrics)
+    leecher = make_swarm("leech", False, peer_metrics)
+    server = await seeder.listen("127.0.0.1", 0)
+    wire = await leecher.connect("127.0.0.1", server.sockets[0].getsockname()[1])
+    await asyncio.wait_for(leecher.wait_complete(), 30)
+    await asyncio.sleep(1.2)  # one rate tick
+    torrent = INFO_HASH.hex()
+    assert wire.peer.downloaded == len(DATA), wire.peer.downloaded
+    assert wire.peer.download_rate > 0
+    seeder_wire = next(iter(seeder.connections))
+    assert seeder_wire.peer.uploaded == len(DATA) and seeder_wire.peer.upload_rate > 0
+    assert peer_metrics.value("peer_downloaded_bytes_total", torrent=torrent) == len(DATA)
+    assert peer_metrics.value("peer_uploaded_bytes_total", torrent=torrent) == len(DATA)
+    assert peer_metrics.value("peer_pieces_verified_total", torrent=torrent) == len(HASHES)
+    assert 'peer_connections{torrent="%s"} 1' % torrent in peer_metrics.format_prometheus()
+    assert "peer_download_rate_bytes" in peer_metrics.format_text()
+    leecher.close()
+    seeder.close()
+    server.close()
+    assert not peer_metrics.collectors  # closed swarms stop reporting
+
+asyncio.run(transfer())
+print("ok")
+
+print("\n=== TEST 6: PEERCLIENT HANDSHAKE FAILURES BY REASON ===")
+client_metrics = Metrics()
+listener = socket.socket()
+listener.bind(("127.0.0.1", 0))
+listener.listen(4)
+replies = [build_handshake(INFO_HASH, b"-XX0000-" + b"0" * 12), b"HTTP/1.1 400 Bad Request\r\n" * 4, b"",
+           build_handshake(hashlib.sha1(b"other").digest(), b"-XX0000-" + b"0" * 12)]
+
+
+def answer():
+    for reply in replies:
+        conn, _ = listener.accept()
+        conn.recv(68)
+        conn.sendall(reply)
+        conn.close()
+
+threading.Thread(target=answer, daemon=True).start()
+port = listener.getsockname()[1]
+client = PeerClient("127.0.0.1", port, INFO_HASH.hex(), metrics=client_metrics)
+sock = client.connect()
+assert sock is not None
+sock.close()
+assert client.connect() is None  # not a handshake
+assert client.connect() is None  # closed before answering
+assert client.connect() is None  # another torrent
+listener.close()
+assert client.connect() is None  # nothing listens any more
+assert client_metrics.value("peer_handshakes_total") == 1
+for reason in ("invalid", "closed", "wrong_torrent", "connect"):
+    assert client_metrics.value("peer_handshake_failures_total", reason=reason) == 1, reason
+print("ok")
+
+print("\nall metrics tests passed")
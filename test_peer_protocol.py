@@ -0,0 +1,184 @@
+#testing code for the asyncio peer wire engine (peer_protocol.py)
+import asyncio
+import hashlib
+import os
+import struct
+import tempfile
+import time
+
+from bitfield import Bitfield
+from choker import Choker
+from core import Storage
+from disk_storage import DiskStorage
+from piece_picker import PiecePicker
+from peer_protocol import (
+    Swarm, PeerWire, encode_message, encode_have, build_handshake, parse_handshake, BITFIELD, UNCHOKE, PIECE,
+)
+
+PIECE_LENGTH = 64 * 1024
+DATA = os.urandom(40 * PIECE_LENGTH + 12345)
+NUM_PIECES = (len(DATA) + PIECE_LENGTH - 1) // PIECE_LENGTH
+HASHES = [hashlib.sha1(DATA[i:i + PIECE_LENGTH]).digest() for i in range(0, len(DATA), PIECE_LENGTH)]
+INFO_HASH = hashlib.sha1(b"test torrent").digest()
+
+tmp = tempfile.mkdtemp()
+
+
+def make_swarm(name, have=(), queue_depth=16, info_hash=INFO_HASH, **limits):
+    path = os.path.join(tmp, name)
+    disk = DiskStorage([(path, len(DATA))], PIECE_LENGTH)
+    storage = Storage(NUM_PIECES, PIECE_LENGTH, HASHES, disk)
+    for piece in have:
+        disk.write_block(piece, 0, DATA[piece * PIECE_LENGTH:(piece + 1) * PIECE_LENGTH])
+        storage.my_bitfield[piece] = 1
+    disk.flush()
+    picker = PiecePicker(storage, len(DATA))
+    return Swarm(info_hash, storage, picker, queue_depth=queue_depth, **limits)
+
+
+def read_back(swarm):
+    swarm.storage.disk.flush()
+    return bytes(swarm.storage.disk.read_block(0, 0, len(DATA)))
+
+
+async def main():
+    print("\n=== TEST 1: DOWNLOAD FROM ONE SEEDER ===")
+    seeder = make_swarm("seed1", have=range(NUM_PIECES))
+    sendfile_bytes = 0
+    send_block = seeder.storage.disk.send_block
+
+    def counting_send_block(*args):
+        nonlocal sendfile_bytes
+        sent = send_block(*args)
+        sendfile_bytes += sent
+        return sent
+    seeder.storage.disk.send_block = counting_send_block
+    server = await seeder.listen("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    leecher = make_swarm("leech1", queue_depth=8)
+    verified = []
+    verify = leecher.verifier.verify
+    leecher.verifier.verify = lambda piece, data: verified.append(piece) or verify(piece, data)
+    wire = await leecher.connect("127.0.0.1", port)
+    max_pending = 0
+
+    async def watch():
+        nonlocal max_pending
+        while True:
+            max_pending = max(max_pending, len(wire.peer.pending_requests))
+            await asyncio.sleep(0)
+    watcher = asyncio.ensure_future(watch())
+    await asyncio.wait_for(leecher.wait_complete(), 30)
+    watcher.cancel()
+    assert read_back(leecher) == DATA
+    assert 1 < max_pending <= 8, max_pending
+    assert not wire.peer.am_interested
+    #piece buffers come back to the pool, a handful are enough for the whole download
+    assert not leecher.piece_buffers and leecher.pool.allocated <= 8, leecher.pool.allocated
+    assert sorted(verified) == list(range(NUM_PIECES))  # every piece went through the swarm's PieceVerifier
+    #unthrottled, so the seeder's uploads went out with sendfile
+    assert sendfile_bytes > len(DATA) // 2, sendfile_bytes
+    print("ok, up to %d requests in flight, %d piece buffers, %d bytes sent with sendfile"
+          % (max_pending, leecher.pool.allocated, sendfile_bytes))
+
+    print("\n=== TEST 2: TWO PARTIAL SEEDERS ===")
+    evens = make_swarm("even", have=range(0, NUM_PIECES, 2))
+    odds = make_swarm("odd", have=range(1, NUM_PIECES, 2))
+    servers = [await evens.listen("127.0.0.1", 0), await odds.listen("127.0.0.1", 0)]
+    leecher2 = make_swarm("leech2")
+    for s in servers:
+        await leecher2.connect("127.0.0.1", s.sockets[0].getsockname()[1])
+    await asyncio.wait_for(leecher2.wait_complete(), 30)
+    assert read_back(leecher2) == DATA
+    #both seeders were told about every piece
+    await asyncio.sleep(0.1)
+    for seeder_wire in list(evens.connections) + list(odds.connections):
+        assert seeder_wire.peer.peer_bitfield.is_complete()
+    print("ok")
+
+    print("\n=== TEST 3: WRONG INFO_HASH IS REFUSED ===")
+    stranger = make_swarm("stranger", info_hash=hashlib.sha1(b"other").digest())
+    try:
+        await stranger.connect("127.0.0.1", port)
+        raise AssertionError("handshake for an unknown torrent went through")
+    except ConnectionError:
+        pass
+    print("ok")
+
+    print("\n=== TEST 4: FRAMES SPLIT AT EVERY BYTE ===")
+
+    class FakeTransport:
+        def __init__(self):
+            self.sent = []
+
+        def write(self, data):
+            self.sent.append(bytes(data))
+
+        def get_extra_info(self, name):
+            return ("10.0.0.1", 6881) if name == "peername" else None
+
+        def close(self):
+            raise AssertionError("connection closed")
+
+    swarm = make_swarm("fake")
+    wire = PeerWire(None, None, lookup_swarm={INFO_HASH: swarm}.get)
+    transport = FakeTransport()
+    wire.connection_made(transport)
+    stream = (
+        build_handshake(INFO_HASH, b"-XX0001-" + b"x" * 12)
+        + encode_message(BITFIELD, Bitfield(NUM_PIECES).to_bytes())
+        + encode_have(3) + b"\x00\x00\x00\x00" + encode_have(5)
+        + encode_message(UNCHOKE)
+    )
+    for byte in stream:
+        buffer = wire.get_buffer(-1)
+        buffer[0] = byte
+        wire.buffer_updated(1)
+    assert parse_handshake(transport.sent[0])[1] == INFO_HASH
+    assert wire.peer.peer_id == b"-XX0001-" + b"x" * 12
+    assert list(wire.peer.peer_bitfield.set_indices()) == [3, 5]
+    assert not wire.peer.peer_choking and wire.peer.am_interested
+    assert len(wire.peer.pending_requests) == 8  # every block of pieces 3 and 5
+
+    #a block split at every byte: once its header is in, the payload lands in the piece buffer directly
+    piece, block = next(iter(wire.peer.pending_requests))
+    payload = DATA[piece * PIECE_LENGTH + block * 16384:][:16384]
+    message = encode_message(PIECE, struct.pack(">II", piece, block * 16384) + payload)
+    for i, byte in enumerate(message):
+        buffer = wire.get_buffer(-1)
+        if i > 13:
+            assert wire.block == (piece, block)
+        buffer[0] = byte
+        wire.buffer_updated(1)
+    assert wire.block is None and (piece, block) not in wire.peer.pending_requests
+    assert swarm.storage.block_status[piece][block] == 2
+    assert swarm.piece_buffers[piece][block * 16384:(block + 1) * 16384] == payload
+    print("ok")
+
+    print("\n=== TEST 5: CHOKER + DOWNLOAD LIMIT ===")
+    seeder3 = make_swarm("seed3", have=range(NUM_PIECES))
+    choker = Choker(seeder3)
+    seeder3.choker = choker
+    choker.start()
+    server3 = await seeder3.listen("127.0.0.1", 0)
+    leecher3 = make_swarm("leech3", download_limit=1000000)
+    start = time.monotonic()
+    wire = await leecher3.connect("127.0.0.1", server3.sockets[0].getsockname()[1])
+    await asyncio.wait_for(leecher3.wait_complete(), 30)
+    elapsed = time.monotonic() - start
+    assert read_back(leecher3) == DATA
+    #1 MB burst, the other ~1.6 MB at 1 MB/s
+    assert 1.2 < elapsed < 5, elapsed
+    assert wire.download_meter.total == len(DATA)
+    servers.append(server3)
+    seeder3.close()
+    leecher3.close()
+    print("ok, %.2fs" % elapsed)
+
+    for s in [server] + servers:
+        s.close()
+    for s in (seeder, leecher, evens, odds, leecher2, stranger):
+        s.close()
+    await asyncio.sleep(0)
+
+asyncio.run(main())
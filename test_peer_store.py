@@ -0,0 +1,48 @@
+#testing code for the announce_peer store (peer_store.py)
+import time
+
+from peer_store import PeerStore
+
+print("\n=== TEST 1: DEDUP + SAMPLING ===")
+store = PeerStore()
+for i in range(500):
+    store.add_peer(1, "10.0.%d.%d" % (i // 256, i % 256), 6881)
+    store.add_peer(1, "10.0.%d.%d" % (i // 256, i % 256), 6881)  # duplicate announce
+assert store.peer_count == 500
+sample = store.get_peers(1, 50)
+assert len(sample) == 50 and len(set(sample)) == 50
+assert all(isinstance(port, int) for _, port in sample)
+assert store.get_peers(2) == []
+print("ok")
+
+print("\n=== TEST 2: TTL ===")
+store = PeerStore(ttl=0.2)
+store.add_peer(1, "10.0.0.1", 6881)
+time.sleep(0.1)
+store.add_peer(1, "10.0.0.2", 6881)
+time.sleep(0.15)
+assert store.get_peers(1) == [("10.0.0.2", 6881)]
+time.sleep(0.1)
+assert store.get_peers(1) == [] and len(store) == 0 and store.peer_count == 0
+print("ok")
+
+print("\n=== TEST 3: MEMORY CAP EVICTS COLD INFO_HASHES ===")
+store = PeerStore(max_peers=100, max_peers_per_torrent=40)
+for info_hash in range(10):
+    for i in range(30):
+        store.add_peer(info_hash, "10.1.0.%d" % i, 6881 + info_hash)
+    store.get_peers(0)  # keep torrent 0 hot
+assert store.peer_count <= 100
+assert store.get_peers(0), "hot info_hash was evicted"
+assert not store.get_peers(1), "cold info_hash survived"
+for i in range(100):
+    store.add_peer(42, "10.2.0.%d" % i, 6881)
+assert len(store.get_peers(42, 1000)) == 40
+print("ok")
+
+print("\n=== TEST 4: IPV6 / BAD PORT IGNORED ===")
+store = PeerStore()
+store.add_peer(1, "::1", 6881)
+store.add_peer(1, "10.0.0.1", 70000)
+assert store.peer_count == 0
+print("ok")
@@ -0,0 +1,132 @@
+#testing code for the piece picker (piece_picker.py)
+import random
+import time
+
+from bitfield import Bitfield
+from core import Storage, BLOCK_SIZE
+from piece_picker import PiecePicker, SEQUENTIAL
+
+PIECE_LENGTH = 4 * BLOCK_SIZE
+NUM_PIECES = 200
+TOTAL_LENGTH = NUM_PIECES * PIECE_LENGTH - 1000  # short last piece
+
+
+def random_bitfield(fraction):
+    bitfield = Bitfield(NUM_PIECES)
+    for piece in range(NUM_PIECES):
+        if random.random() < fraction:
+            bitfield[piece] = 1
+    return bitfield
+
+
+print("\n=== TEST 1: RAREST FIRST ===")
+storage = Storage(NUM_PIECES, PIECE_LENGTH, None)
+picker = PiecePicker(storage, TOTAL_LENGTH)
+peers = [random_bitfield(0.8) for _ in range(10)]
+for bitfield in peers:
+    picker.on_bitfield(bitfield)
+full = Bitfield.full(NUM_PIECES)
+piece, block, length = picker.pick_block(full)
+rarest = min(picker.availability[p] for p in range(NUM_PIECES) if picker.availability[p] > 0)
+assert picker.availability[piece] == rarest and block == 0 and length == BLOCK_SIZE
+#the started piece is finished before a new one is started
+assert picker.pick_block(full)[0] == piece
+print("ok")
+
+print("\n=== TEST 2: DOWNLOAD EVERYTHING FROM A SWARM ===")
+storage = Storage(NUM_PIECES, PIECE_LENGTH, None)
+picker = PiecePicker(storage, TOTAL_LENGTH)
+peers = [random_bitfield(0.3) for _ in range(20)] + [Bitfield.full(NUM_PIECES)]
+for bitfield in peers:
+    picker.on_bitfield(bitfield)
+requested = 0
+while storage.pieces_completed() < NUM_PIECES:
+    bitfield = random.choice(peers)
+    pick = picker.pick_block(bitfield)
+    if pick is None:
+        continue
+    piece, block, length = pick
+    assert bitfield[piece]
+    requested += 1
+    storage.mark_block_received(piece, block)
+    if storage.is_piece_complete(piece):
+        storage.my_bitfield[piece] = 1
+        picker.on_piece_complete(piece)
+assert requested == sum(picker.blocks_in_piece(p) for p in range(NUM_PIECES))
+assert picker.block_size(NUM_PIECES - 1, 3) == BLOCK_SIZE - 1000
+print("%d blocks requested, none twice" % requested)
+
+print("\n=== TEST 3: ENDGAME HANDS OUT IN-FLIGHT BLOCKS AGAIN ===")
+storage = Storage(2, PIECE_LENGTH, None)
+picker = PiecePicker(storage, 2 * PIECE_LENGTH)
+full = Bitfield.full(2)
+picker.on_bitfield(full)
+slow = [picker.pick_block(full) for _ in range(8)]
+assert None not in slow and picker.endgame
+duplicate = picker.pick_block(full, exclude={(p, b) for p, b, _ in slow[:4]})
+assert duplicate in slow[4:]
+picker.on_request_failed(*slow[0][:2])
+assert not picker.endgame and picker.pick_block(full) == slow[0]
+print("ok")
+
+print("\n=== TEST 4: SEQUENTIAL + FAILED PIECE ===")
+storage = Storage(NUM_PIECES, PIECE_LENGTH, None)
+picker = PiecePicker(storage, TOTAL_LENGTH, mode=SEQUENTIAL)
+picker.on_bitfield(Bitfield.full(NUM_PIECES))
+order = []
+for _ in range(12):
+    piece, block, _ = picker.pick_block(Bitfield.full(NUM_PIECES))
+    order.append(piece)
+    storage.mark_block_received(piece, block)
+assert order == [0] * 4 + [1] * 4 + [2] * 4
+picker.on_piece_failed(1)
+assert picker.pick_block(Bitfield.full(NUM_PIECES))[:2] == (1, 0)
+print("ok")
+
+print("\n=== TEST 5: PEER LEAVES ===")
+storage = Storage(NUM_PIECES, PIECE_LENGTH, None)
+picker = PiecePicker(storage, TOTAL_LENGTH)
+only = Bitfield(NUM_PIECES)
+only[7] = 1
+picker.on_bitfield(only)
+picker.on_bitfield(Bitfield.full(NUM_PIECES))
+assert picker.pick_block(Bitfield.full(NUM_PIECES))[0] != 7  # piece 7 has 2 copies, the rest 1
+picker.on_peer_gone(only)
+assert picker.availability[7] == 1
+print("ok")
+
+print("\n=== TEST 6: SPARSE PEER, MANY PIECES ===")
+#piece p has p % 8 + 1 copies, the peer asking only has the most common ones: every rarer level has
+#thousands of pieces it lacks, and picking must not walk them
+BIG = 100000
+storage = Storage(BIG, PIECE_LENGTH, None)
+picker = PiecePicker(storage, BIG * PIECE_LENGTH)
+for copies in range(8):
+    bitfield = Bitfield(BIG)
+    for piece in range(BIG):
+        if piece % 8 >= copies:
+            bitfield[piece] = 1
+    picker.on_bitfield(bitfield)
+sparse = Bitfield(BIG)
+for piece in range(7, BIG, 8):
+    sparse[piece] = 1
+start = time.perf_counter()
+picks = [picker.rarest_piece(sparse) for _ in range(200)]
+per_pick = (time.perf_counter() - start) / 200
+assert all(piece % 8 == 7 for piece in picks)
+assert len(set(picks)) > 150  # spread over the level, not the same piece for everyone
+print("%.3f ms per pick" % (per_pick * 1000))
+assert per_pick < 0.002, per_pick
+
+storage = Storage(BIG, PIECE_LENGTH, None)
+picker = PiecePicker(storage, BIG * PIECE_LENGTH, mode=SEQUENTIAL)
+only_last = Bitfield(BIG)
+only_last[BIG - 1] = 1
+picker.on_bitfield(only_last)
+start = time.perf_counter()
+for _ in range(200):
+    assert picker.sequential_piece(only_last) == BIG - 1
+per_pick = (time.perf_counter() - start) / 200
+print("%.3f ms per sequential pick" % (per_pick * 1000))
+assert per_pick < 0.002, per_pick
+print("ok")
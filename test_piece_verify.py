@@ -0,0 +1,64 @@
+#testing code for piece verification (piece_verify.py + Storage.verify_piece / recheck)
+import hashlib
+import os
+import shutil
+import tempfile
+
+from core import Storage
+from piece_verify import PieceHashes, PieceVerifier
+
+PIECE_LENGTH = 32 * 1024
+
+tmp = tempfile.mkdtemp()
+#3 files whose sizes don't line up with pieces, so pieces straddle file boundaries
+sizes = [100000, 5, 150000]
+data = os.urandom(sum(sizes))
+files = []
+offset = 0
+for i, size in enumerate(sizes):
+    path = os.path.join(tmp, "file%d" % i)
+    with open(path, "wb") as f:
+        f.write(data[offset:offset + size])
+    files.append((path, size))
+    offset += size
+
+blob = b"".join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+hashes = PieceHashes(blob)
+total_pieces = len(hashes)
+
+print("\n=== TEST 1: DIGEST INDEX ===")
+assert total_pieces == (len(data) + PIECE_LENGTH - 1) // PIECE_LENGTH
+assert hashes[0] == blob[:20] and hashes[-1] == blob[-20:]
+assert isinstance(hashes[3], memoryview)
+print("ok")
+
+print("\n=== TEST 2: RECHECK INTACT DATA ===")
+storage = Storage(total_pieces, PIECE_LENGTH, hashes)
+assert storage.recheck(files, workers=4) == total_pieces
+print("ok")
+
+print("\n=== TEST 3: RECHECK FINDS CORRUPTION + MISSING FILES ===")
+with open(files[2][0], "r+b") as f:
+    f.seek(70000)
+    f.write(b"\x00" if data[100005 + 70000] else b"\x01")
+bad_piece = (100005 + 70000) // PIECE_LENGTH
+storage.recheck(files, workers=4)
+assert storage.my_bitfield[bad_piece] == 0
+assert storage.my_bitfield.count() == total_pieces - 1
+os.remove(files[1][0])  # the 5 byte file sits inside piece 3
+storage.recheck(files, workers=2)
+assert storage.my_bitfield[100000 // PIECE_LENGTH] == 0
+assert storage.my_bitfield.count() == total_pieces - 2
+print("ok")
+
+print("\n=== TEST 4: VERIFY A DOWNLOADED PIECE ===")
+storage = Storage(total_pieces, PIECE_LENGTH, hashes)
+assert storage.verify_piece(1, data[PIECE_LENGTH:2 * PIECE_LENGTH])
+assert not storage.verify_piece(2, data[PIECE_LENGTH:2 * PIECE_LENGTH])
+assert storage.my_bitfield[1] == 1 and storage.my_bitfield[2] == 0
+verifier = PieceVerifier(hashes, workers=2)
+assert verifier.submit(0, memoryview(data)[:PIECE_LENGTH]).result()
+verifier.close()
+print("ok")
+
+shutil.rmtree(tmp)
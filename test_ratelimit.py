@@ -0,0 +1,58 @@
+#testing code for the token bucket and rate meter (ratelimit.py)
+import asyncio
+import time
+
+from ratelimit import TokenBucket, RateMeter, take_all
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+print("\n=== TEST 1: TOKEN BUCKET ===")
+clock = Clock()
+bucket = TokenBucket(1000, clock=clock)
+assert bucket.take(1000) == 0  # a full burst is free
+assert bucket.take(500) == 0.5  # then half a second of debt
+clock.now = 0.5
+assert bucket.take(0) == 0
+clock.now = 10
+bucket.refill()
+assert bucket.tokens == 1000  # never more than the burst
+assert bucket.try_take(600) and not bucket.try_take(600)
+assert TokenBucket(None).take(10 ** 9) == 0 and TokenBucket(0).try_take(10 ** 9)
+assert take_all([None, TokenBucket(100, clock=clock), TokenBucket(10, burst=0, clock=clock)], 50) == 5
+print("ok")
+
+print("\n=== TEST 2: RATE METER ===")
+clock = Clock()
+meter = RateMeter(time_constant=5, clock=clock)
+for second in range(1, 61):
+    meter.add(100000)
+    clock.now = second
+    meter.tick()
+assert abs(meter.rate - 100000) < 1000, meter.rate
+assert meter.total == 6000000
+for second in range(61, 81):
+    clock.now = second
+    meter.tick()
+assert meter.rate < 2000  # forgotten after a few time constants
+print("ok, %.0f B/s after 20 idle seconds" % meter.rate)
+
+print("\n=== TEST 3: WAITING ON A REAL CLOCK ===")
+
+
+async def spend():
+    bucket = TokenBucket(100000, burst=10000)
+    start = time.monotonic()
+    for _ in range(30):
+        await bucket.wait(1000)
+    return time.monotonic() - start
+
+elapsed = asyncio.run(spend())
+assert 0.15 < elapsed < 1, elapsed  # 30000 bytes - 10000 burst at 100000 B/s = 0.2 s
+print("ok, %.2fs" % elapsed)
@@ -0,0 +1,148 @@
+#testing code for request timeouts and endgame (request_manager.py)
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+
+from core import PeerConnection, Storage
+from disk_storage import DiskStorage
+from piece_picker import PiecePicker
+from peer_protocol import Swarm
+from request_manager import RequestManager, RttEstimator, INITIAL_TIMEOUT, MIN_TIMEOUT
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeWire:
+    def __init__(self, manager):
+        self.manager = manager
+        self.peer = PeerConnection("10.0.0.1", 6881)
+        self.rtt = RttEstimator()
+        self.cancelled = []
+        self.filled = 0
+
+    def request(self, piece, block, now):
+        self.peer.pending_requests[(piece, block)] = now
+        self.manager.track(self, piece, block, now)
+
+    def cancel(self, piece, block):
+        del self.peer.pending_requests[(piece, block)]
+        self.cancelled.append((piece, block))
+
+    def fill_requests(self):
+        self.filled += 1
+
+
+class FakeSwarm:
+    def __init__(self):
+        self.connections = set()
+        self.released = []
+        self.picker = type("Picker", (), {"endgame": False})()
+
+    def release(self, piece, block, source):
+        self.released.append((piece, block))
+
+
+print("\n=== TEST 1: RTT ESTIMATE ===")
+rtt = RttEstimator()
+assert rtt.rto == INITIAL_TIMEOUT
+for _ in range(50):
+    rtt.sample(0.2)
+assert rtt.rto == MIN_TIMEOUT
+for _ in range(50):
+    rtt.sample(8.0)
+assert 8 < rtt.rto < 12, rtt.rto
+rtt.on_timeout()
+assert rtt.rto > 16
+print("ok")
+
+print("\n=== TEST 2: ONLY STALE REQUESTS EXPIRE ===")
+clock = Clock()
+swarm = FakeSwarm()
+manager = RequestManager(swarm, clock=clock)
+fast, slow = FakeWire(manager), FakeWire(manager)
+swarm.connections.update((fast, slow))
+for block in range(100):
+    fast.request(0, block, clock.now)
+    slow.request(1, block, clock.now)
+#the fast peer answers everything
+for block in range(100):
+    sent_at = fast.peer.pending_requests.pop((0, block))
+    manager.on_answer(fast, sent_at, now=0.3)
+clock.now = INITIAL_TIMEOUT - 1
+manager.tick()
+assert not swarm.released
+clock.now = INITIAL_TIMEOUT
+manager.tick()
+assert sorted(swarm.released) == [(1, block) for block in range(100)]
+assert len(slow.cancelled) == 100 and not slow.peer.pending_requests
+assert manager.timeouts == 100 and slow.rtt.rto == 2 * INITIAL_TIMEOUT
+assert fast.filled == 1 and slow.filled == 1
+assert fast.rtt.rto == MIN_TIMEOUT
+print("ok")
+
+print("\n=== TEST 3: HEAP COMPACTION ===")
+clock = Clock()
+swarm = FakeSwarm()
+manager = RequestManager(swarm, clock=clock)
+wire = FakeWire(manager)
+swarm.connections.add(wire)
+for block in range(5000):
+    wire.request(0, block, clock.now)
+    wire.peer.pending_requests.pop((0, block))  # answered
+wire.request(1, 0, clock.now)
+manager.tick()
+assert len(manager) == 1
+print("ok")
+
+print("\n=== TEST 4: A STALLING PEER DOESN'T HOLD THE LAST BLOCKS ===")
+PIECE_LENGTH = 64 * 1024
+DATA = os.urandom(24 * PIECE_LENGTH)
+NUM_PIECES = len(DATA) // PIECE_LENGTH
+HASHES = [hashlib.sha1(DATA[i:i + PIECE_LENGTH]).digest() for i in range(0, len(DATA), PIECE_LENGTH)]
+INFO_HASH = hashlib.sha1(b"request manager").digest()
+tmp = tempfile.mkdtemp()
+
+
+def make_swarm(name, seed, **limits):
+    disk = DiskStorage([(os.path.join(tmp, name), len(DATA))], PIECE_LENGTH)
+    storage = Storage(NUM_PIECES, PIECE_LENGTH, HASHES, disk)
+    if seed:
+        disk.write_now(0, 0, DATA)
+        for piece in range(NUM_PIECES):
+            storage.my_bitfield[piece] = 1
+    return Swarm(INFO_HASH, storage, PiecePicker(storage, len(DATA)), **limits)
+
+
+async def main():
+    fast = make_swarm("fast", True)
+    #16 outstanding blocks at 4 KB/s would take a minute
+    slow = make_swarm("slow", True, peer_upload_limit=4000)
+    servers = [await fast.listen("127.0.0.1", 0), await slow.listen("127.0.0.1", 0)]
+    leecher = make_swarm("leecher", False)
+    start = time.monotonic()
+    #the slow peer gets its pipeline full of requests before the fast one shows up
+    await leecher.connect("127.0.0.1", servers[1].sockets[0].getsockname()[1])
+    await asyncio.sleep(0.2)
+    assert len(next(iter(leecher.connections)).peer.pending_requests) == 16
+    await leecher.connect("127.0.0.1", servers[0].sockets[0].getsockname()[1])
+    await asyncio.wait_for(leecher.wait_complete(), 30)
+    elapsed = time.monotonic() - start
+    leecher.storage.disk.flush()
+    assert bytes(leecher.storage.disk.read_block(0, 0, len(DATA))) == DATA
+    assert elapsed < 10, elapsed
+    for server in servers:
+        server.close()
+    for swarm in (fast, slow, leecher):
+        swarm.close()
+    await asyncio.sleep(0)
+    return elapsed
+
+print("ok, done in %.2fs" % asyncio.run(main()))
@@ -0,0 +1,65 @@
+#testing code for the splitting routing table in core.py
+import random
+import time
+
+from core import RoutingTable
+
+NUM_CONTACTS = 20000
+
+
+def no_ping(node_id, ip, port):
+    pass
+
+
+print("\n=== TEST 1: BUCKETS SPLIT ON DEMAND ===")
+table = RoutingTable(random.getrandbits(160))
+assert len(table.buckets) == 1
+for i in range(NUM_CONTACTS):
+    table.add_node(random.getrandbits(160), "10.0.0.1", 6881, no_ping)
+print("contacts:", len(table), "buckets:", len(table.buckets))
+assert len(table.buckets) > 1
+assert all(len(b.nodes) <= table.k for b in table.buckets)
+assert all(b.in_range(n.node_id) for b in table.buckets for n in b.nodes)
+assert [b.lo for b in table.buckets] == table.bucket_starts
+assert table.buckets[table.get_bucket_index(table.node_id)].in_range(table.node_id)
+
+print("\n=== TEST 2: CLOSEST NODES MATCH A FULL SORT ===")
+everything = [n for b in table.buckets for n in b.nodes]
+for _ in range(200):
+    target = random.choice([random.getrandbits(160), table.node_id, everything[0][0]])
+    expected = sorted(everything, key=lambda n: n.node_id ^ target)[:table.k]
+    assert table.get_closest_nodes(target, table.k) == expected
+    assert table.get_closest_nodes(target, 100) == sorted(everything, key=lambda n: n.node_id ^ target)[:100]
+print("ok")
+
+print("\n=== TEST 3: QUERY SPEED ===")
+targets = [random.getrandbits(160) for _ in range(2000)]
+start = time.time()
+for target in targets:
+    table.get_closest_nodes(target, table.k)
+print("%.1f us per get_closest_nodes" % ((time.time() - start) / len(targets) * 1e6))
+
+print("\n=== TEST 4: FULL BUCKET USES REPLACEMENT CACHE ===")
+table = RoutingTable(0)
+far = [2 ** 159 + i for i in range(table.k)]  # all land in the far half, which never splits
+for node_id in far:
+    table.add_node(node_id, "10.0.0.1", 6881, no_ping)
+asked = []
+start = time.time()
+for i in range(20):
+    table.add_node(2 ** 159 + 1000 + i, "10.0.0.2", 6881, lambda *node: asked.append(node))
+assert time.time() - start < 0.1, "add_node waited on the network"
+bucket = table.buckets[table.get_bucket_index(far[0])]
+assert [n.node_id for n in bucket.nodes] == far
+assert len(bucket.replacements) == bucket.max_replacements
+assert [a[0] for a in asked] == [far[0]], "only one liveness check should be in flight"
+
+table.ping_result(far[0], False)
+assert far[0] not in [n.node_id for n in bucket.nodes]
+assert bucket.nodes[-1].node_id == 2 ** 159 + 1019, "newest replacement should take the dead node's place"
+
+table.add_node(2 ** 159 + 5000, "10.0.0.3", 6881, lambda *node: asked.append(node))
+assert asked[-1][0] == far[1]
+table.ping_result(far[1], True)
+assert bucket.nodes[-1].node_id == far[1], "a live node moves to the tail"
+print("ok")
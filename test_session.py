@@ -0,0 +1,200 @@
+#testing code for the multi-torrent session (session.py)
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+
+from async_dht import AsyncNode
+from connection_manager import MAX_CONNECTIONS
+from core import Storage
+from disk_storage import DiskStorage
+from peer_protocol import Swarm
+from piece_picker import PiecePicker
+from session import Session
+
+PIECE_LENGTH = 32 * 1024
+tmp = tempfile.mkdtemp()
+TORRENTS = []
+for n in range(3):
+    data = os.urandom(10 * PIECE_LENGTH + 1000 * n)
+    hashes = [hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH)]
+    TORRENTS.append((hashlib.sha1(b"session torrent %d" % n).digest(), data, hashes))
+
+
+def make_storage(name, data, hashes, seed):
+    disk = DiskStorage([(os.path.join(tmp, name), len(data))], PIECE_LENGTH)
+    storage = Storage(len(hashes), PIECE_LENGTH, hashes, disk)
+    if seed:
+        disk.write_block(0, 0, data)
+        disk.flush()
+        for piece in range(len(hashes)):
+            storage.my_bitfield[piece] = 1
+    return storage, PiecePicker(storage, len(data))
+
+
+def read_back(swarm, length):
+    swarm.storage.disk.flush()
+    return bytes(swarm.storage.disk.read_block(0, 0, length))
+
+
+#budget counts move while stray dials (a peer found again through the DHT) come and go, wait for them to settle
+async def settled(check, timeout=3):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not check() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.02)
+    return check()
+
+
+async def main():
+    #a small DHT for the sessions to meet in
+    routers = [AsyncNode("127.0.0.1", 0) for _ in range(4)]
+    for router in routers:
+        await router.start()
+    bootstrap = [("127.0.0.1", routers[0].port)]
+    for router in routers[1:]:
+        await router.ping(None, *bootstrap[0])
+
+    print("\n=== TEST 1: TORRENTS FOUND THROUGH BATCHED DHT ANNOUNCES ===")
+    seeder = Session("127.0.0.1", 0, bootstrap_nodes=bootstrap, announce_interval=3, upload_limit=50 << 20)
+    leecher = Session("127.0.0.1", 0, bootstrap_nodes=bootstrap, announce_interval=3)
+    await seeder.start()
+    await leecher.start()
+    seeds, leeches = [], []
+    for n, (info_hash, data, hashes) in enumerate(TORRENTS):
+        seeds.append(seeder.add_torrent(info_hash, *make_storage("seed%d" % n, data, hashes, True)))
+        leeches.append(leecher.add_torrent(info_hash, *make_storage("leech%d" % n, data, hashes, False)))
+    await asyncio.wait_for(asyncio.gather(*(swarm.wait_complete() for swarm in leeches)), 60)
+    for swarm, (_, data, _) in zip(leeches, TORRENTS):
+        assert read_back(swarm, len(data)) == data
+    #every torrent was announced through the one DHT node, and the new torrents shared rounds
+    assert all(torrent.last_announce is not None for torrent in seeder.torrents.values())
+    assert seeder.announces < 3 * len(TORRENTS), seeder.announces
+    print("ok, %d announce lookups on the seeder" % seeder.announces)
+
+    print("\n=== TEST 2: ONE LISTENER, ONE PEER ID, SHARED POOLS AND BUDGETS ===")
+    #one connection per torrent between the two sessions (whichever side dialed first, duplicates are dropped)
+    for swarm in seeds:
+        assert len(swarm.connections) == 1
+        assert next(iter(swarm.connections)).peer.peer_id == leecher.peer_id
+        assert swarm.peer_id == seeder.peer_id
+        assert swarm.executor is seeder.disk_pool
+        assert swarm.upload_bucket is seeder.upload_bucket is not None
+    #a connection holds a budget slot on both ends, dialed or accepted
+    assert await settled(lambda: leecher.budget.used == seeder.budget.used == len(TORRENTS)), \
+        (leecher.budget.used, seeder.budget.used)
+    #an outside peer reaches every torrent on the session's one port, handshakes are routed by info_hash
+    for n, (info_hash, data, hashes) in enumerate(TORRENTS):
+        outsider = Swarm(info_hash, *make_storage("outsider%d" % n, data, hashes, False))
+        wire = await outsider.connect("127.0.0.1", seeder.port)
+        assert wire.peer.peer_id == seeder.peer_id
+        assert await settled(lambda: len(seeds[n].connections) == 2 and seeder.budget.used == len(TORRENTS) + 1)
+        outsider.close()
+        assert await settled(lambda: seeder.budget.used == len(TORRENTS))
+    uploaded = sum(len(data) for _, data, _ in TORRENTS)
+    assert seeder.metrics.total("peer_uploaded_bytes_total") >= uploaded  # endgame duplicates can add a few blocks
+    print("ok")
+
+    print("\n=== TEST 3: INCOMING CONNECTIONS NEED A FREE SLOT ===")
+    info_hash, data, hashes = TORRENTS[1]
+
+    async def refused(name):
+        outsider = Swarm(info_hash, *make_storage(name, data, hashes, False))
+        try:
+            await outsider.connect("127.0.0.1", seeder.port)
+            return False
+        except ConnectionError:
+            return True
+        finally:
+            outsider.close()
+
+    limit = seeder.budget.limit
+    seeder.budget.limit = 0  # the session is out of file descriptors
+    assert await refused("outsider-budget")
+    assert seeder.metrics.value("peer_incoming_refused_total", reason="budget") >= 1
+    seeder.budget.limit = limit
+    seeder.torrents[info_hash].manager.max_connections = 1  # this torrent is full, the session isn't
+    assert await refused("outsider-full")
+    assert seeder.metrics.value("peer_incoming_refused_total", reason="torrent_full") >= 1
+    assert await settled(lambda: seeder.budget.used == len(TORRENTS) and len(seeds[1].connections) == 1)
+    seeder.torrents[info_hash].manager.max_connections = MAX_CONNECTIONS
+    print("ok")
+
+    print("\n=== TEST 4: PAUSED TORRENTS ARE REFUSED ===")
+    info_hash = TORRENTS[0][0]
+    seeder.pause(info_hash)
+    await asyncio.sleep(0.2)
+    assert not seeds[0].connections
+    assert seeder.lookup_swarm(info_hash) is None
+    try:
+        await leeches[0].connect("127.0.0.1", seeder.port)
+        raise AssertionError("handshake for a paused torrent went through")
+    except ConnectionError:
+        pass
+    assert len(seeds[1].connections) == 1  # the other torrents are untouched
+    seeder.resume(info_hash)
+    assert seeder.lookup_swarm(info_hash) is seeds[0]
+    try:
+        seeder.add_torrent(info_hash, *make_storage("again", TORRENTS[0][1], TORRENTS[0][2], True))
+        raise AssertionError("torrent added twice")
+    except ValueError:
+        pass
+    print("ok")
+
+    print("\n=== TEST 5: CLOSE RELEASES EVERYTHING ===")
+    await leecher.close()
+    await seeder.close()
+    assert not leecher.torrents and not seeder.torrents
+    assert await settled(lambda: leecher.budget.used == seeder.budget.used == 0), \
+        (leecher.budget.used, seeder.budget.used)
+    assert not seeder.metrics.collectors or all(c.__self__ is seeder.node for c in seeder.metrics.collectors)
+    for router in routers:
+        router.close()
+    print("ok")
+
+
+
+#answers every query with a reply that decodes but is unusable ("nodes" is not a list)
+class BrokenNode(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = json.loads(data)
+        self.transport.sendto(json.dumps({"t": query["t"], "node_id": 123, "nodes": 5}).encode(), addr)
+
+
+async def broken_dht():
+    print("\n=== TEST 6: BAD REPLIES AND FAILING ANNOUNCES DON'T STOP THE ANNOUNCE LOOP ===")
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(BrokenNode, local_addr=("127.0.0.1", 0))
+    broken_port = transport.get_extra_info("sockname")[1]
+    session = Session("127.0.0.1", 0, announce_interval=0.2)
+    session.node.rpc_timeout = 0.5
+    await session.start()
+    session.node.routing_table.add_node(123, "127.0.0.1", broken_port, session.node.queue_ping)
+    calls = []
+    get_peers_and_announce = session.node.get_peers_and_announce
+
+    async def flaky(info_hash, alpha=3):
+        calls.append(info_hash)
+        if len(calls) == 1:
+            raise RuntimeError("first announce blows up")
+        return await get_peers_and_announce(info_hash, alpha)
+
+    session.node.get_peers_and_announce = flaky
+    info_hash, data, hashes = TORRENTS[0]
+    session.add_torrent(info_hash, *make_storage("broken", data, hashes, True))
+    assert await settled(lambda: session.announces >= 4, timeout=10), session.announces
+    torrent = session.torrents[info_hash]
+    assert torrent.announce_failures == 1
+    assert session.metrics.value("session_announce_failures_total", error="RuntimeError") == 1
+    assert session.metrics.total("dht_bad_replies_total") > 0
+    assert torrent.last_announce is None  # the only node it knows never took an announce
+    await session.close()
+    transport.close()
+    print("ok, %d announces, %d bad replies" % (session.announces, session.metrics.total("dht_bad_replies_total")))
+
+asyncio.run(main())
+asyncio.run(broken_dht())
+print("\nall session tests passed")